@@ -0,0 +1,8 @@
+"""
+CPU health checks. The results of the last run of main() can be read by any process with
+read_snapshot and read_check_result, without running the checks again.
+"""
+from cpu_health_checks.snapshot import (SnapshotRecord, read_check_result,
+                                        read_snapshot)
+
+__all__ = ['SnapshotRecord', 'read_check_result', 'read_snapshot']
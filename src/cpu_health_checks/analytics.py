@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Felipe Santana Rojas
+# Date: 2023-06-07
+# Filename: analytics.py
+# License: MIT License
+"""
+Offline analytics of the speed registers and the per-host logs.
+
+The registers (e.g. download_speed_register.txt) are parsed in bulk by numpy while being streamed
+from disk, and the logs are streamed line by line keeping only a few numbers per check run, so
+histories of millions of rows are analyzed without building Python objects for every row. All
+the aggregations (time-of-day and day-of-week profiles, percentiles, pass rates per check and
+day, and per-host summaries) are vectorized with numpy.
+
+It can be run from the command line, for example:
+
+    python analytics.py --logs-folder ../../logs/ --registers download_speed_register.txt
+"""
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+
+import cpu_health_checks.utilities as utilities
+
+PERCENTILES = [5, 25, 50, 75, 95]
+WEEK_DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+LOG_LINE = re.compile(r'^(\d{4}-\d{2}-\d{2}) [\d:,]+ - \w+ - (.*)$')
+LOG_EVENTS = [(re.compile(r'^Running (\w+)$'), 'run'),
+              (re.compile(r"^(\w+) didn't passed$"), 'failed'),
+              (re.compile(r'^(\w+) timed out because'), 'failed'),
+              (re.compile(r'^(\w+) was set to failed because'), 'dependency_failed')]
+LOG_SPEED = re.compile(r'^(Downloaded|Uploaded) at an average speed of ([\d.]+)Mb/s')
+
+
+def read_register(register_filename):
+    """
+    Reads a speed register written by utilities.handle_final_speed_test.
+
+    The 'HH:MM' column is split into two numeric columns while the lines are streamed to
+    np.loadtxt, so the whole register is parsed by numpy without loading it as text first. The
+    daily aggregates of the rows older than register_retention_days (see
+    utilities.load_speed_register) are read too, and raw rows of days already aggregated by an
+    interrupted compaction are dropped so no speed is counted twice.
+
+    Returns:
+        dict: Dictionary with the 'timestamps' (datetime64 with minute resolution), the transfer
+        'times' in seconds and the 'speeds' in Mb/s of every row, and the 'daily_dates',
+        'daily_counts' and 'daily_means' of the daily aggregates.
+    """
+    with open(register_filename, 'r') as f:
+        next(f, None)  # Skips the header
+        rows = np.loadtxt((line.replace(':', ' ') for line in f), ndmin=2)
+    if rows.size == 0:
+        rows = np.zeros((0, 7))
+    daily = utilities.read_daily_register(register_filename)
+    daily_dates = utilities.register_dates(daily)
+    dates = utilities.register_dates(rows)
+    if daily_dates.size:
+        rows, dates = rows[dates > daily_dates.max()], dates[dates > daily_dates.max()]
+    hour, minute = rows[:, 3:5].astype(int).T
+    timestamps = dates.astype('datetime64[m]') + 60 * hour + minute
+    return {'timestamps': timestamps, 'times': rows[:, 5], 'speeds': rows[:, 6],
+            'daily_dates': daily_dates, 'daily_counts': daily[:, 3].astype(int),
+            'daily_means': daily[:, 4]}
+
+
+def grouped_percentiles(groups, values, number_of_groups, percentiles=PERCENTILES, weights=None):
+    """
+    Computes the count, mean and percentiles of the values of every group at once.
+
+    The values are sorted by group and value with a single lexsort, so the percentiles of every
+    group are read from the sorted array (interpolating linearly like np.percentile) without
+    looping over the groups. A value with weight w counts as w copies of it, which are found in
+    the sorted array with the cumulative weights instead of being repeated.
+
+    Args:
+        groups (np.ndarray): Group index (between 0 and number_of_groups - 1) of every value.\n
+        values (np.ndarray): Values to aggregate.\n
+        number_of_groups (int): Number of groups.\n
+        percentiles (list): Percentiles computed for every group.\n
+        weights (np.ndarray): Integer weight of every value, 1 by default.\n
+
+    Returns:
+        dict: Dictionary with the 'count' and 'mean' arrays of length number_of_groups and the
+        'percentiles' array with one row per group and one column per percentile. Groups
+        without values have NaN mean and percentiles.
+    """
+    weights = np.ones(values.size, dtype=int) if weights is None else weights.astype(int)
+    counts = np.bincount(groups, weights=weights, minlength=number_of_groups).astype(int)
+    sums = np.bincount(groups, weights=values * weights, minlength=number_of_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    # The k-th copy of the sorted values is the first value whose cumulative weight exceeds k
+    cumulative_weights = np.cumsum(weights[order])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    positions = (np.maximum(counts - 1, 0)[:, None] * np.asarray(percentiles)[None, :] / 100)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, np.maximum(counts - 1, 0)[:, None])
+    fraction = positions - lower
+    result = np.full((number_of_groups, len(percentiles)), np.nan)
+    has_values = counts > 0
+    if sorted_values.size:
+        lower_values, upper_values = [
+            sorted_values[np.minimum(np.searchsorted(cumulative_weights, starts[:, None] + copy,
+                                                     side='right'), sorted_values.size - 1)]
+            for copy in [lower, upper]]
+        result[has_values] = (lower_values + fraction * (upper_values - lower_values))[has_values]
+    return {'count': counts, 'mean': means, 'percentiles': result}
+
+
+def throughput_profiles(register):
+    """
+    Computes the speed profiles of a register read with read_register.
+
+    The daily aggregates have no time of day, so they are only used in the day of week and
+    overall profiles, where every day counts as its number of speeds at its mean speed.
+
+    Returns:
+        dict: Dictionary with the 'hour_of_day' (24 groups) and 'day_of_week' (7 groups, starting
+        on Monday) profiles as returned by grouped_percentiles, and the 'overall' percentiles.
+    """
+    timestamps, speeds = register['timestamps'], register['speeds']
+    hours = (timestamps.astype('datetime64[h]') - timestamps.astype('datetime64[D]')).astype(int)
+    dates = np.concatenate([timestamps.astype('datetime64[D]'), register['daily_dates']])
+    all_speeds = np.concatenate([speeds, register['daily_means']])
+    weights = np.concatenate([np.ones(speeds.size, dtype=int), register['daily_counts']])
+    # 1970-01-01 was a Thursday, so 3 days are added to start the weeks on Monday
+    week_days = (dates.astype(int) + 3) % 7
+    overall = grouped_percentiles(np.zeros(all_speeds.size, dtype=int), all_speeds, 1,
+                                  weights=weights)['percentiles'][0]
+    return {'hour_of_day': grouped_percentiles(hours, speeds, 24),
+            'day_of_week': grouped_percentiles(week_days, all_speeds, 7, weights=weights),
+            'overall': overall}
+
+
+def read_log(log_filename):
+    """
+    Streams a log written by CPUCheck keeping only the check runs, failures and speeds.
+
+    Returns:
+        dict: Dictionary with the arrays 'check_names', 'check_dates' and 'check_failed' with
+        one element per check run (the dates as datetime64 days), and the arrays
+        'download_speeds' and 'upload_speeds' in Mb/s.
+    """
+    names, dates, failed = [], [], []
+    speeds = {'Downloaded': [], 'Uploaded': []}
+    last_run = {}
+    with open(log_filename, 'r', errors='replace') as f:
+        for line in f:
+            match = LOG_LINE.match(line)
+            if match is None:
+                continue
+            date, message = match.groups()
+            speed_match = LOG_SPEED.match(message)
+            if speed_match is not None:
+                speeds[speed_match.group(1)].append(float(speed_match.group(2)))
+                continue
+            for pattern, event in LOG_EVENTS:
+                event_match = pattern.match(message)
+                if event_match is None:
+                    continue
+                name = event_match.group(1)
+                if event in ['run', 'dependency_failed']:
+                    last_run[name] = len(names)
+                    names.append(name)
+                    dates.append(date)
+                    failed.append(event == 'dependency_failed')
+                elif name in last_run:
+                    failed[last_run[name]] = True
+                break
+    return {'check_names': np.array(names, dtype=str),
+            'check_dates': np.array(dates, dtype='datetime64[D]'),
+            'check_failed': np.array(failed, dtype=bool),
+            'download_speeds': np.array(speeds['Downloaded']),
+            'upload_speeds': np.array(speeds['Uploaded'])}
+
+
+def pass_rate_trends(log):
+    """
+    Computes the daily pass rate of every check of a log read with read_log.
+
+    Returns:
+        dict: Dictionary with the check names as keys and as values tuples with the array of
+        days, the number of runs and the pass rate (between 0 and 1) of every day.
+    """
+    trends = {}
+    if log['check_names'].size == 0:
+        return trends
+    check_names, check_index = np.unique(log['check_names'], return_inverse=True)
+    days, day_index = np.unique(log['check_dates'], return_inverse=True)
+    cells = check_index * len(days) + day_index
+    runs = np.bincount(cells, minlength=len(check_names) * len(days)).reshape(-1, len(days))
+    passes = np.bincount(cells, weights=~log['check_failed'],
+                         minlength=len(check_names) * len(days)).reshape(-1, len(days))
+    for number, name in enumerate(check_names):
+        with_runs = runs[number] > 0
+        trends[str(name)] = (days[with_runs], runs[number][with_runs],
+                             passes[number][with_runs] / runs[number][with_runs])
+    return trends
+
+
+def compare_hosts(logs):
+    """
+    Summarizes the logs of several hosts to compare them.
+
+    Args:
+        logs (dict): Dictionary with the host names as keys and the logs read with read_log as
+        values.\n
+
+    Returns:
+        dict: Dictionary with the host names as keys and as values dictionaries with the number
+        of check 'runs', the overall 'pass_rate' and the 'download_percentiles' and
+        'upload_percentiles' (NaN if there are no speeds).
+    """
+    summary = {}
+    for host, log in logs.items():
+        runs = log['check_failed'].size
+        summary[host] = {'runs': runs,
+                         'pass_rate': 1 - log['check_failed'].mean() if runs else np.nan}
+        for kind in ['download', 'upload']:
+            speeds = log[f'{kind}_speeds']
+            summary[host][f'{kind}_percentiles'] = (
+                np.percentile(speeds, PERCENTILES) if speeds.size
+                else np.full(len(PERCENTILES), np.nan))
+    return summary
+
+
+def format_percentiles(values):
+    """Returns the percentiles as a fixed width string."""
+    return ' '.join(f'{value:8.2f}' for value in values)
+
+
+def print_register_report(register_filename):
+    """Prints the speed profiles of a register."""
+    register = read_register(register_filename)
+    profiles = throughput_profiles(register)
+    header = ' '.join(f'{"p" + str(percentile):>8}' for percentile in PERCENTILES)
+    print(f'\n{register_filename}: {register["speeds"].size} rows and '
+          f'{register["daily_counts"].sum()} older speeds in {register["daily_dates"].size} '
+          f'daily aggregates')
+    print(f'    Overall speed percentiles [Mb/s]: {format_percentiles(profiles["overall"])}')
+    for profile_name, labels in [('hour_of_day', [f'{hour:02}h' for hour in range(24)]),
+                                 ('day_of_week', WEEK_DAYS)]:
+        profile = profiles[profile_name]
+        print(f'    {profile_name:<12} {"count":>7} {"mean":>8} {header}')
+        for label, count, mean, percentiles in zip(labels, profile['count'], profile['mean'],
+                                                   profile['percentiles']):
+            if count:
+                print(f'    {label:<12} {count:7} {mean:8.2f} '
+                      f'{format_percentiles(percentiles)}')
+
+
+def print_logs_report(log_filenames):
+    """Prints the pass rate trends of every check and the comparison of the hosts."""
+    logs = {os.path.splitext(os.path.basename(filename))[0]: read_log(filename)
+            for filename in log_filenames}
+    for host, log in logs.items():
+        print(f'\n{host}: daily pass rate per check')
+        for name, (days, runs, pass_rates) in pass_rate_trends(log).items():
+            trend = ', '.join(f'{day} {100 * rate:.0f}% ({count})'
+                              for day, count, rate in zip(days[-7:], runs[-7:], pass_rates[-7:]))
+            print(f'    {name:<30} {trend}')
+
+    print('\nHost comparison (speed percentiles in Mb/s: '
+          + ', '.join(f'p{percentile}' for percentile in PERCENTILES) + ')')
+    for host, summary in compare_hosts(logs).items():
+        print(f'    {host}: {summary["runs"]} check runs, '
+              f'{100 * summary["pass_rate"]:.1f}% passed')
+        print(f'        download {format_percentiles(summary["download_percentiles"])}')
+        print(f'        upload   {format_percentiles(summary["upload_percentiles"])}')
+
+
+def main():
+    """Prints the analytics of the registers and logs given in the command line."""
+    parser = argparse.ArgumentParser(description='Offline analytics of the speed registers and '
+                                                 'the per-host logs')
+    parser.add_argument('--logs-folder', default='../../logs/',
+                        help='Folder with the registers and the .log files of every host')
+    parser.add_argument('--registers', nargs='*', default=['download_speed_register.txt'],
+                        help='Register files (relative to the logs folder) to analyze')
+    parser.add_argument('--logs', nargs='*', default=None,
+                        help='Log files (relative to the logs folder) to analyze. By default '
+                             'all the .log files of the logs folder')
+    args = parser.parse_args()
+
+    for register_filename in args.registers:
+        register_filename = os.path.join(args.logs_folder, register_filename)
+        if os.path.isfile(register_filename):
+            print_register_report(register_filename)
+        else:
+            print(f'\n{register_filename} was not found')
+
+    if args.logs is None:
+        log_filenames = sorted(glob.glob(os.path.join(args.logs_folder, '*.log')))
+    else:
+        log_filenames = [os.path.join(args.logs_folder, filename) for filename in args.logs]
+    if log_filenames:
+        print_logs_report(log_filenames)
+
+
+if __name__ == '__main__':
+    main()
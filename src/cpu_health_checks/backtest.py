@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Felipe Santana Rojas
+# Date: 2023-06-07
+# Filename: backtest.py
+# License: MIT License
+"""
+Backtesting of the outlier rule used by the speed and latency checks.
+
+A stored register is replayed through the same rule used by utilities.handle_final_speed_test
+(through handle_final_download_test) and utilities.handle_final_latency_test: every value is
+compared with the mean and standard deviation of all the values stored before it, once there
+are at least minimum_previous_tests of them. The statistics of every prefix of the history are
+computed at once with cumulative sums, starting from the statistics of the daily aggregates of
+the rows older than register_retention_days (which are not evaluated themselves since only
+their statistics are kept), and whole grids of std_deviations_limit and
+minimum_previous_tests values are evaluated with numpy broadcasting, so grids of thousands of
+combinations over a year of history take seconds.
+
+It can be run from the command line, for example:
+
+    python backtest.py --register ../../logs/download_speed_register.txt \
+        --std-deviations-limit 0.5 4 0.1 --minimum-previous-tests 1 50 1
+"""
+import argparse
+
+import numpy as np
+
+import cpu_health_checks.utilities as utilities
+
+# Number of std_deviations_limit values evaluated at the same time, to bound the memory used
+LIMITS_CHUNK_SIZE = 256
+
+
+def load_history(register_filename):
+    """
+    Loads the values of a speed or latency register in the order they were stored.
+
+    Returns:
+        tuple: The array of values (the speeds or the latencies), True if high values are the
+        outliers (latency registers) or False if low values are (speed registers), and the
+        count, mean and variance of the values rolled into the daily aggregates before them
+        (count 0 if there are none).
+    """
+    with open(register_filename, 'r') as f:
+        header = f.readline()
+    high_outliers = 'Latency' in header
+    # The speed registers store the speed in column 5 and the latency registers the latency in
+    # column 4, the same columns read by the checks
+    rows = np.loadtxt(register_filename, usecols=[0, 1, 2, 4 if high_outliers else 5],
+                      skiprows=1, ndmin=2)
+    daily = utilities.read_daily_register(register_filename)
+    prior = (0, 0.0, 0.0)
+    if daily.size:
+        # Raw rows of days already aggregated were kept by an interrupted compaction
+        rows = rows[utilities.register_dates(rows) > utilities.register_dates(daily).max()]
+        mean, std = utilities.combine_group_statistics(daily[:, 3], daily[:, 4], daily[:, 7])
+        prior = (int(daily[:, 3].sum()), mean, std**2)
+    return rows[:, 3], high_outliers, prior
+
+
+def prior_statistics(values, prior=(0, 0.0, 0.0)):
+    """
+    Computes the mean and standard deviation of the values stored before every value.
+
+    Args:
+        values (np.ndarray): History of the values in the order they were stored.\n
+        prior (tuple): Count, mean and variance of the values stored before the history (e.g.
+        the daily aggregates returned by load_history).\n
+
+    Returns:
+        tuple: Arrays with the number of prior values (the index of every value plus the prior
+        count), and their mean and standard deviation (NaN when there are no prior values).
+    """
+    prior_count, prior_mean, prior_variance = prior
+    # The values are shifted by the first one to avoid losing precision in the sums of squares
+    shift = values[0] if values.size else 0.0
+    shifted = values - shift
+    counts = prior_count + np.arange(values.size)
+    sums = prior_count * (prior_mean - shift) + np.concatenate([[0], np.cumsum(shifted)[:-1]])
+    squares = (prior_count * (prior_variance + (prior_mean - shift)**2)
+               + np.concatenate([[0], np.cumsum(shifted**2)[:-1]]))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        variances = np.maximum(squares / counts - means**2, 0)
+    return counts, means + shift, np.sqrt(variances)
+
+
+def backtest_outlier_rule(values, std_deviations_limits, minimum_previous_tests,
+                          high_outliers=False, prior=(0, 0.0, 0.0)):
+    """
+    Counts how many values of the history each combination of parameters flags as outliers.
+
+    Args:
+        values (np.ndarray): History of the values in the order they were stored.\n
+        std_deviations_limits (list): Values of std_deviations_limit to evaluate.\n
+        minimum_previous_tests (list): Values of minimum_previous_tests to evaluate.\n
+        high_outliers (bool): True if high values are the outliers (latencies) and False if low
+        values are (speeds).\n
+        prior (tuple): Count, mean and variance of the values stored before the history, which
+        are not evaluated.\n
+
+    Returns:
+        tuple: Arrays with one row per std_deviations_limit and one column per
+        minimum_previous_tests with the number of values flagged as outliers and the number of
+        values evaluated (those with enough prior values).
+    """
+    limits = np.asarray(std_deviations_limits, dtype=float)
+    minimums = np.asarray(minimum_previous_tests, dtype=int)
+    counts, means, stds = prior_statistics(values, prior)
+    # A value is only evaluated when it has at least minimum_previous_tests prior values, and
+    # the value i has exactly prior count + i prior values, so the flags counted are those from
+    # index minimum - prior count
+    start_indexes = np.clip(minimums - prior[0], 0, values.size)
+    evaluated = values.size - start_indexes
+
+    flagged = np.zeros((limits.size, minimums.size), dtype=int)
+    for start in range(0, limits.size, LIMITS_CHUNK_SIZE):
+        chunk = limits[start:start + LIMITS_CHUNK_SIZE]
+        flags = utilities.is_statistical_outlier(values[None, :], means[None, :],
+                                                 stds[None, :], chunk[:, None], high_outliers)
+        # Number of flags from every index to the end of the history
+        flags_from = np.concatenate([np.cumsum(flags[:, ::-1], axis=1)[:, ::-1],
+                                     np.zeros((chunk.size, 1), dtype=int)], axis=1)
+        flagged[start:start + chunk.size] = flags_from[:, start_indexes]
+    return flagged, np.broadcast_to(evaluated, flagged.shape)
+
+
+def parameter_range(values, integer=False):
+    """Returns the values given in the command line, or the range if they are start stop step."""
+    if len(values) == 3:
+        start, stop, step = values
+        grid = np.arange(start, stop + step / 2, step)
+        return grid.round().astype(int) if integer else grid
+    return np.asarray(values, dtype=int if integer else float)
+
+
+def main():
+    """Prints how often every combination of parameters would have flagged an outlier."""
+    parser = argparse.ArgumentParser(description='Backtest the outlier rule of the speed and '
+                                                 'latency checks over a stored register')
+    parser.add_argument('--register', required=True, help='Speed or latency register file')
+    parser.add_argument('--std-deviations-limit', nargs='+', type=float, default=[2],
+                        help='Values to evaluate, or start stop step of a range')
+    parser.add_argument('--minimum-previous-tests', nargs='+', type=float, default=[3],
+                        help='Values to evaluate, or start stop step of a range')
+    args = parser.parse_args()
+
+    values, high_outliers, prior = load_history(args.register)
+    limits = parameter_range(args.std_deviations_limit)
+    minimums = parameter_range(args.minimum_previous_tests, integer=True)
+    flagged, evaluated = backtest_outlier_rule(values, limits, minimums, high_outliers, prior)
+
+    print(f'{args.register}: {values.size} values after {prior[0]} in daily aggregates, '
+          f'{limits.size * minimums.size} combinations')
+    print(f'{"std_deviations_limit":>20} {"minimum_previous_tests":>22} {"flagged":>8} '
+          f'{"evaluated":>9} {"rate":>7}')
+    for limit_index, limit in enumerate(limits):
+        for minimum_index, minimum in enumerate(minimums):
+            count = flagged[limit_index, minimum_index]
+            total = evaluated[limit_index, minimum_index]
+            rate = f'{100 * count / total:6.2f}%' if total else '      -'
+            print(f'{limit:20.2f} {minimum:22} {count:8} {total:9} {rate}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Felipe Santana Rojas
+# Date: 2023-06-07
+# Filename: cache.py
+# License: MIT License
+"""
+Result cache shared by all the processes running checks on the same computer.
+
+The results are stored in a small SQLite database in the logs folder, keyed by the check name
+and the parameters that affect its result, so different callers (cron jobs, CI pre-flights,
+agents) can reuse a fresh result instead of measuring again. When a result has expired, a lease
+stored in the same database makes sure that only one process at a time measures it again while
+the others wait for the new result. The database also keeps the average time every check takes,
+used to order the checks by cost in the pre-flight mode.
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+
+class CachedResult:
+    """
+    Result of a check stored in the cache.
+
+    Attributes:
+        status (str): Status of the check when it was measured ('passed' or 'failed').\n
+        timestamp (float): Time (as returned by time.time()) when it was measured.\n
+    """
+
+    def __init__(self, status, timestamp):
+        self.status = status
+        self.timestamp = timestamp
+
+    @property
+    def age(self):
+        """Seconds since the result was measured."""
+        return time.time() - self.timestamp
+
+
+class ResultCache:
+    """
+    SQLite-backed store of check results with expiration and measurement leases.
+
+    Args:
+        filename (str): Path of the SQLite database. It is created if it doesn't exist.\n
+        poll_interval (float): Seconds between checks while waiting for another process to
+        finish measuring a result.\n
+    """
+
+    def __init__(self, filename, poll_interval=0.5):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        # Identifies the leases taken by this cache so it only releases its own
+        self.owner = f'{os.getpid()}-{id(self)}'
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, '
+                               'status TEXT, timestamp REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, '
+                               'owner TEXT, expires REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS durations (name TEXT PRIMARY KEY, '
+                               'seconds REAL)')
+
+    def connect(self):
+        """Returns a new connection to the database (connections are not shared by threads)."""
+        return sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def make_key(name, params):
+        """Returns the cache key of a check given its name and the parameters it depends on."""
+        return name + '|' + json.dumps(params, sort_keys=True)
+
+    def get(self, key, ttl):
+        """Returns the CachedResult of the key if it is younger than ttl seconds, or None."""
+        with contextlib.closing(self.connect()) as connection:
+            row = connection.execute('SELECT status, timestamp FROM results WHERE key = ?',
+                                     (key,)).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        return CachedResult(*row)
+
+    def put(self, key, status):
+        """Stores the status of the key measured now."""
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                               (key, status, time.time()))
+
+    def acquire(self, key, lease_time):
+        """
+        Tries to take the lease to measure the key during lease_time seconds.
+
+        Returns:
+            bool: True if the lease was taken, False if another process holds a valid lease.
+        """
+        connection = self.connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock so checking and taking the lease is atomic
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT expires FROM leases WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is not None and row[0] > time.time():
+                connection.execute('ROLLBACK')
+                return False
+            connection.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                               (key, self.owner, time.time() + lease_time))
+            connection.execute('COMMIT')
+            return True
+        finally:
+            connection.close()
+
+    def release(self, key):
+        """
+        Releases the lease of the key if it is still held by this cache, so a lease that
+        expired and was taken by another process is not released.
+        """
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute('DELETE FROM leases WHERE key = ? AND owner = ?',
+                               (key, self.owner))
+
+    def record_duration(self, name, seconds, weight=0.3):
+        """
+        Updates the moving average of the seconds the check with the given name takes.
+
+        The new value has the given weight in the average so it follows changes in the cost of
+        the check without being dominated by a single slow run.
+        """
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT seconds FROM durations WHERE name = ?',
+                                     (name,)).fetchone()
+            if row is not None:
+                seconds = (1 - weight) * row[0] + weight * seconds
+            connection.execute('INSERT OR REPLACE INTO durations VALUES (?, ?)',
+                               (name, seconds))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def get_durations(self):
+        """Returns a dictionary with the average seconds taken by every check measured."""
+        with contextlib.closing(self.connect()) as connection:
+            return dict(connection.execute('SELECT name, seconds FROM durations').fetchall())
+
+    def get_or_measure(self, key, ttl, measure, lease_time):
+        """
+        Returns the fresh cached status of the key or measures it if there isn't one.
+
+        If another process is measuring the same key, it waits until that process stores the
+        new result (or its lease expires) instead of measuring it at the same time.
+
+        Args:
+            key (str): The cache key of the check.\n
+            ttl (float): Seconds a result is considered fresh.\n
+            measure (function): Function without arguments that measures the check and returns
+            its status ('passed' or 'failed').\n
+            lease_time (float): Maximum number of seconds the measurement is expected to take.\n
+
+        Returns:
+            tuple: The status and the CachedResult used, which is None if it was measured.
+        """
+        while True:
+            cached_result = self.get(key, ttl)
+            if cached_result is not None:
+                return cached_result.status, cached_result
+            if self.acquire(key, lease_time):
+                try:
+                    status = measure()
+                    self.put(key, status)
+                    return status, None
+                finally:
+                    self.release(key)
+            time.sleep(self.poll_interval)
@@ -7,15 +7,23 @@
 # License: MIT License
 import datetime
 import inspect
+import json
 import os
 import re
 import shutil
 import socket
+import subprocess
 import sys
+import threading
 import time
 
+import numpy as np
 import psutil
 
+import cpu_health_checks.cache as cache
+import cpu_health_checks.dns_client as dns_client
+import cpu_health_checks.registry as registry
+import cpu_health_checks.snapshot as snapshot
 import cpu_health_checks.utilities as utilities
 
 
@@ -27,9 +35,15 @@ class CPUCheck:
         check_no_pending_reboot(): Returns boolean indicating if the PC has no pending reboots.\n
         check_enough_disk_space(): Returns boolean indicating if there is enough disk space.\n
         check_enough_idle_usage(): Returns boolean indicating if the CPU has enough idle usage.\n
+        check_cpu_thermal_state(): Returns boolean indicating if the CPU is not throttled and
+        not close to its critical temperature.\n
+        check_kernel_resource_headroom(): Returns boolean indicating if there is enough headroom
+        of file descriptors, pids and ephemeral ports.\n
         check_network_available(): Returns boolean indicating if network is available.\n
         check_good_download_speed(): Returns boolean indicating if the download speed is above a
         threshold and is not a low outlier.\n
+        check_good_upload_speed(): Returns boolean indicating if the upload speed is above a
+        threshold and is not a low outlier.\n
         check_fast_latency(): Returns boolean indicating if latency is fast.\n
         check_enough_battery_charge(): Returns boolean indicating if there is enough
         battery charge left.\n
@@ -37,12 +51,28 @@ class CPUCheck:
     """
 
     def __init__(self, config_file='../../config/configuration.yml', config_mode='default',
-                 logs_folder=None, min_gb=None, min_percent_disk=None, folders_to_print=None,
-                 max_cpu_usage=None, website_to_check=None, max_connection_attempts=None,
+                 logs_folder=None, reboot_scan_filename=None, reboot_scan_time_budget=None,
+                 reboot_scan_max_workers=None, min_gb=None, min_percent_disk=None,
+                 folders_to_print=None, folders_time_budget=None, folders_max_workers=None,
+                 folders_drill_down_depth=None, max_cpu_usage=None, max_throttled_percent=None,
+                 max_memory_percent=None, top_processes=None, min_frequency_percent=None,
+                 critical_temperature_margin=None, throttle_window=None,
+                 min_fd_headroom_percent=None, min_pid_headroom_percent=None,
+                 min_port_headroom_percent=None, website_to_check=None, dns_names_to_check=None,
+                 dns_resolvers=None, dns_queries_per_name=None, dns_max_resolution_ms=None,
+                 dns_max_failure_percent=None, max_connection_attempts=None,
                  file_sizes_to_download=None, block_size=None, sleep_time=None,
-                 speed_log_filename=None, minimum_previous_tests=None, std_deviations_limit=None,
-                 speed_min_mbps=None, minimum_download_time=None, latency_url=None,
-                 latency_limit_ms=None, min_percent_battery=None, min_remaining_time_mins=None):
+                 speed_log_filename=None, register_retention_days=None,
+                 minimum_previous_tests=None, std_deviations_limit=None, speed_min_mbps=None,
+                 minimum_download_time=None, passive_window=None, passive_interval=None,
+                 max_interface_error_percent=None, upload_url=None, upload_speed_log_filename=None,
+                 latency_url=None, latency_limit_ms=None, latency_log_filename=None,
+                 min_percent_battery=None, min_remaining_time_mins=None,
+                 battery_history_filename=None, max_parallel_checks=None, cache_filename=None,
+                 snapshot_filename=None, cache_ttls=None, network_timeout=None,
+                 check_timeouts=None, run_time_budget=None, preflight_mode=None,
+                 preflight_budget=None, low_impact_mode=None, low_impact_max_load=None,
+                 low_impact_max_transfer_mb=None, low_impact_scan_budget=None):
         """
         **CPUCheck object __init__ constructor:**
 
@@ -62,11 +92,57 @@ class CPUCheck:
             logs_folder (str): Path to the folder where logs are stored. The general log filename
             is based on major system properties to facilitate comparison of results across
             platforms/computers.\n
+            reboot_scan_filename (str): Name of the file in the logs folder where the shared
+            libraries used by every process are stored, so the next scans only read the
+            processes started since.\n
+            reboot_scan_time_budget (float): Maximum number of seconds used to find the
+            processes using deleted libraries.\n
+            reboot_scan_max_workers (int): Number of processes read at the same time when
+            looking for deleted libraries.\n
             min_gb (float): Minimum required free disk space in GB.\n
             min_percent_disk (float): Minimum required free disk space as a percentage.\n
             folders_to_print (int): Number of largest subfolders to print.\n
-            max_cpu_usage (float): Maximum allowed CPU usage percentage.\n
+            folders_time_budget (float): Maximum number of seconds used to find the largest
+            subfolders (and to measure the home folder size). If the budget runs out the
+            partial results found so far are printed and clearly marked as partial.\n
+            folders_max_workers (int): Number of subfolders sized at the same time.\n
+            folders_drill_down_depth (int): Number of times the largest subfolder analysis
+            recurses into the largest subfolder found, to point more precisely where the space
+            is being used.\n
+            max_cpu_usage (float): Maximum allowed CPU usage percentage. When running inside a
+            cgroup with a CPU quota (e.g. a container) it is relative to the quota.\n
+            max_throttled_percent (float): Maximum percentage of the cgroup scheduling periods in
+            which the process cgroup was throttled by its CPU quota.\n
+            max_memory_percent (float): Maximum memory usage of the process cgroup as a
+            percentage of its memory limit.\n
+            top_processes (int): Number of processes using most CPU and memory reported when
+            check_enough_idle_usage fails. If it is 0 no report is made.\n
+            min_frequency_percent (float): Minimum frequency every CPU core is allowed to run
+            at, as a percentage of its maximum frequency. Lower limits mean the core is being
+            throttled because of heat or power.\n
+            critical_temperature_margin (float): Minimum number of degrees Celsius every
+            temperature sensor has to be below its critical temperature.\n
+            throttle_window (float): Seconds during which the hardware throttle counters of
+            the cores (x86 only) are sampled, the check fails if any of them increases.\n
+            min_fd_headroom_percent (float): Minimum percentage of the system file descriptors
+            limit (fs.file-max) that has to be free.\n
+            min_pid_headroom_percent (float): Minimum percentage of the pids limit (the lowest
+            of kernel.pid_max and kernel.threads-max) that has to be free.\n
+            min_port_headroom_percent (float): Minimum percentage of the ephemeral ports range
+            (net.ipv4.ip_local_port_range) that has to be free.\n
             website_to_check (str): Website URL to check network connectivity.\n
+            dns_names_to_check (list): Names resolved to check the DNS health. If it is empty
+            website_to_check is used.\n
+            dns_resolvers (list): Resolvers queried directly (bypassing the local cache) as
+            'address', 'address:port' or '[IPv6 address]:port'. If it is empty the resolvers of
+            /etc/resolv.conf are used (or the upstream resolvers of systemd-resolved if it only
+            has its local stub), and if there are none the system resolver is used.\n
+            dns_queries_per_name (int): Number of times every name is resolved with every
+            resolver.\n
+            dns_max_resolution_ms (float): Maximum median resolution time of a healthy resolver
+            in milliseconds. The check passes if at least one resolver is healthy.\n
+            dns_max_failure_percent (float): Maximum percentage of failed resolutions of a
+            healthy resolver.\n
             max_connection_attempts (int): Number of times to attempt connection
             before giving up.\n
             file_sizes_to_download (list): List of file sizes to download for testing.
@@ -77,8 +153,13 @@ class CPUCheck:
             sleep_time (float): Sleep time between download requests used to avoid overloading the
             server.\n
             speed_log_filename (str): Name of the download speed log file.\n
-            minimum_previous_tests (int): Minimum number of previous download tests to perform
-            comparison between current and previous values obtained.\n
+            register_retention_days (int): Number of days the rows of the download and upload
+            speed registers are kept. Older rows are rolled into daily aggregates (stored in the
+            register name ending in '_daily.txt') that are still used to compare the speeds and
+            by analytics.py and backtest.py, and duplicated rows are dropped. If it is 0 all the
+            rows are kept.\n
+            minimum_previous_tests (int): Minimum number of previous download (or latency) tests
+            to perform comparison between current and previous values obtained.\n
             std_deviations_limit (float): Standard deviations limit
             for comparing download speeds.\n
             check_good_download_speed will not pass if the current download speed is less than
@@ -91,10 +172,79 @@ class CPUCheck:
             take too long. If the download time of a file is more than 'minimum_download_time',
             the final file used to measure the download speed will be the next file in terms of
             size, which is usually 10 times bigger.\n
+            passive_window (float): Seconds during which check_good_download_speed observes
+            passively the traffic of the network interfaces before downloading any file. If
+            the observed traffic already reached 'speed_min_mbps', or the interfaces show too
+            many errors, the check is decided without downloading. Use 0 to always download.\n
+            passive_interval (float): Seconds between samples of the interface counters.\n
+            max_interface_error_percent (float): Maximum percentage of packets with errors or
+            dropped in any network interface for the passive download check to pass. It is
+            only applied to interfaces with at least 1000 packets in the passive window.\n
+            upload_url (str): HTTP endpoint receiving the data streamed by
+            check_good_upload_speed (e.g. 'http://127.0.0.1:8080/' when running the sink server
+            of the sink_server module locally). If it is an empty string the upload check is
+            skipped by main(). The upload check uses the same 'file_sizes_to_download',
+            'block_size', 'max_connection_attempts', 'sleep_time', 'minimum_download_time',
+            'minimum_previous_tests', 'std_deviations_limit' and 'speed_min_mbps' parameters as
+            the download check.\n
+            upload_speed_log_filename (str): Name of the upload speed log file.\n
             latency_url (str): URL to be used for latency check.\n
             latency_limit_ms (float): High limit in milliseconds for the latency check to pass.\n
+            latency_log_filename (str): Name of the latency register file. check_fast_latency
+            will not pass either if the current latency is more than the average latency plus
+            'std_deviations_limit' times its standard deviation, once there are
+            'minimum_previous_tests' previous values.\n
             min_percent_battery (float): Minimum battery charge as a percentage.\n
             min_remaining_time_mins (float): Minimum remaining battery charge in minutes.\n
+            battery_history_filename (str): Name of the file in the logs folder where the
+            battery samples and the charge rate estimate of every power state are stored.\n
+            max_parallel_checks (int): Maximum number of independent checks that main() runs
+            at the same time. Use 1 to run them one after the other, which avoids checks
+            disturbing each other's measurements (e.g. CPU usage measured during a download).\n
+            cache_filename (str): Name of the SQLite database in the logs folder where main()
+            shares the results of the cacheable checks with other processes of the computer.\n
+            snapshot_filename (str): Name of the binary file in the logs folder where main()
+            stores the status, main value, duration and time of every check at the end of each
+            run, to be read by other processes with cpu_health_checks.read_snapshot.\n
+            cache_ttls (dict): Seconds the cached result of each cacheable check
+            (check_enough_disk_space, check_good_download_speed and check_good_upload_speed) is
+            reused by main() instead of running the check again. Checks that are not in the
+            dictionary, or have 0 seconds, are always run.\n
+            network_timeout (float): Maximum number of seconds a network operation (connecting,
+            reading or sending a block of data, or a ping) can block before it is considered
+            failed.\n
+            check_timeouts (dict): Maximum number of seconds main() lets each check run before
+            reporting it as timed out and moving on, overriding the default timeout of the
+            check (e.g. {'check_good_download_speed': 300}).\n
+            run_time_budget (float): Maximum number of seconds for running all the checks in
+            main(). The checks still running or not started when it is exhausted are reported
+            as timed out. Use 0 for no limit.\n
+            preflight_mode (bool): Whether main() runs as a fast-fail pre-flight gate. In this
+            mode the checks run one at a time from the fastest to the slowest according to the
+            time they took in previous runs, main() stops at the first check that doesn't pass,
+            and the checks expected to exceed the time left of 'preflight_budget' use their
+            fresh cached result if there is one or are skipped.\n
+            preflight_budget (float): Maximum number of seconds for running all the checks in
+            pre-flight mode (it replaces 'run_time_budget' in that mode). Some checks sample
+            for a while (about 1 sec the idle usage and 'throttle_window' the thermal state, 3
+            secs the pings of the latency), so with less than about 10 secs they are always
+            skipped once their durations are known.\n
+            low_impact_mode (bool): Whether main() runs with as little impact on the computer as
+            possible. In this mode main() lowers its CPU and I/O priority, the heavy checks
+            (the download and upload speed checks) are not started while the load per CPU is
+            above 'low_impact_max_load', the speed tests of a run transfer at most
+            'low_impact_max_transfer_mb' between all of them and store their speeds in separate
+            registers (ending in '_low_impact.txt'), and the folder sizes and the pending reboot
+            scans are limited to 'low_impact_scan_budget' seconds with a single worker.\n
+            low_impact_max_load (float): Load average of the last minute per logical CPU above
+            which heavy checks are not started in low impact mode. A fresh cached result is
+            used instead if there is one, otherwise the check is skipped. Use 0 for no limit.\n
+            low_impact_max_transfer_mb (float): Maximum number of MB transferred by all the
+            speed tests of a run in low impact mode, counting every connection attempt allowed
+            by 'max_connection_attempts'. The files of 'file_sizes_to_download' that don't fit
+            are not transferred, and a speed test is skipped if none of them fits.\n
+            low_impact_scan_budget (float): Maximum number of seconds of the folder sizes and
+            pending reboot scans in low impact mode.\n
 
 
         Example configuration file ('config/configuration.yml'):
@@ -105,16 +255,42 @@ class CPUCheck:
               # General
               logs_folder: 'logs/'
 
+              # check_no_pending_reboot
+              reboot_scan_filename: 'reboot_scan.json'
+              reboot_scan_time_budget: 10
+              reboot_scan_max_workers: 4
+
               # check_enough_disk_space
               min_gb: 2
               min_percent_disk: 10
               folders_to_print: 3
+              folders_time_budget: 20
+              folders_max_workers: 4
+              folders_drill_down_depth: 1
 
               # check_enough_idle_usage
               max_cpu_usage: 75
+              max_throttled_percent: 10
+              max_memory_percent: 90
+              top_processes: 5
+
+              # check_cpu_thermal_state
+              min_frequency_percent: 70
+              critical_temperature_margin: 5
+              throttle_window: 1
+
+              # check_kernel_resource_headroom
+              min_fd_headroom_percent: 20
+              min_pid_headroom_percent: 20
+              min_port_headroom_percent: 20
 
               # check_network_available
               website_to_check: 'www.google.com'
+              dns_names_to_check: []
+              dns_resolvers: []
+              dns_queries_per_name: 3
+              dns_max_resolution_ms: 500
+              dns_max_failure_percent: 34
 
               # check_good_download_speed
               max_connection_attempts: 5
@@ -122,18 +298,44 @@ class CPUCheck:
               block_size: 8192
               sleep_time: 1
               speed_log_filename: 'download_speed_register.txt'
+              register_retention_days: 90
               minimum_previous_tests: 3
               std_deviations_limit: 2
               speed_min_mbps: 1
               minimum_download_time: 3
+              passive_window: 0
+              passive_interval: 0.1
+              max_interface_error_percent: 1
+
+              # check_good_upload_speed
+              upload_url: ''
+              upload_speed_log_filename: 'upload_speed_register.txt'
 
               # check_fast_latency
               latency_url: 'www.google.com'
               latency_limit_ms: 100
+              latency_log_filename: 'latency_register.txt'
 
               # check_enough_battery_charge
               min_percent_battery: 10
               min_remaining_time_mins: 15
+              battery_history_filename: 'battery_history.json'
+
+              # main
+              max_parallel_checks: 1
+              cache_filename: 'check_cache.sqlite'
+              snapshot_filename: 'snapshot.bin'
+              cache_ttls: {'check_enough_disk_space': 300, 'check_good_download_speed': 3600,
+                           'check_good_upload_speed': 3600}
+              network_timeout: 30
+              check_timeouts: {}
+              run_time_budget: 0
+              preflight_mode: False
+              preflight_budget: 10
+              low_impact_mode: False
+              low_impact_max_load: 1
+              low_impact_max_transfer_mb: 100
+              low_impact_scan_budget: 5
         """
 
         init_params = inspect.signature(self.__init__).parameters
@@ -161,11 +363,78 @@ class CPUCheck:
         self.logger = utilities.get_configured_logger('my_logger', log_folder_and_name)
         self.logger.info('Input Paramters Used for CPUCheck Object:')
         self.logger.info(input_values)
+        # Cache used by main() to share the results of the cacheable checks between processes
+        self.result_cache = cache.ResultCache(os.path.join(self.logs_folder,
+                                                           self.cache_filename))
+        # Extra data gathered by the checks when they fail (e.g. the processes using most CPU)
+        self.reports = {}
+        # Main value measured by the checks (e.g. the download speed), stored in the snapshot
+        self.values = {}
+        # Last battery read and its time, reused while it is fresh (see get_battery_info)
+        self.battery_read = None
+        # Last CPU thermal state read and its time (see get_cpu_thermal_state)
+        self.thermal_read = None
+        # Last kernel resources read and its time (see get_kernel_resources)
+        self.kernel_resources_read = None
+        # In low impact mode the folder sizes and pending reboot scans are shorter and use a
+        # single worker
+        if self.low_impact_mode:
+            self.folders_time_budget = min(self.folders_time_budget, self.low_impact_scan_budget)
+            self.reboot_scan_time_budget = min(self.reboot_scan_time_budget,
+                                               self.low_impact_scan_budget)
+            self.folders_max_workers = self.reboot_scan_max_workers = 1
+        # MB of the low impact transfer budget taken by the speed tests of this run
+        self.low_impact_transferred_mb = 0
+        self.low_impact_lock = threading.Lock()
 
     def check_no_pending_reboot(self):
-        """Returns True if the computer has no pending reboots and False if it has"""
-        result = not(os.path.exists('/run/reboot-required'))
-        utilities.print_and_log_result(result, 'No Pending Reboots', 'Pending Reboot(s) Found',
+        """
+        Returns True if the computer has no pending reboots and False if it has.
+
+        Besides the /run/reboot-required flag of Debian-family systems, it compares the running
+        kernel with the newest kernel installed and looks for processes still using shared
+        libraries deleted or replaced by an upgrade. The libraries of every process are stored
+        so the next runs only read the processes started since, and the scan stops when
+        reboot_scan_time_budget runs out.
+        """
+        reasons = []
+        if os.path.exists('/run/reboot-required'):
+            reasons.append('/run/reboot-required exists')
+
+        running_kernel, newest_kernel = utilities.get_kernel_versions()
+        if newest_kernel is not None and newest_kernel != running_kernel:
+            reasons.append(f'running kernel {running_kernel} is older than the installed '
+                           f'kernel {newest_kernel}')
+
+        if os.path.isdir('/proc/self'):
+            scan_filename = os.path.join(self.logs_folder, self.reboot_scan_filename)
+            previous_scan = {}
+            if os.path.isfile(scan_filename):
+                try:
+                    with open(scan_filename, 'r') as f:
+                        previous_scan = json.load(f)
+                except (OSError, ValueError) as e:
+                    # A truncated or unreadable scan only means every process is read again
+                    self.logger.warning(f'Ignoring the previous reboot scan {scan_filename}: {e}')
+            stale, scan, complete = utilities.scan_deleted_libraries(
+                previous_scan, self.reboot_scan_time_budget, self.reboot_scan_max_workers)
+            if not registry.is_cancelled():  # A check that timed out doesn't write files
+                utilities.write_file_atomically(scan_filename, json.dumps(scan))
+
+            if stale:
+                reasons.append(f'{len(stale)} process(es) use deleted or replaced libraries')
+                for pid in sorted(stale, key=int)[:10]:
+                    utilities.print_error(f'    Process {pid} uses {", ".join(stale[pid])}')
+                    self.logger.info(f'Process {pid} uses {", ".join(stale[pid])}')
+            if not complete:
+                partial_message = (f'Partial results: the deleted libraries scan ran out of its '
+                                   f'{self.reboot_scan_time_budget} secs time budget')
+                utilities.print_warning(partial_message)
+                self.logger.info(partial_message)
+
+        result = not reasons
+        utilities.print_and_log_result(result, 'No Pending Reboots',
+                                       'Pending Reboot(s) Found: ' + ', '.join(reasons),
                                        self.logger)
         return result
 
@@ -182,57 +451,228 @@ class CPUCheck:
         du = shutil.disk_usage('/')
         percent_free = 100 * du.free / du.total
         gigabytes_free = du.free / 2**30
-        # Here we calculate the size of home
+        self.values['check_enough_disk_space'] = percent_free
+        # Here we calculate the size of home, bounded by the time budget so it cannot hang
         home = os.path.expanduser("~")
-        home_usage = utilities.get_folder_size(home)
+        try:
+            home_usage = utilities.get_folder_size(home, timeout=self.folders_time_budget)
+            home_message = f'Home folder is {home_usage:.2f} Gb'
+        except subprocess.TimeoutExpired:
+            home_message = (f'Home folder size could not be measured in '
+                            f'{self.folders_time_budget} secs')
 
         main_message = (f'{gigabytes_free:.1f} Gb free ({percent_free:.2f}%) out of a total '
-                        f'of {du.total/2**30:.1f} Gb. Home folder is {home_usage:.2f} Gb')
+                        f'of {du.total/2**30:.1f} Gb. {home_message}')
         enough_gb_avail = gigabytes_free >= self.min_gb
         enough_frac_avail = percent_free >= self.min_percent_disk
         result = enough_gb_avail and enough_frac_avail
 
-        if not(result):
+        if not result:
             utilities.print_error('Disk too close to full', self.logger)
 
-            # Here we calculate the largest subfolders to print as indicator on how to clear space
-            subfolders_sizes = utilities.get_home_subfolder_info()
-            largest_subfolders = utilities.get_largest_subfolders(self.folders_to_print,
-                                                                  subfolders_sizes)
+            # Here we find the largest subfolders to print as indicator on how to clear space
+            # stopping when the time budget runs out so a full disk doesn't hang the check
+            largest_subfolders, complete = utilities.get_largest_subfolders_bounded(
+                home, self.folders_to_print, self.folders_time_budget, self.folders_max_workers,
+                self.folders_drill_down_depth)
             utilities.print_error('To give a hint on where to clear space, the largest home'
                                   ' subfolders are:')
-            for subfolder in largest_subfolders:
-                utilities.print_error(f'    {subfolder[0]} is {subfolder[1]:.2f} Gb')
+            for subfolder, size, depth in largest_subfolders:
+                utilities.print_error(f'{"    " * (depth + 1)}{subfolder} is {size:.2f} Gb')
+            if not complete:
+                partial_message = (f'Partial results: the subfolder analysis ran out of its '
+                                   f'{self.folders_time_budget} secs time budget')
+                utilities.print_warning(partial_message)
+                self.logger.info(partial_message)
 
         utilities.print_and_log_result(result, main_message, main_message, self.logger)
 
         return result
 
     def check_enough_idle_usage(self):
-        """Returns True if the CPU has enough idle usage."""
+        """
+        Returns True if the CPU has enough idle usage.
+
+        If the process runs inside a cgroup (e.g. a container) with CPU or memory limits, the
+        usage is measured relative to those limits instead of the whole host, and being
+        throttled by the CPU quota or being close to the memory limit also fails the check.
+
+        When it fails, the top_processes processes using most CPU and memory are printed,
+        logged and stored in self.reports['check_enough_idle_usage'] as the dict
+        {'top_cpu': [...], 'top_rss': [...]} returned by utilities.get_top_processes.
+        """
+        self.reports.pop('check_enough_idle_usage', None)
+        cgroup = utilities.find_cgroup()
+        cgroup_before = utilities.read_cgroup_stats(cgroup) if cgroup is not None else None
+        start_time = time.time()
         cpu_usage = psutil.cpu_percent(1)
+        elapsed = time.time() - start_time
         if cpu_usage == 0:
             cpu_usage = 0.01  # Just to avoid edge problems in tests
+        self.values['check_enough_idle_usage'] = cpu_usage
         main_message = f'CPU usage is {cpu_usage:.2f}%'
-        result = cpu_usage <= self.max_cpu_usage
+
+        if cgroup is None:
+            result = cpu_usage <= self.max_cpu_usage
+        else:
+            cgroup_after = utilities.read_cgroup_stats(cgroup)
+            result, cgroup_messages = utilities.evaluate_cgroup_usage(
+                cgroup_before, cgroup_after, elapsed, self.max_cpu_usage,
+                self.max_throttled_percent, self.max_memory_percent)
+            if cgroup_after['cpu_quota'] is None:
+                result = result and cpu_usage <= self.max_cpu_usage
+            main_message = ', '.join([main_message] + cgroup_messages)
         utilities.print_and_log_result(result, main_message, main_message, self.logger)
+
+        if not result and self.top_processes > 0:
+            top_cpu, top_rss = utilities.get_top_processes(self.top_processes)
+            self.reports['check_enough_idle_usage'] = {'top_cpu': top_cpu, 'top_rss': top_rss}
+            for line in utilities.format_top_processes(top_cpu, top_rss):
+                utilities.print_error(line)
+                self.logger.info(line)
+        return result
+
+    def check_cpu_thermal_state(self):
+        """
+        Returns True if the CPU is not throttling because of heat or power limits.
+
+        A CPU can have plenty of idle time and still be slow, so it fails if the hardware
+        throttled any core during a window of throttle_window seconds (x86 only), or if the
+        maximum frequency allowed for any core is below min_frequency_percent of its maximum
+        when the throttle counters are not available, or if any temperature sensor is within
+        critical_temperature_margin degrees of its critical temperature.
+        """
+        state = self.get_cpu_thermal_state()
+        throttle_counts = None
+        if state['throttle_counts']:
+            # The counters only grow, so they are read again at the end of the window
+            time.sleep(max(0, self.thermal_read[0] + self.throttle_window - time.time()))
+            throttle_counts = utilities.read_throttle_counts()
+        result, messages = utilities.evaluate_cpu_thermal_state(
+            state, self.min_frequency_percent, self.critical_temperature_margin,
+            throttle_counts)
+        for message in messages:
+            utilities.print_error(message)
+            self.logger.info(message)
+        hottest = max(state['sensors'], key=lambda sensor: sensor['current'], default=None)
+        main_message = f'{len(state["cores"])} CPU cores checked'
+        self.values['check_cpu_thermal_state'] = hottest['current'] if hottest else None
+        if hottest is not None:
+            main_message += (f', the hottest sensor is {hottest["label"]} at '
+                             f'{hottest["current"]:.1f} C')
+        utilities.print_and_log_result(result, main_message, main_message, self.logger)
+        return result
+
+    def check_kernel_resource_headroom(self):
+        """
+        Returns True if there is enough headroom of file descriptors, pids and ephemeral ports.
+
+        Running out of any of them makes new files, processes or connections fail even when the
+        CPU and the disk are fine. The usage of every resource is read from a few /proc files
+        without enumerating the processes, and the check fails if the free percentage of any of
+        them is below its min_*_headroom_percent threshold. The ephemeral ports used are an upper
+        bound, since the sockets of listening servers and of fixed ports are counted too.
+        """
+        thresholds = {'file_descriptors': self.min_fd_headroom_percent,
+                      'pids': self.min_pid_headroom_percent,
+                      'ephemeral_ports': self.min_port_headroom_percent}
+        result = True
+        headrooms = []
+        for resource, (used, limit) in self.get_kernel_resources().items():
+            headroom = 100 - 100 * used / limit
+            headrooms.append(headroom)
+            # sockstat counts every socket holding a port, not only those of the ephemeral range
+            bound = ' at most' if resource == 'ephemeral_ports' else ''
+            message = (f'{resource.replace("_", " ").capitalize()}:{bound} {used} used out of '
+                       f'{limit} ({headroom:.1f}% free)')
+            resource_result = headroom >= thresholds[resource]
+            if not resource_result:
+                message += f', below the minimum of {thresholds[resource]}% free'
+            utilities.print_and_log_result(resource_result, message, message, self.logger)
+            result = result and resource_result
+        self.values['check_kernel_resource_headroom'] = min(headrooms, default=None)
         return result
 
     def check_network_available(self):
-        """Return True if it suceeds to resolve the given URL, and False otherwise."""
-        result = False
-        try:
-            socket.gethostbyname(self.website_to_check)
-            message_passed = 'There is internet connection'
-            message_failed = ''
-            result = True
-        except socket.gaierror:
-            message_failed = 'Failed to resolve URL.'
-        except socket.timeout:
-            message_failed = 'Connection timed out.'
-        except Exception:
-            message_failed = 'Network check failed due to an unknown error.'
-        utilities.print_and_log_result(result, message_passed, message_failed, self.logger)
+        """
+        Returns True if the DNS resolution works and is fast, and False otherwise.
+
+        Every name of dns_names_to_check is resolved dns_queries_per_name times against every
+        resolver concurrently, querying them directly so the answers don't come from the local
+        cache. The median and 95th percentile resolution times and the failure rate of every
+        resolver are reported, and the check passes if at least one resolver is within
+        dns_max_resolution_ms and dns_max_failure_percent, warning about the others since the
+        system falls back to the healthy ones. If /etc/resolv.conf only has a local stub (e.g.
+        systemd-resolved) its upstream resolvers are queried when they are known. If no resolver
+        is known (e.g. there is no /etc/resolv.conf) the names are resolved through the system
+        resolver instead.
+        """
+        names = self.dns_names_to_check or [self.website_to_check]
+        resolvers = self.dns_resolvers or dns_client.get_system_resolvers()
+        if not resolvers:
+            return self.check_system_resolution(names)
+        if not self.dns_resolvers and all(dns_client.is_loopback(resolver)
+                                          for resolver in resolvers):
+            message = (f'Only the local stub resolver {", ".join(resolvers)} is available, its '
+                       f'answers may come from its cache instead of the upstream resolvers')
+            utilities.print_warning(message)
+            self.logger.info(message)
+
+        # DNS answers take milliseconds, so the timeout is capped to not wait for dead resolvers
+        results = dns_client.measure_resolvers(resolvers, names, self.dns_queries_per_name,
+                                               min(self.network_timeout, 5))
+        medians = {}
+        failed = {}
+        for resolver, resolver_results in results.items():
+            latencies = resolver_results['latencies_ms']
+            failure_percent = 100 * resolver_results['failures'] / resolver_results['queries']
+            message = f'Resolver {resolver}: {failure_percent:.0f}% of the resolutions failed'
+            resolver_result = failure_percent <= self.dns_max_failure_percent
+            if latencies:
+                median, p95 = np.percentile(latencies, [50, 95])
+                medians[resolver] = median
+                message += f', median time {median:.1f} ms, 95th percentile {p95:.1f} ms'
+                resolver_result = resolver_result and median <= self.dns_max_resolution_ms
+            else:
+                resolver_result = False
+            if resolver_result:
+                utilities.print_and_log_result(True, message, message, self.logger)
+            else:
+                failed[resolver] = message
+        result = len(failed) < len(results)
+        for message in failed.values():
+            if result:
+                utilities.print_warning(message)
+                self.logger.info(message)
+            else:
+                utilities.print_and_log_result(False, message, message, self.logger)
+        # The value stored is the median resolution time of the slowest healthy resolver, or of
+        # the slowest resolver if none is healthy
+        healthy = [median for resolver, median in medians.items() if resolver not in failed]
+        self.values['check_network_available'] = max(healthy or medians.values(), default=None)
+
+        utilities.print_and_log_result(result, 'There is internet connection',
+                                       'DNS resolution failed or is too slow', self.logger)
+        return result
+
+    def check_system_resolution(self, names):
+        """Returns True if all the names are resolved by the system resolver."""
+        result = True
+        message_failed = ''
+        for name in names:
+            try:
+                socket.gethostbyname(name)
+            except socket.gaierror:
+                message_failed = f'Failed to resolve {name}.'
+            except socket.timeout:
+                message_failed = 'Connection timed out.'
+            except Exception:
+                message_failed = 'Network check failed due to an unknown error.'
+            if message_failed:
+                result = False
+                break
+        utilities.print_and_log_result(result, 'There is internet connection', message_failed,
+                                       self.logger)
         return result
 
     def check_good_download_speed(self):
@@ -246,6 +686,11 @@ class CPUCheck:
         a low outlier compared to previous results, the method returns True, if not it
         results False.
 
+        If 'passive_window' is larger than 0, the traffic of the network interfaces is first
+        observed passively during that time, and the files are only downloaded if that data is
+        inconclusive (see utilities.evaluate_passive_throughput), saving bandwidth and not
+        competing with the traffic of the computer.
+
         Returns:
             bool: True if the download speed test suceeds, False otherwise.
 
@@ -254,57 +699,178 @@ class CPUCheck:
 
         """
 
+        if self.passive_window > 0:
+            interfaces_info = utilities.sample_interface_counters(self.passive_window,
+                                                                  self.passive_interval)
+            result, message = utilities.evaluate_passive_throughput(
+                interfaces_info, self.speed_min_mbps, self.max_interface_error_percent)
+            if result is not None:
+                utilities.print_and_log_result(result, message, message, self.logger)
+                return result
+            self.logger.info(message)
+
+        def download(size, track_progress):
+            # This function does a null download, splitting the file into blocks, performing
+            # multiple attempts, and displaying a progress bar if it is the definitive test
+            url = 'http://speedtest.tele2.net/' + size + '.zip'
+            return utilities.downloads_file(url, self.block_size, self.max_connection_attempts,
+                                            self.logger, track_progress, self.network_timeout)
+
+        return self.run_speed_test(download, 'Download', self.speed_log_filename)
+
+    def check_good_upload_speed(self):
+        """
+        Perform upload speed tests and return the result.
+
+        The upload speed test works as the download speed test, but instead of downloading
+        files it streams generated data of increasing sizes to the 'upload_url' HTTP endpoint
+        (for example the sink server in the sink_server module), without holding the payload in
+        memory. If the data is successfully uploaded, the upload speed is above the minimum
+        limit, and the speed is not a low outlier compared to previous uploads, the method
+        returns True, if not it returns False.
+
+        Returns:
+            bool: True if the upload speed test suceeds, False otherwise.
+
+        Raises:
+            AssertionError: If the logs folder is not a directory.
+        """
+
+        def upload(size, track_progress):
+            # This function streams generated data to the endpoint splitting it into blocks,
+            # performing multiple attempts, and displaying a progress bar if it is the
+            # definitive test
+            return utilities.uploads_file(self.upload_url, utilities.get_megas(size) * 2**20,
+                                          self.block_size, self.max_connection_attempts,
+                                          self.logger, track_progress, self.network_timeout)
+
+        return self.run_speed_test(upload, 'Upload', self.upload_speed_log_filename)
+
+    def run_speed_test(self, transfer, test_name, speed_log_filename):
+        """
+        Measures a transfer speed adapting the size of the transfer and returns the result.
+
+        Transfers of increasing size are performed until one of them takes long enough for the
+        measurement to be accurate ('minimum_download_time'), and then the next size is used for
+        the definitive measurement. The definitive speed is checked and stored in the speed
+        register by utilities.handle_final_speed_test.
+
+        In low impact mode only the sizes that fit in what is left of the transfer budget of the
+        run are used (see get_low_impact_transfer_sizes), no progress bar is displayed, and the
+        speed is stored in a separate register, since measurements with smaller files are not
+        comparable with the usual ones.
+
+        Args:
+            transfer (function): Function that receives the size of the transfer (e.g. '10MB')
+            and whether to display a progress bar, performs the transfer, and returns True if it
+            succeeded.\n
+            test_name (str): Name of the transfer used in messages (e.g. 'Download').\n
+            speed_log_filename (str): Name of the speed register file.\n
+
+        Returns:
+            bool: True if the speed test suceeds, False otherwise.
+
+        Raises:
+            AssertionError: If the logs folder is not a directory.
+        """
+
         assert os.path.isdir(self.logs_folder), \
             f'To run this test you have to create folder {self.logs_folder} first with ' \
             f'mkdir {self.logs_folder} on repo\'s main folder'
 
         sizes = self.file_sizes_to_download
-        # Last test is the one actually used for meassuring the download speed
+        if self.low_impact_mode:
+            # The sizes are taken from the budget at once, so parallel speed tests don't share it
+            with self.low_impact_lock:
+                sizes = self.get_low_impact_transfer_sizes()
+                reserved_mb = self.max_connection_attempts * sum(map(utilities.get_megas, sizes))
+                self.low_impact_transferred_mb += reserved_mb
+            if not sizes:
+                message = (f'{test_name} test not run because the smallest file is larger than '
+                           f'what is left of the {self.low_impact_max_transfer_mb} MB allowed in '
+                           f'low impact mode')
+                utilities.print_error(message)
+                self.logger.error(message)
+                return False
+            speed_log_filename = utilities.get_low_impact_register_filename(speed_log_filename)
+            transferred = []
+
+            def low_impact_transfer(size, track_progress):
+                # The progress bar is not displayed to not use CPU redrawing it
+                transferred.append(size)
+                return transfer(size, False)
+
+            try:
+                return self.measure_transfer_speed(low_impact_transfer, test_name,
+                                                   speed_log_filename, sizes)
+            finally:
+                # The sizes not transferred are given back to the budget
+                transferred_mb = self.max_connection_attempts * sum(map(utilities.get_megas,
+                                                                        transferred))
+                with self.low_impact_lock:
+                    self.low_impact_transferred_mb -= reserved_mb - transferred_mb
+        return self.measure_transfer_speed(transfer, test_name, speed_log_filename, sizes)
+
+    def get_low_impact_transfer_sizes(self):
+        """
+        Returns the sizes of 'file_sizes_to_download' the next speed test can transfer in low
+        impact mode.
+
+        The 'low_impact_max_transfer_mb' are shared by all the speed tests of the run, and every
+        transfer can be attempted 'max_connection_attempts' times, so the sizes are limited to
+        what is left of the budget divided by the number of attempts.
+        """
+        left_mb = self.low_impact_max_transfer_mb - self.low_impact_transferred_mb
+        return utilities.limit_transfer_sizes(self.file_sizes_to_download,
+                                              left_mb / self.max_connection_attempts)
+
+    def measure_transfer_speed(self, transfer, test_name, speed_log_filename, sizes):
+        """Performs the transfers of run_speed_test with the given sizes and returns the result."""
+        # Last test is the one actually used for meassuring the speed
         is_last_test = False
 
-        message1 = 'Testing Download Speed: '
+        message1 = f'Testing {test_name} Speed: '
         message2a = 'Running preliminary quick tests'
         print(message1 + message2a, end='\r', flush=True)
 
-        # We download files of increasing size until we reach one that downloads in enough
+        # We transfer files of increasing size until we reach one that is transferred in enough
         # time for the test to be accurate
         for ind_size in range(len(sizes)):
             size = sizes[ind_size]
-            url = 'http://speedtest.tele2.net/' + size + '.zip'
             start_time = time.time()
-
-            # This function does a null download, splitting the file into blocks, performing
-            # multiple attempts, and displaying a progress bar if it is the definitive test
-            successful_download = utilities.downloads_file(url, self.block_size,
-                                                           self.max_connection_attempts,
-                                                           self.logger, is_last_test)
+            successful_transfer = transfer(size, is_last_test)
             end_time = time.time()
-            if not(successful_download):  # If failed to download the file set the check as failed
+            if not successful_transfer:  # If failed to transfer the file set the check as failed
                 return False
-            download_time = end_time - start_time
+            transfer_time = end_time - start_time
             megas = utilities.get_megas(size)
-            download_speed_mbps = megas / download_time
+            speed_mbps = megas / transfer_time
             time.sleep(self.sleep_time)  # To avoid overloading the server
 
-            # If it is the download used to measure the speed the function below logs the results,
-            # checks if the speed is above the minimum, and if we can, compare it to prior results
-            if is_last_test or download_time > 10 * self.minimum_download_time:
-                main_message = (f'Downloaded at an average speed of {download_speed_mbps:.3f}'
-                                f'Mb/s: {download_time:.2f} secs for a {megas:.1f} Mb file')
-                result = utilities.handle_final_download_test(self.logs_folder,
-                                                              self.speed_log_filename, size,
-                                                              download_time, download_speed_mbps,
-                                                              self.minimum_previous_tests,
-                                                              self.std_deviations_limit,
-                                                              self.speed_min_mbps)
+            # If it is the transfer used to measure the speed the function below logs the
+            # results, checks if the speed is above the minimum, and if we can, compare it to
+            # prior results. If there are no larger sizes left the last one is used.
+            if (is_last_test or transfer_time > 10 * self.minimum_download_time
+                    or ind_size == len(sizes) - 1):
+                if registry.is_cancelled():  # A check that timed out doesn't write registers
+                    return False
+                main_message = (f'{test_name}ed at an average speed of {speed_mbps:.3f}'
+                                f'Mb/s: {transfer_time:.2f} secs for a {megas:.1f} Mb file')
+                result = utilities.handle_final_speed_test(self.logs_folder, speed_log_filename,
+                                                           size, transfer_time, speed_mbps,
+                                                           self.minimum_previous_tests,
+                                                           self.std_deviations_limit,
+                                                           self.speed_min_mbps, test_name,
+                                                           self.register_retention_days)
                 utilities.print_and_log_result(result, main_message, main_message, self.logger)
+                self.values[f'check_good_{test_name.lower()}_speed'] = speed_mbps
                 return result
 
-            # If the download time of a given file is large enough then use the next in size
-            # as the definitive download to measure the speed
-            if download_time > self.minimum_download_time:
+            # If the transfer time of a given file is large enough then use the next in size
+            # as the definitive transfer to measure the speed
+            if transfer_time > self.minimum_download_time:
                 is_last_test = True
-                message2b = (f'Running final download test on {sizes[ind_size+1]}'
+                message2b = (f'Running final {test_name.lower()} test on {sizes[ind_size+1]}'
                              f' size file (automatically discarded)')
                 time.sleep(1.5)  # So that the user can see the message change
                 print(message1 + message2b)
@@ -313,8 +879,9 @@ class CPUCheck:
         """
         Checks if the latency is fast measuring the average value to the given host.
 
-        It also prints a quality flag associated to the latency value according to
-        genelrally acceted benchmarks
+        The check passes if the average latency is below the limit and it is not a high outlier
+        compared to the latency register of the host. It also prints a quality flag associated
+        to the latency value according to genelrally acceted benchmarks
         """
 
         url = self.latency_url  # URL to be used to measure average latency
@@ -324,7 +891,8 @@ class CPUCheck:
 
         # In this block we measure the average latency and catch any potential errors
         try:
-            ping_output = utilities.run_command('ping -c 4 ' + url).stdout
+            ping_output = utilities.run_command('ping -c 4 ' + url,
+                                                timeout=self.network_timeout).stdout
             latency_values = re.findall(r'time=(\d+\.\d+)', ping_output)
             average_latency = sum(float(latency) for latency in latency_values)\
                 / len(latency_values)
@@ -333,6 +901,8 @@ class CPUCheck:
 
         except ZeroDivisionError:
             message_error = f'Failed to ping host {url}'
+        except subprocess.TimeoutExpired:
+            message_error = f'Ping to host {url} didn\'t finish in {self.network_timeout} secs'
         except Exception as e:
             message_error = 'Latency check failed due to an unknown error:' + str(e)
 
@@ -342,16 +912,56 @@ class CPUCheck:
             return False
 
         # If the test didnt find any error checks if the latency was faster than the limit
-        # assigns the quality flag and prints and logs the results
-        result = average_latency < self.latency_limit_ms
+        # and if it is not a high outlier compared to the host's own history, assigns the
+        # quality flag and prints and logs the results
+        if registry.is_cancelled():  # A check that timed out doesn't write registers
+            return False
         main_message = f"Latency to {url} was {average_latency:.2f} ms"
-        latency_quality = quality_limits[max([key for key in quality_limits.keys() if key < 0.1])]
+        self.values['check_fast_latency'] = average_latency
+        latency_quality = quality_limits[max([key for key in quality_limits.keys()
+                                              if key <= average_latency])]
         main_message += (f" which is '{latency_quality}' "
                          f"according to generally accepted benchmarks")
+        not_outlier = utilities.handle_final_latency_test(self.logs_folder,
+                                                          self.latency_log_filename,
+                                                          average_latency,
+                                                          self.minimum_previous_tests,
+                                                          self.std_deviations_limit)
+        result = average_latency < self.latency_limit_ms and not_outlier
         utilities.print_and_log_result(result, main_message, main_message, self.logger)
 
         return result
 
+    def get_cpu_thermal_state(self, max_age=10):
+        """
+        Returns utilities.read_cpu_thermal_state(), reusing the last read if it is younger than
+        max_age seconds so deciding whether to skip the thermal check and running it read sysfs
+        once.
+        """
+        if self.thermal_read is None or time.time() - self.thermal_read[0] > max_age:
+            self.thermal_read = (time.time(), utilities.read_cpu_thermal_state())
+        return self.thermal_read[1]
+
+    def get_kernel_resources(self, max_age=10):
+        """
+        Returns utilities.read_kernel_resources(), reusing the last read if it is younger than
+        max_age seconds so deciding whether to skip the headroom check and running it read /proc
+        once.
+        """
+        if (self.kernel_resources_read is None
+                or time.time() - self.kernel_resources_read[0] > max_age):
+            self.kernel_resources_read = (time.time(), utilities.read_kernel_resources())
+        return self.kernel_resources_read[1]
+
+    def get_battery_info(self, max_age=60):
+        """
+        Returns psutil.sensors_battery(), reusing the last read if it is younger than max_age
+        seconds so deciding whether to skip the battery check and running it read it once.
+        """
+        if self.battery_read is None or time.time() - self.battery_read[0] > max_age:
+            self.battery_read = (time.time(), psutil.sensors_battery())
+        return self.battery_read[1]
+
     def check_enough_battery_charge(self):
         """
         Checks battery level, plugging, and time remaining.
@@ -359,13 +969,26 @@ class CPUCheck:
         Returns True if the battery has enough charge and the remaining time is not too low.
         If not, returns False and checks if the battery is plugged, if it is it recommends to
         check battery health, if it is not, it recommends to plug it.
+
+        Every run stores a battery sample and updates the average charge rate of the current
+        power state (see utilities.handle_battery_sample). Once there are enough previous rates,
+        the remaining time is predicted from the average drain rate instead of the noisy
+        estimate of the operating system, and a drain much faster than usual, a sign of battery
+        wear or runaway processes, fails the check.
         """
 
-        battery_info = psutil.sensors_battery()
+        battery_info = self.get_battery_info()
+        if registry.is_cancelled():  # A check that timed out doesn't write registers
+            return False
         percent_remaining = battery_info.percent
+        self.values['check_enough_battery_charge'] = percent_remaining
         time_remaining = battery_info.secsleft
-        time_remaining_formatted = datetime.timedelta(seconds=time_remaining)
         plugged = battery_info.power_plugged
+        rate_info = utilities.handle_battery_sample(self.logs_folder,
+                                                    self.battery_history_filename,
+                                                    percent_remaining, plugged,
+                                                    self.minimum_previous_tests,
+                                                    self.std_deviations_limit)
         # Initially we only check if the charge fraction is larger than the limit
         result = (percent_remaining >= self.min_percent_battery)
 
@@ -373,17 +996,28 @@ class CPUCheck:
             main_message = (f'The battery is plugged and has {percent_remaining}% of charge')
 
         else:
+            time_source = ''
+            if rate_info['mean_rate'] is not None and rate_info['mean_rate'] < 0:
+                time_remaining = 3600 * percent_remaining / -rate_info['mean_rate']
+                time_source = ' (predicted from the usual drain rate)'
+            time_remaining_formatted = datetime.timedelta(seconds=int(time_remaining))
             main_message = (f'The battery is not plugged, has {percent_remaining}% of charge,'
-                            f' and the remaining time is {time_remaining_formatted}')
+                            f' and the remaining time is {time_remaining_formatted}'
+                            f'{time_source}')
 
             result = result and (time_remaining >= self.min_remaining_time_mins * 60)
 
-        if not(result) and plugged:
+        if rate_info['abnormal']:
+            result = False
+            utilities.print_error(f'The charge is changing at {rate_info["rate"]:.1f}% per hour '
+                                  f'while it usually changes at {rate_info["mean_rate"]:.1f}% per '
+                                  f'hour, which might indicate battery wear or runaway processes')
+        elif not result and plugged:
             utilities.print_error(f'Even though the battery is plugged, the charge level of'
                                   f' {percent_remaining}% is low, so consider running check\n'
                                   f'again in a few minutes, and if this persist the battery '
                                   f'health might be compromised')
-        if not(result) and not(plugged):
+        elif not result and not plugged:
             utilities.print_error(f'The charge level of {percent_remaining}% is low, so please'
                                   f' consider charging your battery')
 
@@ -391,6 +1025,107 @@ class CPUCheck:
         return result
 
 
+class CheckResults(dict):
+    """
+    Results returned by main(): a dictionary with the names of the checks performed as keys and
+    True if they passed or False otherwise as values.
+
+    Attributes:
+        reports (dict): Extra data gathered by the checks that failed, with the names of the
+        checks as keys (see CPUCheck.reports), e.g. the processes using most CPU and memory
+        when check_enough_idle_usage fails.\n
+    """
+
+    def __init__(self, results, reports):
+        super().__init__(results)
+        self.reports = reports
+
+
+# Parameters that change the result of the speed checks, so they are cached separately
+SPEED_CACHE_PARAMS = ['file_sizes_to_download', 'minimum_previous_tests', 'std_deviations_limit',
+                      'speed_min_mbps', 'minimum_download_time', 'low_impact_mode']
+
+
+def speed_test_skip_reason(checkobj):
+    """Returns the reason to skip a speed test in low impact mode, or None if it has to be run."""
+    if checkobj.low_impact_mode and not checkobj.get_low_impact_transfer_sizes():
+        return (f'no file fits in what is left of the {checkobj.low_impact_max_transfer_mb} MB '
+                f'allowed in low impact mode')
+    return None
+
+
+def build_default_registry():
+    """
+    Builds the registry with the checks of the CPUCheck class.
+
+    Returns:
+        CheckRegistry: Registry declaring the name, dependencies, cost class, timeout and
+        cacheability of every CPUCheck check.
+    """
+    check_registry = registry.CheckRegistry()
+    check_registry.register(registry.CheckSpec('check_no_pending_reboot',
+                                               CPUCheck.check_no_pending_reboot,
+                                               cost='io', timeout=60))
+    check_registry.register(registry.CheckSpec('check_enough_disk_space',
+                                               CPUCheck.check_enough_disk_space,
+                                               cost='io', timeout=120, cacheable=True,
+                                               cache_params=['min_gb', 'min_percent_disk']))
+    check_registry.register(registry.CheckSpec('check_enough_idle_usage',
+                                               CPUCheck.check_enough_idle_usage,
+                                               cost='cheap', timeout=10))
+    check_registry.register(registry.CheckSpec('check_cpu_thermal_state',
+                                               CPUCheck.check_cpu_thermal_state,
+                                               cost='cheap', timeout=10,
+                                               skip_if=lambda checkobj: (
+                                                   'there is no frequency or temperature info'
+                                                   if not any(checkobj.get_cpu_thermal_state()[
+                                                       key] for key in ['cores', 'sensors'])
+                                                   else None)))
+    check_registry.register(registry.CheckSpec('check_kernel_resource_headroom',
+                                               CPUCheck.check_kernel_resource_headroom,
+                                               cost='cheap', timeout=10,
+                                               skip_if=lambda checkobj: (
+                                                   'there is no kernel resources info'
+                                                   if not checkobj.get_kernel_resources()
+                                                   else None)))
+    check_registry.register(registry.CheckSpec('check_network_available',
+                                               CPUCheck.check_network_available,
+                                               cost='network', timeout=30))
+    check_registry.register(registry.CheckSpec('check_good_download_speed',
+                                               CPUCheck.check_good_download_speed,
+                                               depends_on=['check_network_available'],
+                                               cost='heavy', timeout=1800, cacheable=True,
+                                               cache_params=SPEED_CACHE_PARAMS + [
+                                                   'passive_window',
+                                                   'max_interface_error_percent'],
+                                               skip_if=speed_test_skip_reason))
+    check_registry.register(registry.CheckSpec('check_good_upload_speed',
+                                               CPUCheck.check_good_upload_speed,
+                                               depends_on=['check_network_available'],
+                                               cost='heavy', timeout=1800, cacheable=True,
+                                               cache_params=SPEED_CACHE_PARAMS + ['upload_url'],
+                                               skip_if=lambda checkobj: (
+                                                   'there is no upload_url'
+                                                   if checkobj.upload_url == ''
+                                                   else speed_test_skip_reason(checkobj))))
+    check_registry.register(registry.CheckSpec('check_fast_latency',
+                                               CPUCheck.check_fast_latency,
+                                               depends_on=['check_network_available'],
+                                               cost='network', timeout=60))
+    check_registry.register(registry.CheckSpec('check_enough_battery_charge',
+                                               CPUCheck.check_enough_battery_charge,
+                                               cost='cheap', timeout=10,
+                                               skip_if=lambda checkobj: (
+                                                   'there is no battery info'
+                                                   if checkobj.get_battery_info() is None
+                                                   else None)))
+    return check_registry
+
+
+# Registry used by main(). Site-specific checks can be added to it with check_registry.register()
+check_registry = build_default_registry()
+
+
 def main(**kwargs):
     """
     The main function to execute the cpu checks based on the provided configuration.
@@ -403,13 +1138,30 @@ def main(**kwargs):
     Then it runs a series of cpu health checks, which return True if the test pass and False
     otherwise. Finally it prints and logs the results indicating how many checks passed/failed.
 
-    The list of checks to run is:
+    The checks to run are the ones in the check_registry of this module (see
+    build_default_registry) plus the ones registered by other packages through entry points:
     [check_no_pending_reboot, check_enough_disk_space, check_enough_idle_usage,
-    check_network_available, check_good_download_speed, and check_enough_battery_charge].
-    But if check_network_available fails (returns False), check_good_download_speed and
-    check_fast_latency are not run and it is set automatically to failed.
+    check_cpu_thermal_state, check_kernel_resource_headroom, check_network_available,
+    check_good_download_speed, check_good_upload_speed, check_fast_latency, and
+    check_enough_battery_charge].
+    The cheapest checks run first, and up to 'max_parallel_checks' independent checks run at the
+    same time. A check that doesn't finish within its timeout ('check_timeouts') or within the
+    'run_time_budget' of the whole run is reported as timed out and counted as failed.
+    With 'preflight_mode' the checks run from the fastest to the slowest (according to
+    previous runs) stopping at the first failure, within 'preflight_budget' seconds. The checks
+    skipped because they would exceed the budget are listed at the end, and a run with skipped
+    checks is not reported as all passed.
+    With 'low_impact_mode' main lowers its CPU and I/O priority while the checks run and
+    doesn't start the heavy checks while the load per CPU is above 'low_impact_max_load'. The
+    CPU time, memory, disk I/O and network traffic of every check and of the whole run are
+    logged. At the end of the run the results are stored in the 'snapshot_filename' binary
+    file (see the snapshot module).
+    If check_network_available fails (returns False), check_good_download_speed,
+    check_good_upload_speed and check_fast_latency are not run and they are set automatically
+    to failed.
     Also the test check_enough_battery_charge is automatically skipped if there is no
-    battery information available (which probably means the code is beign run on a desktop).
+    battery information available (which probably means the code is beign run on a desktop),
+    and check_good_upload_speed is skipped if no 'upload_url' is defined.
 
 
     Args:
@@ -419,8 +1171,9 @@ def main(**kwargs):
             present in the configuration file.
 
     Returns:
-        dict: Dictionary whose keys are the name of the checks performed and the values
-            correspond to the result of each test
+        CheckResults: Dictionary whose keys are the name of the checks performed and the values
+            correspond to the result of each test. Its 'reports' attribute has the extra data
+            gathered by the failed checks (e.g. the top processes of check_enough_idle_usage)
 
     Raises:
         TypeError: If any kwargs are not part of the parameters used
@@ -450,55 +1203,83 @@ def main(**kwargs):
     checkobj = CPUCheck(**kwargs)
     checkobj.logger.info("Starting main function")
 
-    fails = 0
-    checks = [checkobj.check_no_pending_reboot, checkobj.check_enough_disk_space,
-              checkobj.check_enough_idle_usage, checkobj.check_network_available,
-              checkobj.check_good_download_speed, checkobj.check_fast_latency,
-              checkobj.check_enough_battery_charge]
-
-    # In the following while block it runs the checks defined as CPUCheck methods in order
-    # if one or more fail gives an error message and indicates which checks failed.
-    # If the check_network_available check fails then check_good_download_speed and
-    # check_fast_latency are automatically set to failed.
-    # If there is no battery info the battery check is skipped but not set to failed.
-    all_passed = True
-    ind_check = 0
-    results = {}
-    while ind_check in range(len(checks)):
-        check = checks[ind_check]
-        checkobj.logger.info(f"Running {check.__name__}")
-        if check == checkobj.check_enough_battery_charge and psutil.sensors_battery() is None:
-            checkobj.logger.info('check_battery was skipped because there is no battery info')
-            ind_check += 1
-            continue
-        result = check()
-        results[check.__name__] = result
-        if not(result):
-            utilities.print_error(f"{check.__name__} didn't passed")
-            checkobj.logger.error(f"{check.__name__} didn't passed")
-            all_passed = False
-
-            fails += 1
-            if check == checkobj.check_network_available:
-                fails += 2
-                utilities.print_error('Since there is no network check_good_download_speed '
-                                      'and check_fast_latency were automatically set to Failed')
-                ind_check += 2
-        ind_check += 1
+    # Here the checks of the registry (including the ones added by other packages through entry
+    # points) are run in order of cost respecting their dependencies. If a check fails, the
+    # checks depending on it (e.g. check_good_download_speed on check_network_available) are
+    # automatically set to failed. Checks that don't apply (e.g. no battery info) are skipped
+    # but not set to failed. Fresh results of cacheable checks measured by any process of the
+    # computer are reused instead of running the checks again. Checks exceeding their timeout
+    # or the run time budget are reported as timed out and don't stall the run. In pre-flight
+    # mode the fastest checks run first and the run stops at the first failure.
+    check_registry.load_entry_points()
+    if checkobj.preflight_mode:
+        run_time_budget = checkobj.preflight_budget
+    else:
+        run_time_budget = checkobj.run_time_budget
+    # In low impact mode the priorities are lowered before starting the checks, so their worker
+    # threads and child processes inherit them, and heavy checks wait for a quiet computer. They
+    # are restored after the checks, since main may be called from a longer running process
+    max_heavy_load = 0
+    lowered = {}
+    if checkobj.low_impact_mode:
+        lowered = utilities.lower_process_priority()
+        checkobj.logger.info(f'Low impact mode: lowered {", ".join(lowered) or "nothing"}')
+        max_heavy_load = checkobj.low_impact_max_load
+    start_usage = utilities.sample_process_usage(whole_process=True)
+    try:
+        outcomes = registry.run_checks(checkobj, check_registry, checkobj.max_parallel_checks,
+                                       checkobj.result_cache, checkobj.cache_ttls,
+                                       checkobj.check_timeouts, run_time_budget,
+                                       checkobj.preflight_mode, max_heavy_load)
+    finally:
+        not_restored = utilities.restore_process_priority(lowered)
+        if not_restored:
+            message = (f'The {" and ".join(not_restored)} lowered for the low impact mode could '
+                       f'not be restored')
+            utilities.print_warning(message)
+            checkobj.logger.info(message)
+    # The resources used by every check are logged by the scheduler, and here the whole run
+    run_usage = utilities.process_usage_delta(start_usage,
+                                              utilities.sample_process_usage(whole_process=True))
+    checkobj.logger.info(f'The checks used {utilities.format_process_usage(run_usage)}')
+    # Other processes read the results of this run from the snapshot without running the checks
+    snapshot_filename = os.path.join(checkobj.logs_folder, checkobj.snapshot_filename)
+    try:
+        snapshot.write_snapshot(snapshot_filename, outcomes, checkobj.values)
+    except OSError as e:
+        # The results are still returned and logged, only the snapshot keeps the previous run
+        message = f'The snapshot {snapshot_filename} could not be written: {e}'
+        utilities.print_warning(message)
+        checkobj.logger.info(message)
+    results = {name: outcome.passed for name, outcome in outcomes.items()
+               if outcome.status not in ['skipped', 'budget_skipped']}
+    fails = sum(not result for result in results.values())
+    timeouts = sum(outcome.status == 'timed_out' for outcome in outcomes.values())
+    budget_skipped = [name for name, outcome in outcomes.items()
+                      if outcome.status == 'budget_skipped']
 
     print(' ')
     print('#' * 28)
     print('###  ', end='')
 
-    if all_passed:
+    if fails == 0 and not budget_skipped:
         utilities.print_message('All checks passed ', new_line=False)
+    elif fails == 0:
+        utilities.print_warning(f'{len(budget_skipped):02} check(s) not run ', new_line=False)
     else:
-        utilities.print_error(f'{fails:02} check(s) failed', new_line=False)
+        timeouts_message = f' ({timeouts:02} timed out)' if timeouts else ''
+        utilities.print_error(f'{fails:02} check(s) failed{timeouts_message}', new_line=False)
 
     print('  ###')
     print('#' * 28)
+    # Checks skipped for the time budget are neither passed nor failed, so they are listed
+    if budget_skipped:
+        budget_message = (f'{len(budget_skipped)} check(s) skipped for the pre-flight budget: '
+                          f'{", ".join(budget_skipped)}')
+        utilities.print_warning(budget_message)
+        checkobj.logger.info(budget_message)
     checkobj.logger.info("Finished main function")
-    return results
+    return CheckResults(results, checkobj.reports)
 
 
 # If the user specific the 'auto' argument when running
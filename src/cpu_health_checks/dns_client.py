@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Felipe Santana Rojas
+# Date: 2023-06-07
+# Filename: dns_client.py
+# License: MIT License
+"""
+Minimal UDP DNS client used by check_network_available, and a stub DNS server to test it.
+
+The client sends A queries straight to the given resolvers instead of going through the
+resolver library of the operating system, so the results don't come from the local cache and
+the health and resolution time of every resolver can be measured separately. Names without
+IPv4 addresses are queried again for their IPv6 (AAAA) addresses. Many names and resolvers are
+queried concurrently.
+
+The stub server answers A and AAAA queries from a dictionary of names and addresses, optionally
+after a delay, and can be run from the command line, for example:
+
+    python dns_client.py --port 5353 --record www.example.com=192.0.2.1
+"""
+import argparse
+import concurrent.futures
+import ipaddress
+import random
+import socket
+import struct
+import threading
+import time
+
+DNS_PORT = 53
+TYPE_A = 1
+TYPE_AAAA = 28
+CLASS_IN = 1
+# resolv.conf written by systemd-resolved with the upstream resolvers behind its local stub
+UPSTREAM_RESOLV_CONF = '/run/systemd/resolve/resolv.conf'
+
+
+class DNSError(Exception):
+    """Raised when a name can't be resolved (error answer, malformed answer or timeout)."""
+
+
+def build_query(name, query_id, query_type=TYPE_A):
+    """Returns the bytes of a DNS query of one name with recursion desired."""
+    # Header: id, flags (only recursion desired), 1 question, no answers or other records
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    labels = b''.join(bytes([len(label)]) + label.encode('idna')
+                      for label in name.rstrip('.').split('.'))
+    return header + labels + b'\x00' + struct.pack('!HH', query_type, CLASS_IN)
+
+
+def skip_name(data, offset):
+    """Returns the offset after the (possibly compressed) name that starts at offset."""
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:  # A pointer to a name elsewhere ends the name
+            return offset + 2
+        offset += length + 1
+
+
+def parse_response(data, query_id):
+    """
+    Returns the IPv4 and IPv6 addresses of the answer of a query built with build_query.
+
+    Raises:
+        DNSError: If the answer doesn't correspond to the query, is malformed, or is an error
+        (e.g. the name doesn't exist).
+    """
+    try:
+        response_id, flags, questions, answers, _, _ = struct.unpack('!HHHHHH', data[:12])
+        if response_id != query_id or not flags & 0x8000:
+            raise DNSError('The answer does not correspond to the query')
+        if flags & 0x000F:
+            raise DNSError(f'The resolver answered with error code {flags & 0x000F}')
+        offset = 12
+        for _ in range(questions):
+            offset = skip_name(data, offset) + 4
+        addresses = []
+        for _ in range(answers):
+            offset = skip_name(data, offset)
+            record_type, _, _, length = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            if record_type == TYPE_A and length == 4:
+                addresses.append(socket.inet_ntoa(data[offset:offset + 4]))
+            elif record_type == TYPE_AAAA and length == 16:
+                addresses.append(socket.inet_ntop(socket.AF_INET6, data[offset:offset + 16]))
+            offset += length
+    except (struct.error, IndexError):
+        raise DNSError('Malformed answer')
+    return addresses
+
+
+def send_query(name, query_type, family, resolver_address, timeout):
+    """
+    Sends one query of the name to the resolver and returns the addresses of its answer.
+
+    Raises:
+        DNSError: If there is no valid answer before the timeout or it is an error.
+    """
+    query_id = random.randint(0, 0xFFFF)
+    query = build_query(name, query_id, query_type)
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        deadline = time.perf_counter() + timeout
+        try:
+            sock.sendto(query, resolver_address)
+            while True:
+                data, address = sock.recvfrom(4096)
+                # Answers from other addresses or to other queries are ignored
+                if address[0] == resolver_address[0] and data[:2] == query[:2]:
+                    break
+                sock.settimeout(max(deadline - time.perf_counter(), 0.001))
+        except socket.timeout:
+            raise DNSError(f'No answer from {resolver_address[0]} after {timeout:.3g} secs')
+        except OSError as error:
+            raise DNSError(f'Could not query {resolver_address[0]}: {error}')
+    return parse_response(data, query_id)
+
+
+def resolve(name, resolver, port=DNS_PORT, timeout=2):
+    """
+    Resolves the name querying the resolver directly through UDP.
+
+    The IPv4 addresses are queried first, and the IPv6 ones only if the name has no IPv4
+    address, so names of IPv6-only hosts are resolved too.
+
+    Args:
+        name (str): Name to resolve.\n
+        resolver (str): IP address of the resolver.\n
+        port (int): Port of the resolver.\n
+        timeout (float): Maximum number of seconds to wait for the answers.\n
+
+    Returns:
+        tuple: The list of IP addresses of the name and the seconds the resolution took.
+
+    Raises:
+        DNSError: If the name could not be resolved.
+    """
+    try:
+        # The address is normalized (or the hostname resolved) to compare it with the sender of
+        # the answers, which is always given in canonical form
+        family, _, _, _, resolver_address = socket.getaddrinfo(resolver, port,
+                                                               type=socket.SOCK_DGRAM)[0]
+    except OSError as error:
+        raise DNSError(f'Invalid resolver {resolver}: {error}')
+    start_time = time.perf_counter()
+    for query_type in (TYPE_A, TYPE_AAAA):
+        remaining = max(start_time + timeout - time.perf_counter(), 0.001)
+        addresses = send_query(name, query_type, family, resolver_address, remaining)
+        if addresses:
+            return addresses, time.perf_counter() - start_time
+    raise DNSError(f'{resolver} returned no addresses for {name}')
+
+
+def read_resolv_conf(resolv_conf):
+    """Returns the resolvers configured in a resolv.conf file, or an empty list if none."""
+    try:
+        with open(resolv_conf, 'r') as f:
+            return [line.split()[1] for line in f
+                    if line.startswith('nameserver') and len(line.split()) > 1]
+    except OSError:
+        return []
+
+
+def is_loopback(resolver):
+    """Returns True if the resolver is a loopback address, like a local caching stub."""
+    try:
+        return ipaddress.ip_address(parse_resolver(resolver)[0]).is_loopback
+    except ValueError:  # Hostnames are not local stubs
+        return False
+
+
+def get_system_resolvers(resolv_conf='/etc/resolv.conf',
+                         upstream_resolv_conf=UPSTREAM_RESOLV_CONF):
+    """
+    Returns the resolvers configured in resolv.conf, or an empty list if there is none.
+
+    If they are only local stubs (e.g. 127.0.0.53 of systemd-resolved), which answer from their
+    cache, the upstream resolvers they forward to are returned instead when they are known.
+    """
+    resolvers = read_resolv_conf(resolv_conf)
+    if resolvers and all(is_loopback(resolver) for resolver in resolvers):
+        upstream = [resolver for resolver in read_resolv_conf(upstream_resolv_conf)
+                    if not is_loopback(resolver)]
+        return upstream or resolvers
+    return resolvers
+
+
+def parse_resolver(resolver):
+    """
+    Returns the address and port of a resolver given as 'address', 'address:port' (IPv4), or
+    '[address]:port' (IPv6).
+
+    Raises:
+        ValueError: If the port is not a number between 1 and 65535.
+    """
+    address, port = resolver, str(DNS_PORT)
+    if resolver.startswith('['):
+        address, _, port = resolver[1:].partition(']:')
+        address, port = address.rstrip(']'), port or str(DNS_PORT)
+    elif resolver.count(':') == 1:
+        address, port = resolver.split(':')
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f'The port of the resolver {resolver} should be a number between 1 and '
+                         f'65535')
+    return address, int(port)
+
+
+def measure_resolvers(resolvers, names, queries_per_name=1, timeout=2):
+    """
+    Resolves every name queries_per_name times against every resolver concurrently.
+
+    Args:
+        resolvers (list): Resolvers to query, in the formats accepted by parse_resolver.\n
+        names (list): Names to resolve.\n
+        queries_per_name (int): Number of times every name is resolved with every resolver.\n
+        timeout (float): Maximum number of seconds to wait for every answer.\n
+
+    Returns:
+        dict: Dictionary with the resolvers as keys and as values dictionaries with the list of
+        'latencies_ms' of the successful resolutions and the number of 'failures' and 'queries'.
+    """
+    queries = [(resolver, name) for resolver in resolvers for name in names
+               for _ in range(queries_per_name)]
+    results = {resolver: {'latencies_ms': [], 'failures': 0, 'queries': 0}
+               for resolver in resolvers}
+    if not queries:
+        return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(queries), 32)) as executor:
+        futures = {executor.submit(resolve, name, *parse_resolver(resolver), timeout): resolver
+                   for resolver, name in queries}
+        for future in concurrent.futures.as_completed(futures):
+            resolver_results = results[futures[future]]
+            resolver_results['queries'] += 1
+            try:
+                resolver_results['latencies_ms'].append(1000 * future.result()[1])
+            except DNSError:
+                resolver_results['failures'] += 1
+    return results
+
+
+def build_answer(query, records, ttl=60):
+    """Returns the answer of the stub server to a query, using the addresses of records."""
+    query_id, _ = struct.unpack('!HH', query[:4])
+    question_end = skip_name(query, 12) + 4
+    query_type, = struct.unpack('!H', query[question_end - 4:question_end - 2])
+    labels, offset = [], 12
+    while query[offset]:
+        labels.append(query[offset + 1:offset + 1 + query[offset]].decode('idna'))
+        offset += query[offset] + 1
+    address = records.get('.'.join(labels).lower())
+    if address is None:  # The name doesn't exist (NXDOMAIN)
+        return struct.pack('!HHHHHH', query_id, 0x8183, 1, 0, 0, 0) + query[12:question_end]
+    address = ipaddress.ip_address(address)
+    if query_type != (TYPE_A if address.version == 4 else TYPE_AAAA):
+        # The name exists but has no address of the type asked (an empty answer)
+        return struct.pack('!HHHHHH', query_id, 0x8180, 1, 0, 0, 0) + query[12:question_end]
+    # The answer points (0xC00C) to the name of the question instead of repeating it
+    answer = (struct.pack('!HHHIH', 0xC00C, query_type, CLASS_IN, ttl, len(address.packed))
+              + address.packed)
+    return (struct.pack('!HHHHHH', query_id, 0x8180, 1, 1, 0, 0) + query[12:question_end]
+            + answer)
+
+
+def start_stub_dns_server(records, host='127.0.0.1', port=0, delay=0):
+    """
+    Starts a stub DNS server in a background thread.
+
+    Args:
+        records (dict): Dictionary with the names (lowercase) as keys and their IPv4 or IPv6
+        address as values. Other names are answered as non-existent.\n
+        host (str): Address where the server listens.\n
+        port (int): Port where the server listens. If it is 0 a free port is chosen.\n
+        delay (float): Seconds waited before answering every query.\n
+
+    Returns:
+        socket.socket: The socket of the server. Its port is sock.getsockname()[1] and the
+        server is stopped with sock.close().
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+
+    def send(answer, address):
+        try:
+            sock.sendto(answer, address)
+        except OSError:  # The socket was closed while waiting
+            pass
+
+    def serve():
+        while True:
+            try:
+                query, address = sock.recvfrom(4096)
+            except OSError:  # The socket was closed
+                return
+            try:
+                answer = build_answer(query, records)
+            except (struct.error, IndexError, UnicodeError):
+                continue  # Malformed queries are ignored
+            if delay:
+                threading.Timer(delay, send, (answer, address)).start()
+            else:
+                send(answer, address)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock
+
+
+def main():
+    """Runs the stub DNS server in the foreground until it is interrupted."""
+    parser = argparse.ArgumentParser(description='Stub DNS server for check_network_available')
+    parser.add_argument('--host', default='127.0.0.1', help='Address where the server listens')
+    parser.add_argument('--port', type=int, default=5353, help='Port where the server listens')
+    parser.add_argument('--record', action='append', default=[],
+                        help='Record answered by the server as name=address')
+    args = parser.parse_args()
+
+    records = dict(record.lower().split('=', 1) for record in args.record)
+    for name, address in records.items():
+        try:
+            ipaddress.ip_address(address)
+        except ValueError:
+            parser.error(f'The address {address} of {name} is not an IP address')
+    sock = start_stub_dns_server(records, args.host, args.port)
+    print(f'Stub DNS server listening on {args.host}:{args.port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
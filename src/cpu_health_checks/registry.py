@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Felipe Santana Rojas
+# Date: 2023-06-07
+# Filename: registry.py
+# License: MIT License
+"""
+Registry of the checks run by main() and the scheduler that runs them.
+
+Every check is declared with a CheckSpec that indicates its name, the checks it depends on, its
+cost class, its timeout, and whether its result can be cached. The scheduler builds a dependency
+graph from the registry, runs the cheapest checks first, runs independent checks concurrently
+when allowed, marks as failed the checks whose dependencies did not pass without running them,
+and marks as timed out the checks that exceed their time budget.
+
+Third-party packages can add checks declaring CheckSpec objects (or lists of them) in the
+'cpu_health_checks.checks' entry point group.
+"""
+import heapq
+import queue
+import threading
+import time
+
+import cpu_health_checks.utilities as utilities
+
+# Cost classes from cheapest to most expensive, used to decide which checks run first
+COST_CLASSES = ['cheap', 'io', 'network', 'heavy']
+# Seconds a check of each cost class is expected to take when it has never been measured
+DEFAULT_DURATIONS = {'cheap': 0.1, 'io': 1, 'network': 2, 'heavy': 60}
+ENTRY_POINT_GROUP = 'cpu_health_checks.checks'
+# Cancellation event of the check run by each worker thread (see is_cancelled)
+worker_state = threading.local()
+
+
+class CheckCancelled(Exception):
+    """Raised when a check finishes after timing out, so its result is not cached."""
+
+
+class CheckSpec:
+    """
+    Declaration of a check that can be run by the scheduler.
+
+    Attributes:
+        name (str): Unique name of the check, used as key of the results.\n
+        function (function): Function receiving the CPUCheck object that runs the check and
+        returns True if it passed and False otherwise.\n
+        depends_on (tuple): Names of the checks that have to pass before running this one.\n
+        cost (str): Cost class of the check, one of 'cheap', 'io', 'network' or 'heavy'.\n
+        timeout (float): Maximum number of seconds the check is allowed to run before it is
+        set to timed out, or None for no limit.\n
+        cacheable (bool): Whether the result of the check can be reused by other runs.\n
+        cache_params (tuple): Names of the CPUCheck attributes that affect the result of the
+        check, so results obtained with different values are cached separately.\n
+        skip_if (function): Optional function receiving the CPUCheck object that returns the
+        reason to skip the check (e.g. there is no battery) or None if it has to be run.\n
+    """
+
+    def __init__(self, name, function, depends_on=(), cost='cheap', timeout=60,
+                 cacheable=False, cache_params=(), skip_if=None):
+        if cost not in COST_CLASSES:
+            raise ValueError(f'Cost class {cost} of check {name} should be one of '
+                             f'{COST_CLASSES}')
+        self.name = name
+        self.function = function
+        self.depends_on = tuple(depends_on)
+        self.cost = cost
+        self.timeout = timeout
+        self.cacheable = cacheable
+        self.cache_params = tuple(cache_params)
+        self.skip_if = skip_if
+
+
+class CheckOutcome:
+    """
+    Outcome of a check run by the scheduler.
+
+    Attributes:
+        name (str): Name of the check.\n
+        status (str): 'passed', 'failed', 'skipped' (the check doesn't apply to this computer),
+        'budget_skipped' (not run because it was expected to exceed the pre-flight budget),
+        'dependency_failed' (not run because a check it depends on didn't pass), or
+        'timed_out' (it didn't finish within its time budget).\n
+        duration (float): Seconds the check took to run.\n
+        message (str): Extra information about the status (e.g. the reason to skip it).\n
+        cached (bool): True if the status was taken from the result cache.\n
+        usage (dict): Resources used by the process while running the check, as returned by
+        utilities.process_usage_delta, or None if it was not run.\n
+        timestamp (float): Time (as returned by time.time()) when the status was determined,
+        or when the cached result was measured.\n
+    """
+
+    def __init__(self, name, status, duration=0.0, message='', cached=False, usage=None,
+                 timestamp=None):
+        self.name = name
+        self.status = status
+        self.duration = duration
+        self.message = message
+        self.cached = cached
+        self.usage = usage
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    @property
+    def passed(self):
+        """True if the check passed."""
+        return self.status == 'passed'
+
+
+class CheckRegistry:
+    """Ordered collection of the CheckSpec objects to be run by the scheduler."""
+
+    def __init__(self):
+        self.specs = {}
+        self.entry_points_loaded = False
+
+    def register(self, spec):
+        """Adds a CheckSpec to the registry replacing any previous check with the same name."""
+        self.specs[spec.name] = spec
+        return spec
+
+    def unregister(self, name):
+        """Removes the check with the given name from the registry."""
+        del self.specs[name]
+
+    def load_entry_points(self, group=ENTRY_POINT_GROUP):
+        """
+        Registers the checks declared by installed packages in the given entry point group.
+
+        Every entry point has to point to a CheckSpec or a list of them. Entry points that
+        cannot be loaded are ignored with a warning. They are only loaded once per registry.
+        """
+        if self.entry_points_loaded:
+            return
+        self.entry_points_loaded = True
+        try:
+            from importlib import metadata
+        except ImportError:  # importlib.metadata is only available from Python 3.8
+            return
+
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, 'select'):
+            group_entry_points = entry_points.select(group=group)
+        else:
+            group_entry_points = entry_points.get(group, [])
+
+        for entry_point in group_entry_points:
+            try:
+                specs = entry_point.load()
+            except Exception as e:
+                utilities.print_warning(f'Ignoring check entry point {entry_point.name}: {e}')
+                continue
+            for spec in (specs if isinstance(specs, (list, tuple)) else [specs]):
+                self.register(spec)
+
+    def execution_order(self):
+        """
+        Returns the names of the checks in the order they would be run sequentially.
+
+        The order respects the dependencies and, among the checks that are ready to run,
+        the cheapest ones go first (and then the ones registered first).
+
+        Raises:
+            ValueError: If a check depends on an unknown check or there are circular
+            dependencies.
+        """
+        graph = DependencyGraph(self)
+        order = []
+        while graph.has_ready():
+            name = graph.pop_ready()
+            order.append(name)
+            graph.mark_done(name)
+        graph.check_finished()
+        return order
+
+
+class DependencyGraph:
+    """
+    Tracks which checks of a registry are ready to run as their dependencies finish.
+
+    Among the ready checks the first one returned is the one with the lowest expected duration
+    if expected_durations (a dictionary with the seconds of every check) is given, and otherwise
+    the one with the cheapest cost class.
+    """
+
+    def __init__(self, registry, expected_durations=None):
+        self.registry = registry
+        self.pending_dependencies = {}
+        self.dependents = {name: [] for name in registry.specs}
+        self.ready = []
+        self.done = set()
+
+        for index, (name, spec) in enumerate(registry.specs.items()):
+            for dependency in spec.depends_on:
+                if dependency not in registry.specs:
+                    raise ValueError(f'Check {name} depends on unknown check {dependency}')
+                self.dependents[dependency].append(name)
+            self.pending_dependencies[name] = len(spec.depends_on)
+        # Checks are ordered by expected duration when it is given and otherwise by cost class
+        self.priorities = {name: (expected_durations[name] if expected_durations else 0,
+                                  COST_CLASSES.index(spec.cost), index)
+                           for index, (name, spec) in enumerate(registry.specs.items())}
+        for name, pending in self.pending_dependencies.items():
+            if pending == 0:
+                heapq.heappush(self.ready, (self.priorities[name], name))
+
+    def has_ready(self):
+        """True if there are checks whose dependencies have all finished."""
+        return len(self.ready) > 0
+
+    def pop_ready(self):
+        """Returns the cheapest check whose dependencies have all finished."""
+        return heapq.heappop(self.ready)[1]
+
+    def mark_done(self, name):
+        """Marks a check as finished releasing the checks that depend on it."""
+        self.done.add(name)
+        for dependent in self.dependents[name]:
+            self.pending_dependencies[dependent] -= 1
+            if self.pending_dependencies[dependent] == 0:
+                heapq.heappush(self.ready, (self.priorities[dependent], dependent))
+
+    def check_finished(self):
+        """Raises ValueError if some checks could never run because of circular dependencies."""
+        if len(self.done) != len(self.registry.specs):
+            blocked = [name for name in self.registry.specs if name not in self.done]
+            raise ValueError(f'Circular dependencies found between checks {blocked}')
+
+
+def is_cancelled():
+    """
+    Returns True if the check running in this thread timed out, so its result is discarded
+    and it must not write registers or other files.
+    """
+    cancelled = getattr(worker_state, 'cancelled', None)
+    return cancelled is not None and cancelled.is_set()
+
+
+def dependency_outcome(spec, outcomes):
+    """
+    Returns the outcome of the check if it is not run because of its dependencies
+    ('budget_skipped' if a dependency was skipped for the pre-flight budget and
+    'dependency_failed' if one didn't pass or doesn't apply), or None.
+    """
+    skipped_dependencies = [name for name in spec.depends_on
+                            if outcomes[name].status == 'budget_skipped']
+    if skipped_dependencies:
+        return CheckOutcome(spec.name, 'budget_skipped',
+                            message=f'{", ".join(skipped_dependencies)} was skipped for the '
+                                    f'pre-flight budget')
+    failed_dependencies = [name for name in spec.depends_on if not outcomes[name].passed]
+    if failed_dependencies:
+        return CheckOutcome(spec.name, 'dependency_failed',
+                            message=f'{", ".join(failed_dependencies)} didn\'t pass')
+    return None
+
+
+def run_check(checkobj, spec, outcomes, result_cache=None, cache_ttls=None, max_heavy_load=0):
+    """
+    Runs a single check unless it has to be skipped or a dependency didn't pass.
+
+    If the check is cacheable and has a positive time to live in cache_ttls, a fresh result
+    from the cache is used instead of running it, and only one process at a time runs it again
+    when the cached result has expired. Heavy checks are not started while the load per CPU is
+    above max_heavy_load: their fresh cached result is used if there is one or they are skipped.
+    The resources used by the process while running the check are stored in the outcome.
+
+    Args:
+        checkobj (CPUCheck): The object used to run the checks.\n
+        spec (CheckSpec): The check to run.\n
+        outcomes (dict): The outcomes of the checks already finished.\n
+        result_cache (ResultCache): Cache shared with other processes, or None to not use it.\n
+        cache_ttls (dict): Seconds the result of each check name is considered fresh.\n
+        max_heavy_load (float): Load average per CPU above which heavy checks are not started,
+        or 0 for no limit.\n
+
+    Returns:
+        CheckOutcome: The outcome of the check.
+    """
+    outcome = dependency_outcome(spec, outcomes)
+    if outcome is not None:
+        return outcome
+    if spec.skip_if is not None:
+        skip_reason = spec.skip_if(checkobj)
+        if skip_reason:
+            return CheckOutcome(spec.name, 'skipped', message=skip_reason)
+    if spec.cost == 'heavy' and max_heavy_load:
+        load = utilities.get_load_per_cpu()
+        if load > max_heavy_load:
+            outcome = get_fresh_cached_outcome(checkobj, spec, result_cache, cache_ttls)
+            if outcome is None:
+                outcome = CheckOutcome(spec.name, 'skipped',
+                                       message=f'the load per CPU ({load:.2f}) is above '
+                                               f'{max_heavy_load}')
+            return outcome
+
+    usage = {}
+
+    def measure():
+        # A worker that timed out while waiting for the lease never starts the measurement
+        if is_cancelled():
+            raise CheckCancelled(f'{spec.name} timed out before starting')
+        checkobj.logger.info(f"Running {spec.name}")
+        before = utilities.sample_process_usage()
+        try:
+            status = 'passed' if spec.function(checkobj) else 'failed'
+        finally:
+            usage.update(utilities.process_usage_delta(before,
+                                                       utilities.sample_process_usage()))
+        if is_cancelled():  # The result is discarded, so it isn't stored in the cache
+            raise CheckCancelled(f'{spec.name} finished after timing out')
+        return status
+
+    start_time = time.time()
+    ttl = (cache_ttls or {}).get(spec.name, 0)
+    if result_cache is None or not spec.cacheable or ttl <= 0:
+        status = measure()
+        return CheckOutcome(spec.name, status, time.time() - start_time, usage=usage)
+
+    key = result_cache.make_key(spec.name, cache_params(checkobj, spec))
+    # The lease expires with the check timeout so a process that hangs doesn't block the others
+    lease_time = spec.timeout if spec.timeout else 3600
+    status, cached_result = result_cache.get_or_measure(key, ttl, measure, lease_time)
+    if cached_result is None:
+        return CheckOutcome(spec.name, status, time.time() - start_time, usage=usage)
+    return cached_outcome(checkobj, spec, cached_result)
+
+
+def cache_params(checkobj, spec):
+    """Returns the values of the CPUCheck attributes that affect the result of the check."""
+    return {param: getattr(checkobj, param) for param in spec.cache_params}
+
+
+def cached_outcome(checkobj, spec, cached_result):
+    """Prints and logs that a cached result is used and returns it as a CheckOutcome."""
+    message = f'{spec.name} used the cached result measured {cached_result.age:.0f} secs ago'
+    utilities.print_and_log_result(cached_result.status == 'passed', message, message,
+                                   checkobj.logger)
+    return CheckOutcome(spec.name, cached_result.status, message=message, cached=True,
+                        timestamp=cached_result.timestamp)
+
+
+def get_fresh_cached_outcome(checkobj, spec, result_cache, cache_ttls):
+    """Returns the CheckOutcome of a fresh cached result of the check, or None if there isn't."""
+    ttl = (cache_ttls or {}).get(spec.name, 0)
+    if result_cache is None or not spec.cacheable or ttl <= 0:
+        return None
+    cached_result = result_cache.get(result_cache.make_key(spec.name,
+                                                           cache_params(checkobj, spec)), ttl)
+    if cached_result is None:
+        return None
+    return cached_outcome(checkobj, spec, cached_result)
+
+
+def report_outcome(checkobj, outcome):
+    """Logs the resources used by the checks run, and prints and logs the ones not passed."""
+    if outcome.usage:
+        checkobj.logger.info(f'{outcome.name} used '
+                             f'{utilities.format_process_usage(outcome.usage)}')
+    if outcome.status == 'failed':
+        utilities.print_error(f"{outcome.name} didn't passed")
+        checkobj.logger.error(f"{outcome.name} didn't passed")
+    elif outcome.status == 'dependency_failed':
+        utilities.print_error(f'Since {outcome.message} {outcome.name} was automatically set '
+                              f'to Failed')
+        checkobj.logger.error(f'{outcome.name} was set to failed because {outcome.message}')
+    elif outcome.status == 'timed_out':
+        utilities.print_error(f'{outcome.name} timed out because {outcome.message}')
+        checkobj.logger.error(f'{outcome.name} timed out because {outcome.message}')
+    elif outcome.status in ['skipped', 'budget_skipped']:
+        checkobj.logger.info(f'{outcome.name} was skipped because {outcome.message}')
+
+
+def run_checks(checkobj, registry, max_parallel=1, result_cache=None, cache_ttls=None,
+               check_timeouts=None, run_time_budget=0, preflight=False, max_heavy_load=0):
+    """
+    Runs all the checks of the registry respecting their dependencies and time budgets.
+
+    The checks ready to run are started cheapest first, each one in its own worker thread. If
+    max_parallel is larger than 1, up to that number of independent checks run concurrently.
+    Checks whose dependencies didn't pass are not run and are set to 'dependency_failed'.
+    Cacheable checks use the result cache, and heavy checks are not started while the load per
+    CPU is above max_heavy_load, as explained in run_check.
+
+    A check that doesn't finish within its timeout (or before the run time budget is exhausted)
+    is set to 'timed_out' and the scheduler moves on. Its worker thread is a daemon that is
+    abandoned, since blocking calls cannot be interrupted, so it can't stall the exit of the
+    interpreter. The abandoned worker is told that it was cancelled (see is_cancelled) so it
+    doesn't store its result in the cache nor write registers, and it keeps its worker slot
+    until it finishes, so no more than max_parallel checks use the computer at the same time.
+    A check waiting for a slot held by abandoned workers counts that time against its timeout.
+    Checks that were not started before the run time budget was exhausted are also set to
+    'timed_out'. A check that raises an exception is set to 'failed' with the exception in its
+    message, and the other checks still run.
+
+    The time each check takes is stored in the result cache (as a moving average) so the
+    pre-flight mode can order the checks by their measured cost. In pre-flight mode the checks
+    run one at a time from the fastest to the slowest, the run stops at the first check that
+    doesn't pass (the remaining ones are skipped), and a check expected to take longer than the
+    time left of the run time budget is replaced by its fresh cached result or set to
+    'budget_skipped' (as the checks depending on it).
+
+    Args:
+        checkobj (CPUCheck): The object used to run the checks.\n
+        registry (CheckRegistry): The checks to run.\n
+        max_parallel (int): Maximum number of checks running at the same time.\n
+        result_cache (ResultCache): Cache shared with other processes, or None to not use it.\n
+        cache_ttls (dict): Seconds the result of each check name is considered fresh.\n
+        check_timeouts (dict): Seconds each check name is allowed to run, overriding the
+        timeout of its CheckSpec.\n
+        run_time_budget (float): Maximum number of seconds for running all the checks, or 0
+        for no limit.\n
+        preflight (bool): Whether to run the checks in pre-flight mode.\n
+        max_heavy_load (float): Load average per CPU above which heavy checks are not started,
+        or 0 for no limit.\n
+
+    Returns:
+        dict: Dictionary whose keys are the names of the checks and the values their
+        CheckOutcome, in the order they finished.
+
+    Raises:
+        ValueError: If a check depends on an unknown check or there are circular dependencies.
+    """
+    expected_durations = None
+    if preflight:
+        max_parallel = 1
+        measured_durations = result_cache.get_durations() if result_cache is not None else {}
+        expected_durations = {name: measured_durations.get(name, DEFAULT_DURATIONS[spec.cost])
+                              for name, spec in registry.specs.items()}
+    graph = DependencyGraph(registry, expected_durations)
+    outcomes = {}
+    stopped = False  # Set when a check fails in pre-flight mode
+    running = {}  # Name of the running checks with their start time, deadline and cancel event
+    abandoned = set()  # Checks that timed out but whose worker threads are still running
+    waiting = None  # Check waiting for a worker slot held by abandoned workers
+    finished_queue = queue.Queue()
+    run_deadline = time.monotonic() + run_time_budget if run_time_budget else None
+
+    def worker(spec, cancelled):
+        worker_state.cancelled = cancelled
+        try:
+            finished_queue.put((spec.name, run_check(checkobj, spec, outcomes, result_cache,
+                                                     cache_ttls, max_heavy_load), None))
+        except BaseException as e:
+            finished_queue.put((spec.name, None, e))
+
+    def start(spec, start_time, deadline):
+        cancelled = threading.Event()
+        running[spec.name] = (start_time, deadline, cancelled)
+        threading.Thread(target=worker, args=(spec, cancelled), daemon=True).start()
+
+    def finish(outcome):
+        outcomes[outcome.name] = outcome
+        report_outcome(checkobj, outcome)
+        graph.mark_done(outcome.name)
+        measured = outcome.status in ['passed', 'failed', 'timed_out'] and not outcome.cached
+        if result_cache is not None and measured and outcome.duration > 0:
+            result_cache.record_duration(outcome.name, outcome.duration)
+
+    while graph.has_ready() or running or waiting is not None:
+        # The check waiting for a worker starts when an abandoned worker finishes
+        if waiting is not None and len(running) + len(abandoned) < max_parallel:
+            start(*waiting)
+            waiting = None
+        # Start the cheapest checks ready to run while there are free workers
+        while waiting is None and graph.has_ready() and len(running) < max_parallel:
+            spec = registry.specs[graph.pop_ready()]
+            start_time = time.monotonic()
+            if stopped:
+                finish(CheckOutcome(spec.name, 'skipped',
+                                    message='the pre-flight stopped at the first failure'))
+                continue
+            # Checks not run because of their dependencies don't need a worker
+            outcome = dependency_outcome(spec, outcomes)
+            if outcome is not None:
+                finish(outcome)
+                continue
+            if (preflight and run_deadline is not None
+                    and start_time + expected_durations[spec.name] > run_deadline):
+                outcome = get_fresh_cached_outcome(checkobj, spec, result_cache, cache_ttls)
+                if outcome is None:
+                    outcome = CheckOutcome(spec.name, 'budget_skipped',
+                                           message=f'it is expected to take '
+                                                   f'{expected_durations[spec.name]:.1f} secs, '
+                                                   f'more than the pre-flight budget left')
+                finish(outcome)
+                stopped = not outcome.passed and outcome.status != 'budget_skipped'
+                continue
+            if run_deadline is not None and start_time >= run_deadline:
+                finish(CheckOutcome(spec.name, 'timed_out',
+                                    message='the run time budget was exhausted before it '
+                                            'started'))
+                continue
+            timeout = (check_timeouts or {}).get(spec.name, spec.timeout)
+            deadline = start_time + timeout if timeout else float('inf')
+            if run_deadline is not None:
+                deadline = min(deadline, run_deadline)
+            if len(running) + len(abandoned) >= max_parallel:
+                waiting = (spec, start_time, deadline)
+                break
+            start(spec, start_time, deadline)
+        if not running and waiting is None:
+            continue
+
+        # Wait for the next check to finish or for the closest deadline to be reached
+        deadlines = [deadline for _, deadline, _ in running.values()]
+        next_deadline = min(deadlines + ([waiting[2]] if waiting is not None else []))
+        try:
+            wait_time = next_deadline - time.monotonic()
+            name, outcome, exception = finished_queue.get(
+                timeout=None if wait_time == float('inf') else max(wait_time, 0))
+        except queue.Empty:
+            now = time.monotonic()
+            for name, (start_time, deadline, cancelled) in list(running.items()):
+                if deadline <= now:
+                    del running[name]
+                    cancelled.set()
+                    abandoned.add(name)
+                    finish(CheckOutcome(name, 'timed_out', now - start_time,
+                                        f'it didn\'t finish in {deadline - start_time:.1f} '
+                                        f'secs'))
+                    stopped = preflight
+            if waiting is not None and waiting[2] <= now:
+                spec, start_time, deadline = waiting
+                waiting = None
+                finish(CheckOutcome(spec.name, 'timed_out', now - start_time,
+                                    f'no worker was free in {deadline - start_time:.1f} secs '
+                                    f'while {", ".join(sorted(abandoned))} kept running after '
+                                    f'timing out'))
+                stopped = preflight
+            continue
+        if name not in running:  # It finished after being set to timed out
+            abandoned.discard(name)
+            continue
+        start_time = running.pop(name)[0]
+        if isinstance(exception, Exception):
+            # A check that crashes fails alone, the other checks and the results are kept
+            message = f'it raised {type(exception).__name__}: {exception}'
+            utilities.print_error(f'{name} failed because {message}')
+            checkobj.logger.error(f'{name} failed because {message}', exc_info=exception)
+            outcome = CheckOutcome(name, 'failed', time.monotonic() - start_time, message)
+        elif exception is not None:
+            raise exception
+        finish(outcome)
+        stopped = preflight and not outcome.passed and outcome.status != 'skipped'
+
+    graph.check_finished()
+    return outcomes
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Felipe Santana Rojas
+# Date: 2023-06-07
+# Filename: sink_server.py
+# License: MIT License
+"""
+HTTP sink server used as target of check_good_upload_speed.
+
+The server accepts POST and PUT requests, reads the body block by block discarding it, and
+answers with the number of bytes received and the seconds it took to receive them, so it can be
+used to test the upload check locally or to measure the upload speed between machines of a LAN.
+
+It can be run from the command line, for example:
+
+    python sink_server.py --host 0.0.0.0 --port 8080
+"""
+import argparse
+import http.server
+import json
+import threading
+import time
+
+
+class SinkRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler that reads and discards the body of every POST or PUT request."""
+
+    block_size = 65536
+
+    def do_POST(self):
+        """Reads the request body discarding it and answers with the bytes received."""
+        start_time = time.time()
+        bytes_left = int(self.headers.get('Content-Length', 0))
+        bytes_received = 0
+        while bytes_left > 0:
+            buffer = self.rfile.read(min(self.block_size, bytes_left))
+            if not buffer:
+                break
+            bytes_received += len(buffer)
+            bytes_left -= len(buffer)
+
+        body = json.dumps({'bytes_received': bytes_received,
+                           'seconds': time.time() - start_time}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        """Silences the default logging of every request to stderr."""
+        pass
+
+
+def start_sink_server(host='127.0.0.1', port=0):
+    """
+    Starts the sink server in a background thread.
+
+    Args:
+        host (str): Address where the server listens.
+        port (int): Port where the server listens. If it is 0 a free port is chosen.
+
+    Returns:
+        ThreadingHTTPServer: The running server. Its url is
+        f'http://{host}:{server.server_address[1]}/' and it is stopped with server.shutdown().
+    """
+    server = http.server.ThreadingHTTPServer((host, port), SinkRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    """Runs the sink server in the foreground until it is interrupted."""
+    parser = argparse.ArgumentParser(description='HTTP sink server for check_good_upload_speed')
+    parser.add_argument('--host', default='127.0.0.1', help='Address where the server listens')
+    parser.add_argument('--port', type=int, default=8080, help='Port where the server listens')
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer((args.host, args.port), SinkRequestHandler)
+    print(f'Sink server listening on http://{args.host}:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Felipe Santana Rojas
+# Date: 2023-06-07
+# Filename: snapshot.py
+# License: MIT License
+"""
+Binary snapshot of the results of the last run, shared with any process of the computer.
+
+At the end of every run main() writes the status, main value, duration and time of every check
+to a small file with a fixed layout: a header followed by one fixed size record per check, all
+little-endian. The file is written to a temporary file and renamed over the previous one, so
+readers never see a partial snapshot and don't need locks, and it is read through mmap without
+any parsing, which takes microseconds. The module only uses the standard library so reading a
+snapshot doesn't import the dependencies of the checks.
+
+Layout (see HEADER and RECORD):
+
+    header: magic b'CPUHSNAP', version (uint16), record size (uint16), number of records
+            (uint32), time written (float64)
+    record: check name (64 bytes, UTF-8 padded with zeros), status code (uint8, index in
+            STATUSES), cached flag (uint8), 6 padding bytes, value, duration and timestamp
+            (float64 each, the value is NaN if the check has none)
+
+It can be run from the command line to print the last snapshot, for example:
+
+    python snapshot.py --snapshot ../../logs/snapshot.bin
+"""
+import argparse
+import math
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'CPUHSNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sHHId')
+RECORD = struct.Struct('<64sBB6xddd')
+NAME_SIZE = 64
+# Attempts to replace the snapshot, which fails on Windows while a reader has it mapped
+REPLACE_ATTEMPTS = 5
+STATUSES = ['passed', 'failed', 'skipped', 'dependency_failed', 'timed_out', 'budget_skipped']
+
+
+class SnapshotRecord:
+    """
+    Result of a check stored in a snapshot.
+
+    Attributes:
+        name (str): Name of the check.\n
+        status (str): Status of the check, one of STATUSES.\n
+        value (float): Main value measured by the check (e.g. the download speed in Mb/s), or
+        NaN if it has none.\n
+        duration (float): Seconds the check took to run.\n
+        timestamp (float): Time (as returned by time.time()) when the result was measured.\n
+        cached (bool): True if the result was taken from the result cache.\n
+    """
+
+    def __init__(self, name, status, value, duration, timestamp, cached):
+        self.name = name
+        self.status = status
+        self.value = value
+        self.duration = duration
+        self.timestamp = timestamp
+        self.cached = cached
+
+    @property
+    def passed(self):
+        """True if the check passed."""
+        return self.status == 'passed'
+
+    @property
+    def age(self):
+        """Seconds since the result was measured."""
+        return time.time() - self.timestamp
+
+
+def encode_name(name):
+    """Returns the name as stored in the records, cut to NAME_SIZE bytes of valid UTF-8."""
+    return name.encode('utf-8')[:NAME_SIZE].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def write_snapshot(filename, outcomes, values=None):
+    """
+    Writes the outcomes of a run to the snapshot file replacing the previous one atomically.
+
+    Names longer than NAME_SIZE bytes are truncated. On Windows the snapshot can't be replaced
+    while a reader has it mapped, so replacing it is retried a few times in case the reader
+    finishes, and the temporary file is removed if it still fails.
+
+    Args:
+        filename (str): Path of the snapshot file.\n
+        outcomes (dict): Dictionary with the names of the checks as keys and their
+        registry.CheckOutcome as values.\n
+        values (dict): Main value measured by every check name. Checks without a value are
+        stored with NaN.\n
+
+    Raises:
+        OSError: If the snapshot could not be written or replaced.
+    """
+    values = values or {}
+    content = bytearray(HEADER.pack(MAGIC, VERSION, RECORD.size, len(outcomes), time.time()))
+    for name, outcome in outcomes.items():
+        value = values.get(name)
+        content += RECORD.pack(encode_name(name), STATUSES.index(outcome.status),
+                               outcome.cached, math.nan if value is None else float(value),
+                               outcome.duration, outcome.timestamp)
+    # Every writer uses its own temporary file so concurrent runs don't mix their snapshots
+    temporary_filename = f'{filename}.{os.getpid()}.tmp'
+    try:
+        with open(temporary_filename, 'wb') as f:
+            f.write(content)
+        for attempt in range(REPLACE_ATTEMPTS):
+            try:
+                os.replace(temporary_filename, filename)
+                return
+            except PermissionError:
+                if attempt == REPLACE_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.05 * 2**attempt)
+    except OSError:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+
+
+def unpack_record(buffer, index):
+    """Returns the SnapshotRecord with the given index of a snapshot buffer."""
+    name, status, cached, value, duration, timestamp = RECORD.unpack_from(
+        buffer, HEADER.size + index * RECORD.size)
+    return SnapshotRecord(name.rstrip(b'\x00').decode('utf-8'), STATUSES[status], value,
+                          duration, timestamp, bool(cached))
+
+
+def map_snapshot(filename):
+    """
+    Maps the snapshot file into memory and checks its header.
+
+    Returns:
+        tuple: The mmap of the file, the number of records and the time it was written.
+
+    Raises:
+        ValueError: If the file is not a snapshot of this version or it is truncated.
+    """
+    with open(filename, 'rb') as f:
+        # The map keeps the file contents even if a new snapshot replaces the file
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, record_size, count, written = HEADER.unpack_from(buffer)
+    except struct.error:
+        buffer.close()
+        raise ValueError(f'{filename} is not a snapshot file')
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        buffer.close()
+        raise ValueError(f'{filename} is not a version {VERSION} snapshot file')
+    if len(buffer) < HEADER.size + count * RECORD.size:
+        buffer.close()
+        raise ValueError(f'{filename} is truncated')
+    return buffer, count, written
+
+
+def read_snapshot(filename):
+    """
+    Reads all the results of a snapshot file.
+
+    Returns:
+        tuple: The time the snapshot was written and a dictionary with the names of the
+        checks as keys and their SnapshotRecord as values, in the order they finished.
+
+    Raises:
+        ValueError: If the file is not a snapshot of this version or it is truncated.
+    """
+    buffer, count, written = map_snapshot(filename)
+    with buffer:
+        records = [unpack_record(buffer, index) for index in range(count)]
+    return written, {record.name: record for record in records}
+
+
+def read_check_result(filename, name):
+    """
+    Reads the result of a single check from a snapshot file without decoding the others.
+
+    Returns:
+        SnapshotRecord: The result of the check, or None if it is not in the snapshot.
+
+    Raises:
+        ValueError: If the file is not a snapshot of this version or it is truncated.
+    """
+    encoded_name = encode_name(name).ljust(NAME_SIZE, b'\x00')
+    buffer, count, _ = map_snapshot(filename)
+    with buffer:
+        for index in range(count):
+            offset = HEADER.size + index * RECORD.size
+            if buffer[offset:offset + NAME_SIZE] == encoded_name:
+                return unpack_record(buffer, index)
+    return None
+
+
+def main():
+    """Prints the results stored in a snapshot file."""
+    parser = argparse.ArgumentParser(description='Print the results of the last run stored in '
+                                                 'a snapshot file')
+    parser.add_argument('--snapshot', default='../../logs/snapshot.bin',
+                        help='Snapshot file written by main()')
+    args = parser.parse_args()
+
+    written, records = read_snapshot(args.snapshot)
+    print(f'{args.snapshot}: written {time.time() - written:.0f} secs ago')
+    print(f'{"check":<32} {"status":<18} {"value":>10} {"duration":>9} {"age":>8}')
+    for record in records.values():
+        cached = ' (cached)' if record.cached else ''
+        print(f'{record.name:<32} {record.status:<18} {record.value:10.2f} '
+              f'{record.duration:9.2f} {record.age:8.0f}{cached}')
+
+
+if __name__ == '__main__':
+    main()
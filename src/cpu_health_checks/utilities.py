@@ -5,20 +5,30 @@
 # Date: 2023-06-07
 # Filename: utilities.py
 # License: MIT License
+import concurrent.futures
+import contextlib
+import glob
 import heapq
+import http.client
+import json
 import logging
 import logging.handlers
 import os
 import platform
 import re
+import socket
 import subprocess
 import time
+import urllib.parse
 import urllib.request
 
 import numpy as np
+import psutil
 import yaml
 from tqdm import tqdm
 
+import cpu_health_checks.dns_client as dns_client
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -96,17 +106,21 @@ def get_input_params(function_params, function_values, config_file, config_mode)
     return input_values
 
 
-def run_command(command):
+def run_command(command, timeout=None):
     """
     Run a command in the shell and capture the output.
 
     Args:
         command (str): The command to run.
+        timeout (float): Maximum number of seconds the command can run, or None for no limit.
 
     Returns:
         CompletedProcess: The result of running the command.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command takes longer than timeout.
     """
-    return subprocess.run(command, shell=True, capture_output=True, text=True)
+    return subprocess.run(command, shell=True, capture_output=True, text=True, timeout=timeout)
 
 
 def print_message(message, new_line=True):
@@ -125,9 +139,12 @@ def print_error(message, new_line=True):
         print(bcolors.FAIL + message + bcolors.ENDC, end='')
 
 
-def print_warning(message):
+def print_warning(message, new_line=True):
     """ Print a warning message in yellow color."""
-    print(bcolors.WARNING + message + bcolors.ENDC)
+    if new_line:
+        print(bcolors.WARNING + message + bcolors.ENDC)
+    else:
+        print(bcolors.WARNING + message + bcolors.ENDC, end='')
 
 
 def print_and_log_result(result, message_passed, message_failed, logger):
@@ -143,37 +160,27 @@ def print_and_log_result(result, message_passed, message_failed, logger):
         logger.info(message_failed)
 
 
-def get_home_subfolder_info():
+def get_folder_size(folder, timeout=None):
     """
-    Get information about the home subfolders.
-
-    Returns:
-        dict: A dict containing the home subfolders names and sizes.
-    """
-    home = os.path.expanduser("~")
-    subfolders = [os.path.join(home, folder) for folder in os.listdir(home)
-                  if os.path.isdir(os.path.join(home, folder))]
-    subfolders_sizes = {folder: get_folder_size(folder) for folder in subfolders}
-
-    return subfolders_sizes
-
-
-def get_folder_size(folder):
-    """
-    Get the size of a folder in bytes.
+    Get the size of a folder in Gb.
 
     Args:
         folder (str): Path to the folder.
+        timeout (float): Maximum number of seconds the size command is allowed to run. If it is
+        None the command can run for as long as it needs.
 
     Returns:
-        int: Size of the folder in bytes.
+        float: Size of the folder in Gb.
+
+    Raises:
+        subprocess.TimeoutExpired: If the size command takes longer than timeout.
     """
     if os.name == 'nt':  # Windows
         folder = folder.replace('"', r'\"')  # Escape double quotes
         command = f'dir /s /a /q "{folder}" | find /i "File(s)"'
         try:
             output = subprocess.check_output(command, shell=True, universal_newlines=True,
-                                             stderr=subprocess.DEVNULL)
+                                             stderr=subprocess.DEVNULL, timeout=timeout)
             if len(output.split()) != 0:
                 # Here we remove the commas and convert to integer
                 size = int(output.split()[-2].replace(',', '')) / 2**20
@@ -186,31 +193,123 @@ def get_folder_size(folder):
             return 0
 
     else:  # Unix-like systems
-        command = 'du -sk "{}" 2>/dev/null || true'.format(folder)
-        output = subprocess.check_output(command, shell=True, universal_newlines=True)
+        # The command is run without a shell so that when the timeout expires the du process
+        # itself is killed instead of only the shell that launched it
+        output = subprocess.run(['du', '-sk', folder], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True,
+                                timeout=timeout).stdout
         if output.strip() == '':
             size = 0
         else:
-            size = int(output.split()[0]) / 2**20  # Convert to MB
+            size = int(output.split()[0]) / 2**20  # Convert from Kb to Gb
 
     return size
 
 
-def get_largest_subfolders(folders_to_print, subfolders_sizes):
+def get_subfolders(folder):
+    """Returns the list of paths of the subfolders directly inside folder."""
+    try:
+        with os.scandir(folder) as entries:
+            return [entry.path for entry in entries
+                    if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        return []
+
+
+def stream_largest_subfolders(subfolders, folders_to_print, deadline, max_workers):
     """
-    Get the largest subfolders based on their sizes.
+    Sizes the given subfolders concurrently and keeps only the largest ones.
+
+    Every subfolder is sized in a pool of max_workers threads and, as the sizes come in, they are
+    pushed into a min-heap that never holds more than folders_to_print elements, so the smallest
+    of the current candidates is the one discarded. If the deadline is reached before every
+    subfolder is sized, the pending ones are cancelled and the running ones are killed.
 
     Args:
-        folders_to_print (int): The number of folders to print.
-        subfolders_sizes (dict): A dictionary containing subfolder sizes.
+        subfolders (list): Paths of the subfolders to size.\n
+        folders_to_print (int): The number of largest subfolders to keep.\n
+        deadline (float): Value of time.monotonic() after which the sizing stops.\n
+        max_workers (int): Number of subfolders sized at the same time.\n
 
     Returns:
-        list: A list of tuples containing the largest subfolders and their sizes.
+        tuple: The list of (subfolder, size in Gb) tuples of the largest subfolders sorted from
+        largest to smallest, and a boolean that is True if every subfolder was sized in time.
     """
-    return heapq.nlargest(folders_to_print, subfolders_sizes.items(), key=lambda item: item[1])
 
+    def size_before_deadline(folder):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired('du', 0)
+        return get_folder_size(folder, timeout=remaining)
+
+    largest = []
+    complete = True
+    if folders_to_print == 0 or len(subfolders) == 0:
+        return largest, complete
 
-def downloads_file(url, block_size, max_attempts, logger, track_progress):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(size_before_deadline, folder): folder for folder in subfolders}
+    try:
+        for future in concurrent.futures.as_completed(futures,
+                                                      timeout=max(deadline - time.monotonic(),
+                                                                  0)):
+            try:
+                item = (future.result(), futures[future])
+            except (subprocess.TimeoutExpired, OSError):
+                complete = False
+                continue
+            if len(largest) < folders_to_print:
+                heapq.heappush(largest, item)
+            elif item > largest[0]:
+                heapq.heappushpop(largest, item)
+    except concurrent.futures.TimeoutError:
+        complete = False
+        for future in futures:
+            future.cancel()
+    # Running sizes are bounded by their own timeout so there is no need to wait for them
+    executor.shutdown(wait=False)
+
+    return [(folder, size) for size, folder in sorted(largest, reverse=True)], complete
+
+
+def get_largest_subfolders_bounded(folder, folders_to_print, time_budget, max_workers,
+                                   drill_down_depth):
+    """
+    Gets the largest subfolders of a folder within a time budget.
+
+    The subfolders are sized with stream_largest_subfolders, and then the analysis drills down
+    into the largest subfolder found, repeating the process drill_down_depth times. If the time
+    budget runs out the results found so far are returned and marked as partial.
+
+    Args:
+        folder (str): Path to the folder to analyze.\n
+        folders_to_print (int): The number of largest subfolders to return on each level.\n
+        time_budget (float): Maximum number of seconds used for the whole analysis.\n
+        max_workers (int): Number of subfolders sized at the same time.\n
+        drill_down_depth (int): Number of times the analysis recurses into the largest
+        subfolder found.\n
+
+    Returns:
+        tuple: The list of (subfolder, size in Gb, depth) tuples of the largest subfolders, and
+        a boolean that is True if the analysis was completed within the time budget.
+    """
+    deadline = time.monotonic() + time_budget
+    largest_subfolders = []
+    complete = True
+    for depth in range(drill_down_depth + 1):
+        largest, level_complete = stream_largest_subfolders(get_subfolders(folder),
+                                                            folders_to_print, deadline,
+                                                            max_workers)
+        largest_subfolders += [(subfolder, size, depth) for subfolder, size in largest]
+        complete = complete and level_complete
+        if not level_complete or len(largest) == 0:
+            break
+        folder = largest[0][0]  # The next level analyzes the largest subfolder found
+
+    return largest_subfolders, complete
+
+
+def downloads_file(url, block_size, max_attempts, logger, track_progress, timeout=None):
     """
     Performs a null download of the file in the url.
 
@@ -218,13 +317,15 @@ def downloads_file(url, block_size, max_attempts, logger, track_progress):
     connection.
     If it doesn't work it returns False and logs an error. If it succeeds returns True
     If track_progress is True then it displays a progress bar while downloading.
+    If timeout is not None, any connection or read blocked for more than timeout seconds makes
+    the attempt (or the download) fail instead of hanging.
     """
     attempt = 1
     while attempt <= max_attempts:
         try:
-            response = urllib.request.urlopen(url)
+            response = urllib.request.urlopen(url, timeout=timeout)
             break
-        except (urllib.error.URLError, ConnectionResetError):
+        except (urllib.error.URLError, ConnectionResetError, socket.timeout):
             if attempt == max_attempts:
                 print_error(f'Failed to establish connection after '
                             f'{max_attempts} attempts', logger)
@@ -241,26 +342,204 @@ def downloads_file(url, block_size, max_attempts, logger, track_progress):
         progress_bar = tqdm(total=file_size, unit='B', unit_scale=True, ncols=80)
 
     # Here we download the file into dev/null splitting in it into blocks and breaking when is over
-    with open(os.devnull, 'wb') as file:
-        while True:
-            buffer = response.read(block_size)
-            if not buffer:
-                break
-            file.write(buffer)
+    try:
+        with open(os.devnull, 'wb') as file:
+            while True:
+                buffer = response.read(block_size)
+                if not buffer:
+                    break
+                file.write(buffer)
+                if track_progress:
+                    progress_bar.update(len(buffer))
+    except (socket.timeout, ConnectionResetError):
+        print_error(f'Download from {url} stalled for more than {timeout} secs')
+        logger.error(f'Download from {url} stalled for more than {timeout} secs')
+        return False
+    finally:
+        response.close()
+        if track_progress:
+            progress_bar.close()
+    return True
+
+
+def uploads_file(url, upload_size, block_size, max_attempts, logger, track_progress,
+                 timeout=None):
+    """
+    Uploads upload_size bytes of generated data to the url with a POST request.
+
+    The data is generated and sent block by block so the payload is never held in memory, trying
+    (max_attempts) of times to establish connection and send it.
+    If it doesn't work it returns False and logs an error. If it succeeds returns True
+    If track_progress is True then it displays a progress bar while uploading.
+    If timeout is not None, any connection or send blocked for more than timeout seconds makes
+    the attempt fail instead of hanging.
+    """
+    parsed_url = urllib.parse.urlsplit(url)
+    if parsed_url.scheme == 'https':
+        connection_class = http.client.HTTPSConnection
+    else:
+        connection_class = http.client.HTTPConnection
+    path = parsed_url.path or '/'
+    if parsed_url.query:
+        path += '?' + parsed_url.query
+    block = b'\0' * block_size
+
+    attempt = 1
+    while attempt <= max_attempts:
+        # In the definitive upload test we create a progress bar and updated accordingly
+        if track_progress:
+            progress_bar = tqdm(total=upload_size, unit='B', unit_scale=True, ncols=80)
+        connection = connection_class(parsed_url.netloc, timeout=timeout)
+        try:
+            connection.putrequest('POST', path)
+            connection.putheader('Content-Type', 'application/octet-stream')
+            connection.putheader('Content-Length', str(upload_size))
+            connection.endheaders()
+            # Here we send the data splitting in it into blocks until the whole size is sent
+            bytes_left = upload_size
+            while bytes_left > 0:
+                buffer = block if bytes_left >= block_size else block[:bytes_left]
+                connection.send(buffer)
+                bytes_left -= len(buffer)
+                if track_progress:
+                    progress_bar.update(len(buffer))
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 300:
+                print_error(f'Upload to {url} failed with HTTP status {response.status}')
+                logger.error(f'Upload to {url} failed with HTTP status {response.status}')
+                return False
+            return True
+        except (OSError, http.client.HTTPException):
+            if attempt == max_attempts:
+                print_error(f'Failed to upload the data after {max_attempts} attempts')
+                logger.error(f'Failed to upload the data after {max_attempts} attempts')
+                return False
+            # Wait more every time before retrying
+            print_warning(f'Trying to establish connection again after {2 * attempt} seconds')
+            time.sleep(2 * attempt)
+            attempt += 1
+        finally:
+            connection.close()
             if track_progress:
-                progress_bar.update(len(buffer))
+                progress_bar.close()
 
-    response.close()
-    if track_progress:
-        progress_bar.close()
-    return True
 
+def sample_interface_counters(window, interval):
+    """
+    Passively measures the traffic of the network interfaces from their counters.
 
-def handle_final_download_test(logs_folder, speed_log_filename, size, download_time,
-                               download_speed_mbps, minimum_previous_tests, std_deviations_limit,
-                               speed_min_mbps):
+    The counters of every interface that is up (excluding loopbacks) are sampled every
+    'interval' seconds during 'window' seconds, without generating any traffic.
+
+    Args:
+        window (float): Number of seconds during which the counters are sampled.\n
+        interval (float): Number of seconds between samples.\n
+
+    Returns:
+        dict: Dictionary whose keys are the interface names and the values dictionaries with
+        the mean and peak received and sent throughput in Mb/s ('recv_mbps', 'recv_peak_mbps',
+        'sent_mbps', 'sent_peak_mbps'), the peak utilization of the link as a percentage of
+        its speed ('utilization_percent', None if the speed is unknown), the number of packets
+        sent and received ('packets'), and the percentage of them with errors ('error_percent')
+        or dropped ('drop_percent').
+    """
+    interfaces_stats = psutil.net_if_stats()
+    interfaces = [name for name, stats in interfaces_stats.items()
+                  if stats.isup and 'loopback' not in getattr(stats, 'flags', '')
+                  and not name.lower().startswith(('lo', 'loopback'))]
+
+    first = previous = psutil.net_io_counters(pernic=True)
+    start_time = previous_time = time.monotonic()
+    peaks = {name: [0.0, 0.0] for name in interfaces}
+    while previous_time - start_time < window:
+        time.sleep(interval)
+        current = psutil.net_io_counters(pernic=True)
+        current_time = time.monotonic()
+        elapsed = current_time - previous_time
+        for name in interfaces:
+            if name in current and name in previous:
+                recv_mbps = (current[name].bytes_recv - previous[name].bytes_recv) / elapsed
+                sent_mbps = (current[name].bytes_sent - previous[name].bytes_sent) / elapsed
+                peaks[name][0] = max(peaks[name][0], recv_mbps / 2**20)
+                peaks[name][1] = max(peaks[name][1], sent_mbps / 2**20)
+        previous, previous_time = current, current_time
+
+    elapsed = previous_time - start_time
+    interfaces_info = {}
+    for name in interfaces:
+        if name not in first or name not in previous:
+            continue
+        start, end = first[name], previous[name]
+        packets = (end.packets_recv - start.packets_recv) + (end.packets_sent - start.packets_sent)
+        errors = (end.errin - start.errin) + (end.errout - start.errout)
+        drops = (end.dropin - start.dropin) + (end.dropout - start.dropout)
+        # The link speed is given in Mbits/s and throughputs in Mb/s (megabytes per second)
+        speed = interfaces_stats[name].speed
+        utilization = 100 * max(peaks[name]) * 8 * 2**20 / (speed * 10**6) if speed else None
+        interfaces_info[name] = {
+            'recv_mbps': (end.bytes_recv - start.bytes_recv) / elapsed / 2**20,
+            'recv_peak_mbps': peaks[name][0],
+            'sent_mbps': (end.bytes_sent - start.bytes_sent) / elapsed / 2**20,
+            'sent_peak_mbps': peaks[name][1],
+            'utilization_percent': utilization,
+            'packets': packets,
+            'error_percent': 100 * errors / packets if packets else 0.0,
+            'drop_percent': 100 * drops / packets if packets else 0.0}
+    return interfaces_info
+
+
+def evaluate_passive_throughput(interfaces_info, speed_min_mbps, max_error_percent,
+                                min_packets=1000):
+    """
+    Decides if the passively measured traffic is enough to evaluate the download speed.
+
+    The measurement is conclusive if some interface with at least min_packets packets in the
+    window has a percentage of packets with errors or dropped above max_error_percent (the
+    check fails, while a few errors on a quiet interface are not conclusive), or if some
+    interface received traffic at a peak speed of at least speed_min_mbps (the check passes
+    since the connection proved able to reach the minimum speed). Otherwise it is inconclusive
+    and the speed has to be measured actively.
+
+    Returns:
+        tuple: The result (True, False, or None if inconclusive) and a message explaining it.
+    """
+    for name, info in interfaces_info.items():
+        if (info['packets'] >= min_packets
+                and max(info['error_percent'], info['drop_percent']) > max_error_percent):
+            return False, (f'Interface {name} has {info["error_percent"]:.2f}% of packets with '
+                           f'errors and {info["drop_percent"]:.2f}% dropped')
+
+    if len(interfaces_info) == 0:
+        return None, 'No active network interfaces found to measure passively'
+    name, info = max(interfaces_info.items(), key=lambda item: item[1]['recv_peak_mbps'])
+    message = (f'Passively observed a peak download speed of {info["recv_peak_mbps"]:.3f}Mb/s '
+               f'(average {info["recv_mbps"]:.3f}Mb/s) on interface {name}')
+    if info['utilization_percent'] is not None:
+        message += f' using {info["utilization_percent"]:.1f}% of the link'
+    if info['recv_peak_mbps'] >= speed_min_mbps:
+        return True, message
+    return None, message + ', which is not enough to evaluate the speed'
+
+
+def is_statistical_outlier(value, mean, std, std_deviations_limit, high_outliers=False):
+    """
+    Returns True if the value is more than std_deviations_limit standard deviations away from the
+    mean, below it (e.g. speeds) or above it if high_outliers is True (e.g. latencies).
+
+    It works element-wise on numpy arrays, so the backtest module evaluates whole histories and
+    grids of limits with the same rule used by the checks.
     """
-    Handles the result of the download used to measure speed.
+    if high_outliers:
+        return value > mean + std_deviations_limit * std
+    return value < mean - std_deviations_limit * std
+
+
+def handle_final_speed_test(logs_folder, speed_log_filename, size, transfer_time, speed_mbps,
+                            minimum_previous_tests, std_deviations_limit, speed_min_mbps,
+                            test_name='Download', register_retention_days=0):
+    """
+    Handles the result of the download (or upload) used to measure speed.
 
     This function stores the value in the speed logs, and checks if the speed is below the absolute
     minimum threshold or if it is too slow compared to usual values obtained if there are enough
@@ -270,53 +549,52 @@ def handle_final_download_test(logs_folder, speed_log_filename, size, download_t
     Args:
         logs_folder (str): The folder to store the log files.\n
         speed_log_filename (str): The name of the speed log file.\n
-        size (str): The size of the file downloaded to measure speed.\n
-        download_time (float): The download time in seconds.\n
-        download_speed_mbps (float): The download speed in Mbps.\n
+        size (str): The size of the file transferred to measure speed.\n
+        transfer_time (float): The transfer time in seconds.\n
+        speed_mbps (float): The transfer speed in Mbps.\n
         minimum_previous_tests (int): The minimum number of previous tests required to compare
         current results with results usually obtained.\n
         std_deviations_limit (int): The number of standard deviations used for comparison.
-        If the current download speed is less than the average speed minus
+        If the current speed is less than the average speed minus
         'std_deviations_limit' times the standard deviation of the speed, this function returns
         False which implied that check_download_speed will not pass.\n
-        speed_min_mbps (float): The minimum download speed threshold in Mbps.\n
+        speed_min_mbps (float): The minimum speed threshold in Mbps.\n
+        test_name (str): The kind of transfer measured ('Download' or 'Upload') used in the
+        register header and the messages.\n
+        register_retention_days (int): Number of days the rows of the register are kept. Older
+        rows are rolled into the daily aggregates register (see load_speed_register). If it is 0
+        all the rows are kept.\n
 
     Returns:
         bool: True if there is an error, False otherwise.
     """
 
     speed_log_filename = f'{logs_folder}/{speed_log_filename}'
-    log_file_exits = os.path.isfile(speed_log_filename)
-    local_time = time.localtime(time.time())
-
-    # If the file doesnt exist yet we create the header and write the results in it
-    # if not it appends the results to the current file
-    if log_file_exits:
-        speed_log = open(speed_log_filename, 'a')
-    else:
-        speed_log = open(speed_log_filename, 'w')
-        speed_log.write('Year  Month  Day  HH:MM  Download_Time[s]  Download_Speed[Mb/s]')
-
-    # Here results of the speed download test are written in the speed log along with a timestamp
-    speed_log.write('\n' + time.strftime("%Y     %m   %d  %H:%M", local_time))
-    speed_log.write(f'{download_time:18.2f} {download_speed_mbps:21.2f}')
-    speed_log.close()
-
-    # Here we check how many download test have been performed before
-    speedlog = np.loadtxt(speed_log_filename, usecols=[0], skiprows=1)
-    if np.ndim(speedlog) == 0:  # If it is just one line we set line numbers manually
-        lines_in_log = 1
-    else:  # Otherwise we calculate it as the number of lines in the array
-        lines_in_log = len(speedlog)
+    # The register is locked so a compaction run by another process doesn't drop the new row
+    with lock_file(speed_log_filename):
+        # Here results of the speed test are written in the speed log along with a timestamp
+        append_register_row(
+            speed_log_filename,
+            f'Year  Month  Day  HH:MM  {test_name}_Time[s]  {test_name}_Speed[Mb/s]',
+            f'{transfer_time:18.2f} {speed_mbps:21.2f}')
+
+        # Here the register is read once (compacting it if it has old or duplicated rows) to
+        # know how many speed tests have been performed before and their statistics
+        register = load_speed_register(speed_log_filename, register_retention_days)
+    prior_speeds = register['speeds'][:-1]
+    counts = np.append(register['counts'], np.ones(prior_speeds.size))
+    means = np.append(register['means'], prior_speeds)
+    variances = np.append(register['variances'], np.zeros(prior_speeds.size))
+    lines_in_log = int(counts.sum()) + 1
 
     # If there are not enough previous test to perform a significant comparison between the current
     # results and prior results, then it doesn't make the comparison and prints a warning message
     enough_previous_tests = True
     if lines_in_log < minimum_previous_tests + 1:
         enough_previous_tests = False
-        print_warning(f'There are not enough prior download tests ({lines_in_log - 1} out of a '
-                      f'minimum of {minimum_previous_tests}) to compare the current results with '
-                      f'the usual value')
+        print_warning(f'There are not enough prior {test_name.lower()} tests '
+                      f'({lines_in_log - 1} out of a minimum of {minimum_previous_tests}) to '
+                      f'compare the current results with the usual value')
 
     # If there are enough previous test to perform a significant comparison between the current
     # results and prior results it checks whether the current result is less than the average
@@ -326,10 +604,11 @@ def handle_final_download_test(logs_folder, speed_log_filename, size, download_t
 
     if enough_previous_tests:
 
-        prior_speeds = np.loadtxt(speed_log_filename, usecols=[5], skiprows=1)[:-1]
-        avg_speed, speed_std = np.average(prior_speeds), np.std(prior_speeds)
+        # The raw prior speeds are combined with the daily aggregates as groups of one value,
+        # which gives exactly the average and standard deviation of all the prior speeds
+        avg_speed, speed_std = combine_group_statistics(counts, means, variances)
 
-        if download_speed_mbps < (avg_speed - std_deviations_limit * speed_std):
+        if is_statistical_outlier(speed_mbps, avg_speed, speed_std, std_deviations_limit):
             err_msg += (f' is too low compared to regular values '
                         f'(more than {std_deviations_limit} standard deviations '
                         f'less than average)')
@@ -340,7 +619,7 @@ def handle_final_download_test(logs_folder, speed_log_filename, size, download_t
     # Here it checks if the current result is below the absolute minimum threshold and if it is
     # it sets speed_below_absmin to True. It also adjusts the error message so that it has the
     # information of any of the types of failure possible (too low, or outlier).
-    if download_speed_mbps < speed_min_mbps:
+    if speed_mbps < speed_min_mbps:
         speed_below_absmin = True
         if speed_outlier is True:
             err_msg += (',\nand it is below the absolute minimum cut '
@@ -349,7 +628,7 @@ def handle_final_download_test(logs_folder, speed_log_filename, size, download_t
             err_msg += (f' is below the absolute minimum cut '
                         f'({speed_min_mbps:.1f} Mb/s)')
 
-    message_out1 = f'Download Speed: {download_speed_mbps:.2f} Mb/s'
+    message_out1 = f'{test_name} Speed: {speed_mbps:.2f} Mb/s'
 
     # If speed_outlier or speed_below_absmin are True then returns False
     if speed_outlier or speed_below_absmin:
@@ -359,6 +638,1091 @@ def handle_final_download_test(logs_folder, speed_log_filename, size, download_t
         return True
 
 
+def combine_group_statistics(counts, means, variances):
+    """
+    Returns the mean and standard deviation of the union of groups of values given the number of
+    values, the mean and the (population) variance of every group.
+    """
+    total = counts.sum()
+    mean = (counts * means).sum() / total
+    variance = (counts * (variances + (means - mean)**2)).sum() / total
+    return mean, variance**0.5
+
+
+def get_daily_register_filename(register_filename):
+    """Returns the filename of the daily aggregates of a speed register."""
+    return os.path.splitext(register_filename)[0] + '_daily.txt'
+
+
+def get_low_impact_register_filename(register_filename):
+    """Returns the filename of the speed register of the measurements of low impact mode."""
+    return os.path.splitext(register_filename)[0] + '_low_impact.txt'
+
+
+def read_daily_register(register_filename):
+    """
+    Reads the daily aggregates of a speed register written by load_speed_register.
+
+    Returns:
+        np.ndarray: One row per day with the Year, Month, Day, Count, Mean, Min, Max and
+        Variance columns, empty if the register has no daily aggregates.
+    """
+    daily_filename = get_daily_register_filename(register_filename)
+    if os.path.isfile(daily_filename):
+        with open(daily_filename, 'r') as f:
+            daily_lines = f.read().splitlines()[1:]
+        if daily_lines:
+            return np.loadtxt(daily_lines, ndmin=2)
+    return np.zeros((0, 8))
+
+
+def register_dates(rows):
+    """Returns the dates (as datetime64 days) of register rows starting with Year Month Day."""
+    year, month, day = rows[:, 0].astype(int), rows[:, 1].astype(int), rows[:, 2].astype(int)
+    # Integers are converted to datetime64 as the number of units since 1970-01-01
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    return months.astype('datetime64[D]') + (day - 1)
+
+
+@contextlib.contextmanager
+def lock_file(filename):
+    """
+    Holds an exclusive lock on filename + '.lock' while the block runs, so processes that
+    rewrite a file (e.g. the compaction of a register) don't lose what others append to it.
+    """
+    with open(filename + '.lock', 'a+') as f:
+        if os.name == 'nt':  # Windows
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # It retries for 10 seconds before raising OSError
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def write_file_atomically(filename, content):
+    """Writes the file replacing the previous one atomically, so readers never see it partial."""
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'w') as f:
+        f.write(content)
+    os.replace(temporary_filename, filename)
+
+
+def load_speed_register(register_filename, retention_days=0, today=None):
+    """
+    Loads a speed register and its daily aggregates, compacting them first if needed.
+
+    Rows older than retention_days are rolled into the daily aggregates register (one row per
+    day with the count, mean, min, max and variance of the speeds), duplicated rows are dropped,
+    and both files are rewritten atomically. The daily aggregates are written first, and raw
+    rows of days already aggregated are ignored, so a rewrite interrupted between both files
+    never counts a speed twice. This way the register only keeps retention_days of rows and the
+    daily register one row per day, while the statistics of all the speeds stay exact. Callers
+    that may run concurrently with other writers of the register have to hold its lock_file.
+
+    Args:
+        register_filename (str): Path of the speed register.\n
+        retention_days (int): Number of days the raw rows are kept. If it is 0 the register is
+        never compacted.\n
+        today (np.datetime64): Current date, by default the local date.\n
+
+    Returns:
+        dict: Dictionary with the arrays 'counts', 'means' and 'variances' of the daily
+        aggregates, and the 'speeds' of the raw rows in the order they were stored.
+    """
+    with open(register_filename, 'r') as f:
+        header = f.readline().rstrip('\n')
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    rows = np.loadtxt(lines, usecols=[0, 1, 2, 5], ndmin=2) if lines else np.zeros((0, 4))
+    dates = register_dates(rows)
+
+    daily_filename = get_daily_register_filename(register_filename)
+    daily = read_daily_register(register_filename)
+    daily_dates = register_dates(daily)
+    last_daily_date = daily_dates.max() if daily_dates.size else None
+
+    if today is None:
+        today = np.datetime64(time.strftime('%Y-%m-%d'))
+    cutoff = today - retention_days
+    # Raw rows of days already aggregated were kept by an interrupted compaction
+    aggregated = (dates <= last_daily_date if last_daily_date is not None
+                  else np.zeros(len(lines), dtype=bool))
+    old = (dates < cutoff) & ~aggregated
+    first_seen = {}
+    for number, line in enumerate(lines):
+        first_seen.setdefault(line, number)
+    duplicated = np.ones(len(lines), dtype=bool)
+    duplicated[list(first_seen.values())] = False
+
+    if retention_days > 0 and (old.any() or aggregated.any() or duplicated.any()):
+        old, aggregated = old & ~duplicated, aggregated | duplicated
+
+        # The old speeds are grouped by day and merged with the existing daily aggregates
+        new_dates, day_index = np.unique(dates[old], return_inverse=True)
+        old_speeds = rows[old, 3]
+        counts = np.bincount(day_index, minlength=new_dates.size)
+        means = np.bincount(day_index, weights=old_speeds, minlength=new_dates.size) / counts
+        variances = np.bincount(day_index, weights=(old_speeds - means[day_index])**2,
+                                minlength=new_dates.size) / counts
+        minimums = np.full(new_dates.size, np.inf)
+        maximums = np.full(new_dates.size, -np.inf)
+        np.minimum.at(minimums, day_index, old_speeds)
+        np.maximum.at(maximums, day_index, old_speeds)
+        years = new_dates.astype('datetime64[Y]').astype(int) + 1970
+        months = new_dates.astype('datetime64[M]').astype(int) % 12 + 1
+        days = (new_dates - new_dates.astype('datetime64[M]')).astype(int) + 1
+        daily = np.concatenate([daily, np.column_stack([years, months, days, counts, means,
+                                                        minimums, maximums, variances])])
+
+        # The means and variances are written with all their digits to keep the stats exact
+        unit = header.split('[')[-1].rstrip(']') if '[' in header else 'Mb/s'
+        daily_lines = [f'Year  Month  Day       Count  {"Mean[" + unit + "]":>24}  Min[{unit}]  '
+                       f'Max[{unit}]  {"Variance[" + unit + "^2]":>24}']
+        daily_lines += [f'{int(row[0])}     {int(row[1]):02}   {int(row[2]):02}  '
+                        f'{int(row[3]):10} {float(row[4])!r:>24} {row[5]:10.2f} '
+                        f'{row[6]:10.2f} {float(row[7])!r:>24}' for row in daily]
+        if new_dates.size:
+            write_file_atomically(daily_filename, '\n'.join(daily_lines) + '\n')
+        kept = ~old & ~aggregated
+        write_file_atomically(register_filename, header + ''.join(
+            '\n' + line for line, is_kept in zip(lines, kept) if is_kept))
+        rows, aggregated = rows[kept], np.zeros(int(kept.sum()), dtype=bool)
+
+    return {'counts': daily[:, 3], 'means': daily[:, 4], 'variances': daily[:, 7],
+            'speeds': rows[~aggregated, 3]}
+
+
+def handle_final_download_test(logs_folder, speed_log_filename, size, download_time,
+                               download_speed_mbps, minimum_previous_tests, std_deviations_limit,
+                               speed_min_mbps):
+    """Handles the result of the download used to measure speed (see handle_final_speed_test)."""
+    return handle_final_speed_test(logs_folder, speed_log_filename, size, download_time,
+                                   download_speed_mbps, minimum_previous_tests,
+                                   std_deviations_limit, speed_min_mbps, 'Download')
+
+
+def append_register_row(register_filename, header, row):
+    """
+    Appends a row to a register file preceded by the current timestamp.
+
+    If the register doesn't exist yet it is created with the given header first. Only the new
+    row is written so the cost doesn't depend on the size of the register.
+    """
+    local_time = time.localtime(time.time())
+    # If the file doesnt exist yet we create the header and write the results in it
+    # if not it appends the results to the current file
+    if os.path.isfile(register_filename):
+        register = open(register_filename, 'a')
+    else:
+        register = open(register_filename, 'w')
+        register.write(header)
+    register.write('\n' + time.strftime("%Y     %m   %d  %H:%M", local_time))
+    register.write(row)
+    register.close()
+
+
+def load_running_stats(stats_filename, register_filename, column):
+    """
+    Loads the running statistics (count, mean and sum of squared deviations) of a register.
+
+    The statistics are stored in a small json file next to the register so evaluating a new
+    value doesn't require reading the register. If the statistics file doesn't exist (or is
+    truncated) but the register does, the statistics are rebuilt once from the given column of
+    the register.
+    """
+    if os.path.isfile(stats_filename):
+        try:
+            with open(stats_filename, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass  # The statistics are rebuilt from the register
+
+    stats = {'count': 0, 'mean': 0.0, 'm2': 0.0}
+    if os.path.isfile(register_filename):
+        values = np.loadtxt(register_filename, usecols=[column], skiprows=1, ndmin=1)
+        for value in values:
+            update_running_stats(stats, float(value))
+    return stats
+
+
+def update_running_stats(stats, value):
+    """Updates in place the running statistics with a new value using Welford's algorithm."""
+    stats['count'] += 1
+    delta = value - stats['mean']
+    stats['mean'] += delta / stats['count']
+    stats['m2'] += delta * (value - stats['mean'])
+
+
+def save_running_stats(stats_filename, stats):
+    """Writes the running statistics replacing the previous file atomically."""
+    temporary_filename = stats_filename + '.tmp'
+    with open(temporary_filename, 'w') as f:
+        json.dump(stats, f)
+    os.replace(temporary_filename, stats_filename)
+
+
+def handle_final_latency_test(logs_folder, latency_log_filename, average_latency,
+                              minimum_previous_tests, std_deviations_limit):
+    """
+    Handles the average latency measured by check_fast_latency.
+
+    This function stores the value in the latency register and checks if it is too high compared
+    to the usual values of the host if there are enough previous tests to make a significant
+    comparison. The usual values are kept as running statistics updated with every test, so
+    storing and evaluating a new value costs the same no matter how long the history is.
+
+    Args:
+        logs_folder (str): The folder to store the register files.\n
+        latency_log_filename (str): The name of the latency register file.\n
+        average_latency (float): The average latency in milliseconds.\n
+        minimum_previous_tests (int): The minimum number of previous tests required to compare
+        current results with results usually obtained.\n
+        std_deviations_limit (float): The number of standard deviations used for comparison.
+        If the current latency is more than the average latency plus 'std_deviations_limit'
+        times the standard deviation of the latency, this function returns False.\n
+
+    Returns:
+        bool: True if the latency is not a high outlier, False otherwise.
+    """
+    latency_log_filename = f'{logs_folder}/{latency_log_filename}'
+    stats_filename = os.path.splitext(latency_log_filename)[0] + '_stats.json'
+    # The register is locked so the statistics of concurrent runs don't overwrite each other
+    with lock_file(latency_log_filename):
+        stats = load_running_stats(stats_filename, latency_log_filename, 4)
+
+        append_register_row(latency_log_filename, 'Year  Month  Day  HH:MM  Latency[ms]',
+                            f'{average_latency:13.2f}')
+
+        latency_outlier = False
+        if stats['count'] < minimum_previous_tests:
+            print_warning(f'There are not enough prior latency tests ({stats["count"]} out of a '
+                          f'minimum of {minimum_previous_tests}) to compare the current results '
+                          f'with the usual value')
+        else:
+            avg_latency, latency_std = stats['mean'], (stats['m2'] / stats['count'])**0.5
+            if is_statistical_outlier(average_latency, avg_latency, latency_std,
+                                      std_deviations_limit, high_outliers=True):
+                print_error(f'Latency: {average_latency:.2f} ms is too high compared to regular '
+                            f'values (more than {std_deviations_limit} standard deviations more '
+                            f'than average of {avg_latency:.2f} ms)')
+                latency_outlier = True
+
+        update_running_stats(stats, average_latency)
+        save_running_stats(stats_filename, stats)
+
+    return not latency_outlier
+
+
+def handle_battery_sample(logs_folder, battery_history_filename, percent, plugged,
+                          minimum_previous_tests, std_deviations_limit, now=None,
+                          max_sample_gap=6 * 3600, history_size=100):
+    """
+    Stores a battery sample and updates the charge rate estimate of its power state.
+
+    The charge rate (percentage points per hour, negative when draining) is measured between
+    this sample and the previous one if both have the same power state and were taken less than
+    max_sample_gap seconds apart. Every power state ('plugged' or 'unplugged') keeps running
+    statistics of its rates, updated incrementally, so the history file stays small no matter
+    how many samples were taken. Only the last history_size samples are kept. Chargers slow
+    down above about 80% of charge, so plugged rates ending above it are not stored, and only
+    the drain rate of the unplugged state is compared with its usual value.
+
+    Args:
+        logs_folder (str): The folder to store the battery history file.\n
+        battery_history_filename (str): The name of the battery history file.\n
+        percent (float): The battery charge percentage.\n
+        plugged (bool): True if the power is plugged.\n
+        minimum_previous_tests (int): The minimum number of previous rates of the power state
+        required to use the estimate and compare the current rate with it.\n
+        std_deviations_limit (float): The number of standard deviations used for comparison.
+        If the current rate is lower (drains faster) than the average rate minus
+        'std_deviations_limit' times its standard deviation, it is flagged as abnormal.\n
+        now (float): Time of the sample, by default time.time().\n
+
+    Returns:
+        dict: Dictionary with the current 'rate' (None if it couldn't be measured), the average
+        rate of the power state 'mean_rate' (None if there are not enough previous rates), and
+        'abnormal' set to True if the current rate is unplugged and a low outlier.
+    """
+    history_filename = os.path.join(logs_folder, battery_history_filename)
+    history = {'samples': [], 'rates': {}}
+    if os.path.isfile(history_filename):
+        try:
+            with open(history_filename, 'r') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            pass  # A truncated history only means the estimates start again
+    now = time.time() if now is None else now
+    state = 'plugged' if plugged else 'unplugged'
+    stats = history['rates'].setdefault(state, {'count': 0, 'mean': 0.0, 'm2': 0.0})
+
+    rate = None
+    if history['samples']:
+        last_time, last_percent, last_plugged = history['samples'][-1]
+        elapsed = now - last_time
+        # A battery charges slower and slower above about 80%, so those samples would bias
+        # the charging rate
+        tapering = plugged and percent > 80
+        if last_plugged == plugged and 60 <= elapsed <= max_sample_gap and not tapering:
+            rate = (percent - last_percent) / (elapsed / 3600)
+
+    info = {'rate': rate, 'mean_rate': None, 'abnormal': False}
+    if stats['count'] >= minimum_previous_tests:
+        info['mean_rate'] = stats['mean']
+        if rate is not None and not plugged:
+            rate_std = (stats['m2'] / stats['count'])**0.5
+            info['abnormal'] = bool(is_statistical_outlier(rate, stats['mean'], rate_std,
+                                                           std_deviations_limit))
+    if rate is not None:
+        update_running_stats(stats, rate)
+
+    history['samples'] = (history['samples'] + [[now, percent, plugged]])[-history_size:]
+    write_file_atomically(history_filename, json.dumps(history))
+    return info
+
+
+def find_cgroup(proc_cgroup_file='/proc/self/cgroup', mounts_file='/proc/self/mounts'):
+    """
+    Finds the cgroup folders limiting the CPU and memory of the current process.
+
+    It supports cgroup v1 (one hierarchy per controller) and cgroup v2 (unified hierarchy). When
+    both exist, the v1 hierarchies are used if the cpu or memory controllers are attached to
+    them.
+
+    Args:
+        proc_cgroup_file (str): File listing the cgroups of the process.\n
+        mounts_file (str): File listing the mounted file systems.\n
+
+    Returns:
+        dict or None: Dictionary with the cgroup 'version' (1 or 2) and the folders of the
+        'cpu', 'cpuacct' and 'memory' controllers (the same folder for version 2), or None if
+        the process is not in a cgroup (e.g. it is not running on Linux).
+    """
+    try:
+        with open(proc_cgroup_file) as f:
+            cgroup_lines = [line.rstrip('\n').split(':', 2) for line in f if line.count(':') >= 2]
+        with open(mounts_file) as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return None
+
+    v1_mount_points, v2_mount_point = {}, None
+    for mount in mounts:
+        if len(mount) < 4:
+            continue
+        if mount[2] == 'cgroup2':
+            v2_mount_point = mount[1]
+        elif mount[2] == 'cgroup':
+            for option in mount[3].split(','):
+                v1_mount_points[option] = mount[1]
+
+    def cgroup_folder(mount_point, path):
+        # Inside a container the cgroup namespace usually mounts the cgroup of the process as
+        # the root of the hierarchy, so the path is only appended if that folder exists
+        folder = os.path.join(mount_point, path.lstrip('/'))
+        return folder if os.path.isdir(folder) else mount_point
+
+    v1_paths = {}
+    for _, controllers, path in cgroup_lines:
+        for controller in controllers.split(','):
+            if controller in ['cpu', 'cpuacct', 'memory'] and controller in v1_mount_points:
+                v1_paths[controller] = cgroup_folder(v1_mount_points[controller], path)
+    if 'cpu' in v1_paths or 'memory' in v1_paths:
+        return {'version': 1, 'cpu': v1_paths.get('cpu'), 'cpuacct': v1_paths.get('cpuacct'),
+                'memory': v1_paths.get('memory')}
+
+    for _, controllers, path in cgroup_lines:
+        if controllers == '' and v2_mount_point is not None:
+            folder = cgroup_folder(v2_mount_point, path)
+            return {'version': 2, 'cpu': folder, 'cpuacct': folder, 'memory': folder}
+    return None
+
+
+def read_sysfs_file(folder, filename):
+    """Returns the content of a sysfs (or cgroup) file, or None if it can't be read."""
+    if folder is None:
+        return None
+    try:
+        with open(os.path.join(folder, filename)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_cgroup_stats(cgroup):
+    """
+    Reads the CPU and memory limits and usage of a cgroup found with find_cgroup.
+
+    Only a few small files are read so it is cheap enough to be sampled every second.
+
+    Returns:
+        dict: Dictionary with the CPU quota in number of CPUs ('cpu_quota', None if unlimited),
+        the CPU time used in microseconds ('usage_usec'), the number of scheduling periods
+        ('nr_periods') and how many of them were throttled ('nr_throttled'), the time throttled
+        in microseconds ('throttled_usec'), and the memory used and its limit in bytes
+        ('memory_current' and 'memory_max', None if unlimited). Values that can't be read are
+        None.
+    """
+    stats = {'cpu_quota': None, 'usage_usec': None, 'nr_periods': None, 'nr_throttled': None,
+             'throttled_usec': None, 'memory_current': None, 'memory_max': None}
+
+    if cgroup['version'] == 2:
+        cpu_max = read_sysfs_file(cgroup['cpu'], 'cpu.max')
+        if cpu_max is not None and not cpu_max.startswith('max'):
+            quota, period = cpu_max.split()
+            stats['cpu_quota'] = int(quota) / int(period)
+        cpu_stat = dict(line.split() for line in
+                        (read_sysfs_file(cgroup['cpu'], 'cpu.stat') or '').splitlines())
+        for key in ['usage_usec', 'nr_periods', 'nr_throttled', 'throttled_usec']:
+            if key in cpu_stat:
+                stats[key] = int(cpu_stat[key])
+        memory_current = read_sysfs_file(cgroup['memory'], 'memory.current')
+        memory_max = read_sysfs_file(cgroup['memory'], 'memory.max')
+    else:
+        quota = read_sysfs_file(cgroup['cpu'], 'cpu.cfs_quota_us')
+        period = read_sysfs_file(cgroup['cpu'], 'cpu.cfs_period_us')
+        if quota is not None and period is not None and int(quota) > 0:
+            stats['cpu_quota'] = int(quota) / int(period)
+        usage = read_sysfs_file(cgroup['cpuacct'], 'cpuacct.usage')
+        if usage is not None:
+            stats['usage_usec'] = int(usage) // 1000  # Converts from nanoseconds
+        cpu_stat = dict(line.split() for line in
+                        (read_sysfs_file(cgroup['cpu'], 'cpu.stat') or '').splitlines())
+        for key in ['nr_periods', 'nr_throttled']:
+            if key in cpu_stat:
+                stats[key] = int(cpu_stat[key])
+        if 'throttled_time' in cpu_stat:
+            stats['throttled_usec'] = int(cpu_stat['throttled_time']) // 1000
+        memory_current = read_sysfs_file(cgroup['memory'], 'memory.usage_in_bytes')
+        memory_max = read_sysfs_file(cgroup['memory'], 'memory.limit_in_bytes')
+
+    if memory_current is not None:
+        stats['memory_current'] = int(memory_current)
+    # cgroup v1 uses a huge number instead of 'max' to indicate there is no memory limit
+    if memory_max is not None and memory_max != 'max' and int(memory_max) < 2**60:
+        stats['memory_max'] = int(memory_max)
+    return stats
+
+
+def evaluate_cgroup_usage(before, after, elapsed, max_cpu_usage, max_throttled_percent,
+                          max_memory_percent):
+    """
+    Evaluates the CPU and memory usage of a cgroup relative to its own limits.
+
+    Args:
+        before (dict): Stats read with read_cgroup_stats at the start of the interval.\n
+        after (dict): Stats read with read_cgroup_stats at the end of the interval.\n
+        elapsed (float): Seconds between both reads.\n
+        max_cpu_usage (float): Maximum CPU usage as a percentage of the CPU quota.\n
+        max_throttled_percent (float): Maximum percentage of scheduling periods throttled.\n
+        max_memory_percent (float): Maximum memory usage as a percentage of the memory limit.\n
+
+    Returns:
+        tuple: True if the usage is within the limits and False otherwise, and the list of
+        messages describing the usage (and the reasons it failed).
+    """
+    result = True
+    messages = []
+    if after['cpu_quota'] is not None and None not in [before['usage_usec'],
+                                                       after['usage_usec']]:
+        used_cpus = (after['usage_usec'] - before['usage_usec']) / 10**6 / elapsed
+        cpu_usage = 100 * used_cpus / after['cpu_quota']
+        messages.append(f'Container CPU usage is {cpu_usage:.2f}% of its quota of '
+                        f'{after["cpu_quota"]:.2f} CPUs')
+        result = result and cpu_usage <= max_cpu_usage
+
+    if None not in [before['nr_periods'], after['nr_periods'], before['nr_throttled'],
+                    after['nr_throttled']]:
+        periods = after['nr_periods'] - before['nr_periods']
+        throttled = after['nr_throttled'] - before['nr_throttled']
+        if periods > 0:
+            throttled_percent = 100 * throttled / periods
+            message = (f'Container was throttled in {throttled_percent:.2f}% of the scheduling '
+                       f'periods')
+            if None not in [before['throttled_usec'], after['throttled_usec']]:
+                throttled_secs = (after['throttled_usec'] - before['throttled_usec']) / 10**6
+                message += f' ({throttled_secs:.3f} secs throttled)'
+            messages.append(message)
+            result = result and throttled_percent <= max_throttled_percent
+
+    if after['memory_max'] is not None and after['memory_current'] is not None:
+        memory_percent = 100 * after['memory_current'] / after['memory_max']
+        messages.append(f'Container memory usage is {memory_percent:.2f}% of its limit of '
+                        f'{after["memory_max"] / 2**30:.2f} Gb')
+        result = result and memory_percent <= max_memory_percent
+
+    return result, messages
+
+
+def get_top_processes(top_n, interval=1):
+    """
+    Finds the processes using most CPU and memory.
+
+    The CPU usage of every process is the difference between two snapshots of its CPU times
+    taken interval seconds apart. The first snapshot only keeps the CPU time of every process,
+    and the second pass keeps the top_n processes in bounded heaps, so the memory used stays
+    small even on hosts running tens of thousands of processes.
+
+    Args:
+        top_n (int): Number of processes to report in every list.\n
+        interval (float): Seconds between both snapshots.\n
+
+    Returns:
+        tuple: Lists of the top_n processes by CPU usage and by resident memory, from the
+        largest to the smallest, as dicts with their 'pid', 'name', 'cpu_percent' (of a single
+        CPU, as shown by top) and 'rss_mb'.
+    """
+    def cpu_time(info):
+        return info['cpu_times'].user + info['cpu_times'].system
+
+    # The pid is reused after a process ends, so the create time identifies the process
+    first_snapshot = {}
+    for process in psutil.process_iter(attrs=['pid', 'create_time', 'cpu_times']):
+        if process.info['cpu_times'] is not None:
+            first_snapshot[process.info['pid']] = (process.info['create_time'],
+                                                   cpu_time(process.info))
+    time.sleep(interval)
+
+    top_cpu, top_rss = [], []
+    for process in psutil.process_iter(attrs=['pid', 'name', 'create_time', 'cpu_times',
+                                              'memory_info']):
+        info = process.info
+        if info['cpu_times'] is None or info['memory_info'] is None:
+            continue  # Access denied or the process ended in the middle of the pass
+        start_time, previous_cpu_time = first_snapshot.get(info['pid'], (None, 0))
+        if start_time != info['create_time']:
+            previous_cpu_time = 0  # Process started between both snapshots
+        entry = {'pid': info['pid'], 'name': info['name'],
+                 'cpu_percent': 100 * (cpu_time(info) - previous_cpu_time) / interval,
+                 'rss_mb': info['memory_info'].rss / 2**20}
+        for heap, key in [(top_cpu, 'cpu_percent'), (top_rss, 'rss_mb')]:
+            item = (entry[key], info['pid'], entry)
+            if len(heap) < top_n:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+    return ([entry for *_, entry in sorted(top_cpu, key=lambda item: item[:2], reverse=True)],
+            [entry for *_, entry in sorted(top_rss, key=lambda item: item[:2], reverse=True)])
+
+
+def format_top_processes(top_cpu, top_rss):
+    """Returns the lines of the report of the processes found with get_top_processes."""
+    lines = ['Processes using most CPU:']
+    lines += [f'    {entry["cpu_percent"]:6.1f}% CPU  {entry["rss_mb"]:9.1f} Mb  '
+              f'{entry["pid"]:>7}  {entry["name"]}' for entry in top_cpu]
+    lines.append('Processes using most memory:')
+    lines += [f'    {entry["rss_mb"]:9.1f} Mb  {entry["cpu_percent"]:6.1f}% CPU  '
+              f'{entry["pid"]:>7}  {entry["name"]}' for entry in top_rss]
+    return lines
+
+
+def read_sysfs_number(filename):
+    """Returns the number stored in a sysfs file, or None if it doesn't exist or can't be read."""
+    try:
+        with open(filename) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def read_throttle_counts(sysfs_folder='/sys'):
+    """
+    Reads how many times every CPU core has been throttled by the hardware since boot.
+
+    The counters of the thermal_throttle folder of sysfs (only available on x86) are increased
+    by the firmware whenever a core or its package is slowed down because of heat or power
+    limits, including the throttling done by the CPU itself (e.g. Intel HWP) that doesn't lower
+    the frequency limit of cpufreq.
+
+    Args:
+        sysfs_folder (str): Folder where sysfs is mounted.\n
+
+    Returns:
+        dict: Dictionary with the names of the cores as keys and the sum of their core and
+        package throttle counts as values, empty if the counters are not available.
+    """
+    counts = {}
+    for folder in sorted(glob.glob(os.path.join(sysfs_folder, 'devices/system/cpu/cpu[0-9]*',
+                                                'thermal_throttle'))):
+        values = [read_sysfs_number(os.path.join(folder, filename))
+                  for filename in ['core_throttle_count', 'package_throttle_count']]
+        if values != [None, None]:
+            counts[os.path.basename(os.path.dirname(folder))] = sum(
+                value for value in values if value is not None)
+    return counts
+
+
+def read_cpu_thermal_state(sysfs_folder='/sys'):
+    """
+    Reads the frequency of every CPU core and the temperature of every thermal sensor.
+
+    On Linux it reads the small cpufreq, thermal_throttle and thermal zone files of sysfs
+    directly in a single pass, which is cheap enough to be sampled at a high rate. Elsewhere it
+    falls back to psutil.cpu_freq(percpu=True) and psutil.sensors_temperatures(), which don't
+    tell the frequency limit, so it is reported as the maximum frequency.
+
+    Args:
+        sysfs_folder (str): Folder where sysfs is mounted.\n
+
+    Returns:
+        dict: Dictionary with the list of 'cores' as dicts with their 'cpu' name and their
+        'current_mhz', 'limit_mhz' (the maximum frequency currently allowed by the kernel,
+        lowered when throttling or by the power profile) and 'max_mhz' (the maximum frequency of
+        the hardware), the list of 'sensors' as dicts with their 'label', 'current' and
+        'critical' temperatures in Celsius ('critical' is None if unknown), and the
+        'throttle_counts' as returned by read_throttle_counts.
+    """
+    state = {'cores': [], 'sensors': [], 'throttle_counts': read_throttle_counts(sysfs_folder)}
+    cpufreq_folders = glob.glob(os.path.join(sysfs_folder, 'devices/system/cpu/cpu[0-9]*',
+                                             'cpufreq'))
+    thermal_folders = glob.glob(os.path.join(sysfs_folder, 'class/thermal/thermal_zone*'))
+
+    for folder in sorted(cpufreq_folders):
+        current, limit, maximum = [read_sysfs_number(os.path.join(folder, filename))
+                                   for filename in ['scaling_cur_freq', 'scaling_max_freq',
+                                                    'cpuinfo_max_freq']]
+        if None in [current, maximum]:
+            continue
+        limit = maximum if limit is None else limit
+        # sysfs stores the frequencies in kHz
+        state['cores'].append({'cpu': os.path.basename(os.path.dirname(folder)),
+                               'current_mhz': current / 1000, 'limit_mhz': limit / 1000,
+                               'max_mhz': maximum / 1000})
+
+    for folder in sorted(thermal_folders):
+        temperature = read_sysfs_number(os.path.join(folder, 'temp'))
+        if temperature is None:
+            continue
+        label = read_sysfs_file(folder, 'type') or os.path.basename(folder)
+        critical = None
+        for trip_type_file in glob.glob(os.path.join(folder, 'trip_point_*_type')):
+            if read_sysfs_file(folder, os.path.basename(trip_type_file)) == 'critical':
+                trip_temp = read_sysfs_number(trip_type_file.replace('_type', '_temp'))
+                if trip_temp is not None:
+                    critical = trip_temp / 1000
+        # sysfs stores the temperatures in millidegrees Celsius
+        state['sensors'].append({'label': label, 'current': temperature / 1000,
+                                 'critical': critical})
+
+    if not cpufreq_folders:
+        frequencies = psutil.cpu_freq(percpu=True) or []
+        state['cores'] = [{'cpu': f'cpu{number}', 'current_mhz': freq.current,
+                           'limit_mhz': freq.max, 'max_mhz': freq.max}
+                          for number, freq in enumerate(frequencies) if freq.max > 0]
+    if not thermal_folders and hasattr(psutil, 'sensors_temperatures'):
+        state['sensors'] = [{'label': sensor.label or name, 'current': sensor.current,
+                             'critical': sensor.critical}
+                            for name, sensors in psutil.sensors_temperatures().items()
+                            for sensor in sensors]
+    return state
+
+
+def evaluate_cpu_thermal_state(state, min_frequency_percent, critical_temperature_margin,
+                               throttle_counts=None):
+    """
+    Evaluates if the CPU is throttling because of heat or power limits.
+
+    When the hardware throttle counters are available a core is throttled if its counter
+    increased between the state and throttle_counts, and the frequency limit is not checked
+    because a lowered limit with working counters is a cap of the power profile, not
+    throttling. Otherwise a core is throttled if its frequency limit is too low.
+
+    Args:
+        state (dict): CPU state as returned by read_cpu_thermal_state.\n
+        min_frequency_percent (float): Minimum frequency allowed for every core, as a percentage
+        of its maximum frequency.\n
+        critical_temperature_margin (float): Minimum number of degrees Celsius every sensor has
+        to be below its critical temperature.\n
+        throttle_counts (dict): Throttle counts as returned by read_throttle_counts read some
+        time after the state, or None if they were not read again.\n
+
+    Returns:
+        tuple: True if no core is throttled and no sensor is near its critical temperature and
+        False otherwise, and the list of messages describing the problems found.
+    """
+    messages = []
+    for cpu, count in (throttle_counts or {}).items():
+        increase = count - state['throttle_counts'].get(cpu, count)
+        if increase > 0:
+            messages.append(f'{cpu} was throttled by the hardware {increase} times while '
+                            f'sampling')
+    for core in state['cores'] if not state['throttle_counts'] else []:
+        # The current frequency of an idle core is low to save power, so the core is only
+        # considered throttled if the maximum frequency allowed by the kernel is lowered
+        limit_percent = 100 * core['limit_mhz'] / core['max_mhz']
+        if limit_percent < min_frequency_percent:
+            messages.append(f'{core["cpu"]} is limited to {core["limit_mhz"]:.0f} MHz '
+                            f'({limit_percent:.1f}% of its {core["max_mhz"]:.0f} MHz maximum) '
+                            f'and runs at {core["current_mhz"]:.0f} MHz')
+    for sensor in state['sensors']:
+        if (sensor['critical'] is not None
+                and sensor['current'] >= sensor['critical'] - critical_temperature_margin):
+            messages.append(f'{sensor["label"]} is at {sensor["current"]:.1f} C, close to its '
+                            f'critical temperature of {sensor["critical"]:.1f} C')
+    return not messages, messages
+
+
+def version_key(version):
+    """Returns a key to sort versions like '6.1.0-13-amd64' comparing their numbers as integers."""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', version)]
+
+
+def get_kernel_versions(modules_folder='/lib/modules'):
+    """
+    Returns the running kernel version and the newest kernel version installed.
+
+    The installed kernels are the folders of modules_folder. If the running kernel is not one of
+    them (e.g. inside a container, which runs the kernel of the host) or there are none, the
+    newest installed version is None since they can't be compared.
+    """
+    running = platform.release()
+    try:
+        installed = [name for name in os.listdir(modules_folder)
+                     if os.path.isdir(os.path.join(modules_folder, name))]
+    except OSError:
+        installed = []
+    if running not in installed:
+        return running, None
+    return running, max(installed, key=version_key)
+
+
+def read_process_start_time(proc_folder, pid):
+    """Returns the start time of a process in clock ticks after boot, or None if it ended."""
+    try:
+        with open(os.path.join(proc_folder, pid, 'stat')) as f:
+            # The process name can contain spaces, so the fields are counted after it
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def get_file_id(path, file_ids):
+    """Returns the inode of a file (None if it doesn't exist) caching it in file_ids."""
+    if path not in file_ids:
+        try:
+            file_ids[path] = os.stat(path).st_ino
+        except OSError:
+            file_ids[path] = None
+    return file_ids[path]
+
+
+def read_process_libraries(proc_folder, pid, file_ids):
+    """
+    Reads the start time and the shared libraries mapped by a process from /proc.
+
+    Args:
+        proc_folder (str): Folder where procfs is mounted.\n
+        pid (str): Process id.\n
+        file_ids (dict): Cache of the inodes of the library files, shared by all the calls of a
+        scan so every library is only stat once.\n
+
+    Returns:
+        list or None: The start time of the process, the dict with the inode every mapped
+        library file had when it was read, and the list of mapped libraries that were already
+        deleted. None if the process ended or its mappings can't be read.
+    """
+    start_time = read_process_start_time(proc_folder, pid)
+    try:
+        with open(os.path.join(proc_folder, pid, 'maps')) as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    if start_time is None:
+        return None
+
+    libraries, deleted = {}, set()
+    for line in lines:
+        fields = line.split(maxsplit=5)
+        if len(fields) < 6 or not re.search(r'\.so(\.|$| )', fields[5]):
+            continue
+        path = fields[5].rstrip('\n')
+        if path.endswith(' (deleted)'):
+            deleted.add(path[:-len(' (deleted)')])
+        elif path not in libraries:
+            libraries[path] = get_file_id(path, file_ids)
+    return [start_time, libraries, sorted(deleted)]
+
+
+def scan_deleted_libraries(previous_scan, time_budget, max_workers, proc_folder='/proc'):
+    """
+    Finds the processes still using shared libraries deleted or replaced by an upgrade.
+
+    The mappings of the processes are read in parallel. Processes found in previous_scan with the
+    same start time are not read again: their libraries are stale if they were already deleted
+    or the library files were replaced since (they have a different inode now). The scan stops
+    when the time budget runs out, reporting the results found so far.
+
+    Args:
+        previous_scan (dict): Scan returned by a previous call, or an empty dict.\n
+        time_budget (float): Maximum number of seconds used to read the mappings.\n
+        max_workers (int): Number of processes read at the same time.\n
+        proc_folder (str): Folder where procfs is mounted.\n
+
+    Returns:
+        tuple: Dictionary with the pids using stale libraries and the list of those libraries,
+        the new scan to pass to the next call (it can be stored as json), and True if all the
+        processes were checked or False if the time budget ran out.
+    """
+    pids = [name for name in os.listdir(proc_folder) if name.isdigit()]
+    file_ids = {}
+
+    def scan_process(pid):
+        if (pid in previous_scan
+                and previous_scan[pid][0] == read_process_start_time(proc_folder, pid)):
+            return pid, previous_scan[pid]
+        return pid, read_process_libraries(proc_folder, pid, file_ids)
+
+    new_scan = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    try:
+        for pid in pids:
+            futures.append(executor.submit(scan_process, pid))
+        done, not_done = concurrent.futures.wait(futures, timeout=time_budget)
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    stale = {}
+    for future in done:
+        pid, process_scan = future.result()
+        if process_scan is None:
+            continue
+        new_scan[pid] = process_scan
+        _, libraries, deleted = process_scan
+        replaced = [path for path, file_id in libraries.items()
+                    if file_id is not None and get_file_id(path, file_ids) != file_id]
+        if deleted or replaced:
+            stale[pid] = sorted(deleted + replaced)
+    return stale, new_scan, not not_done
+
+
+def read_kernel_resources(proc_folder='/proc'):
+    """
+    Reads the usage and limits of the kernel resources that can be exhausted.
+
+    Only a few small files are read and the processes are not enumerated: the number of threads
+    (each one uses a pid) comes from loadavg, and the sockets holding local ports from sockstat.
+    The ephemeral ports used are an upper bound, since sockstat also counts the sockets of
+    listening servers and of ports outside ip_local_port_range.
+
+    Args:
+        proc_folder (str): Folder where procfs is mounted.\n
+
+    Returns:
+        dict: Dictionary with the 'file_descriptors', 'pids' and 'ephemeral_ports' resources that
+        could be read as keys, and tuples with their usage and limit as values.
+    """
+    def read(filename):
+        try:
+            with open(os.path.join(proc_folder, filename), 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    resources = {}
+    file_nr = read('sys/fs/file-nr')
+    if file_nr is not None:
+        allocated, _, maximum = (int(value) for value in file_nr.split())
+        resources['file_descriptors'] = (allocated, maximum)
+
+    loadavg, pid_max = read('loadavg'), read('sys/kernel/pid_max')
+    threads_max = read('sys/kernel/threads-max')
+    if loadavg is not None and pid_max is not None:
+        # The fourth field of loadavg is 'running/total' scheduling entities (threads)
+        threads = int(loadavg.split()[3].split('/')[1])
+        limits = [int(pid_max)] + ([int(threads_max)] if threads_max is not None else [])
+        resources['pids'] = (threads, min(limits))
+
+    port_range = read('sys/net/ipv4/ip_local_port_range')
+    sockstat = read('net/sockstat')
+    if port_range is not None and sockstat is not None:
+        low, high = (int(value) for value in port_range.split())
+        # Sockets in use and in TIME_WAIT hold a local port (sockstat6 lists the IPv6 ones),
+        # although not all of them are ephemeral ports
+        counters = {}
+        for line in (sockstat + (read('net/sockstat6') or '')).splitlines():
+            protocol, _, values = line.partition(':')
+            fields = values.split()
+            for name, value in zip(fields[::2], fields[1::2]):
+                key = (protocol.rstrip('6'), name)
+                counters[key] = counters.get(key, 0) + int(value)
+        used = sum(counters.get(key, 0) for key in [('TCP', 'inuse'), ('TCP', 'tw'),
+                                                    ('UDP', 'inuse')])
+        resources['ephemeral_ports'] = (used, high - low + 1)
+    return resources
+
+
+def sample_process_usage(whole_process=False):
+    """
+    Samples the resources used so far by this process, to be compared with
+    process_usage_delta.
+
+    The CPU time is the one of the calling thread (or of all the threads if whole_process is
+    True) plus the one of the finished child processes (e.g. du or ping), so checks running
+    concurrently in other threads are not counted unless whole_process is True. The
+    RSS and the disk I/O are those of the whole process, and the network bytes those of all
+    the network interfaces, since the operating systems don't count them per process. Values
+    not available in the platform (e.g. the I/O counters in macOS) are None.
+
+    Returns:
+        dict: Dictionary with the 'cpu_seconds', 'rss', 'read_bytes', 'write_bytes' and
+        'network_bytes' used so far.
+    """
+    process = psutil.Process()
+    cpu_times = process.cpu_times()
+    own_cpu = cpu_times.user + cpu_times.system if whole_process else time.thread_time()
+    sample = {'cpu_seconds': own_cpu + cpu_times.children_user + cpu_times.children_system,
+              'rss': process.memory_info().rss, 'read_bytes': None, 'write_bytes': None,
+              'network_bytes': None}
+    try:
+        io_counters = process.io_counters()
+        sample['read_bytes'] = io_counters.read_bytes
+        sample['write_bytes'] = io_counters.write_bytes
+    except (AttributeError, psutil.Error):  # Not available in macOS or without permissions
+        pass
+    net_counters = psutil.net_io_counters()
+    if net_counters is not None:
+        sample['network_bytes'] = net_counters.bytes_sent + net_counters.bytes_recv
+    return sample
+
+
+def process_usage_delta(before, after):
+    """
+    Computes the resources used between two samples taken with sample_process_usage.
+
+    Returns:
+        dict: Dictionary with the 'cpu_seconds' used, the 'rss_mb' at the end and its change
+        'rss_delta_mb', and the 'read_mb', 'write_mb' and 'network_mb' transferred (None if
+        they are not available).
+    """
+    def delta_mb(key):
+        if before[key] is None or after[key] is None:
+            return None
+        return (after[key] - before[key]) / 2**20
+
+    return {'cpu_seconds': after['cpu_seconds'] - before['cpu_seconds'],
+            'rss_mb': after['rss'] / 2**20, 'rss_delta_mb': delta_mb('rss'),
+            'read_mb': delta_mb('read_bytes'), 'write_mb': delta_mb('write_bytes'),
+            'network_mb': delta_mb('network_bytes')}
+
+
+def format_process_usage(usage):
+    """Returns a one line description of the resources returned by process_usage_delta."""
+    def megabytes(key):
+        return 'n/a' if usage[key] is None else f'{usage[key]:.1f} MB'
+
+    return (f'{usage["cpu_seconds"]:.2f} CPU secs, {usage["rss_mb"]:.1f} MB RSS '
+            f'({usage["rss_delta_mb"]:+.1f} MB), {megabytes("read_mb")} read, '
+            f'{megabytes("write_mb")} written, {megabytes("network_mb")} through the network '
+            f'interfaces')
+
+
+def get_load_per_cpu():
+    """Returns the load average of the last minute divided by the number of logical CPUs."""
+    return psutil.getloadavg()[0] / (psutil.cpu_count() or 1)
+
+
+def lower_process_priority(nice_increment=10):
+    """
+    Lowers the CPU priority (nice) and the I/O priority (ionice) of this process.
+
+    The CPU priority is lowered relative to the current one, so a process that was already
+    started with a low priority keeps it. Threads and child processes started afterwards
+    inherit the priorities, so it has to be called before starting the checks. Priorities the
+    platform doesn't support or the user is not allowed to change are left as they are.
+
+    Args:
+        nice_increment (int): Number added to the nice value of the process in Unix, up to 19.
+
+    Returns:
+        dict: Dictionary with the descriptions of the priorities that were lowered as keys and
+        their previous values as values, to restore them with restore_process_priority.
+    """
+    process = psutil.Process()
+    previous = {}
+    try:
+        nice = process.nice()
+        if os.name == 'posix':
+            new_nice = min(nice + nice_increment, 19)
+        elif nice in [psutil.IDLE_PRIORITY_CLASS, psutil.BELOW_NORMAL_PRIORITY_CLASS]:
+            new_nice = nice
+        else:
+            new_nice = psutil.BELOW_NORMAL_PRIORITY_CLASS
+        if new_nice != nice:
+            process.nice(new_nice)
+            previous['CPU priority'] = nice
+    except (AttributeError, psutil.Error):
+        pass
+    # Idle I/O class in Linux and very low I/O priority in Windows, not available in macOS
+    io_priority = getattr(psutil, 'IOPRIO_CLASS_IDLE', getattr(psutil, 'IOPRIO_VERYLOW', None))
+    if io_priority is not None:
+        try:
+            ionice = process.ionice()
+            if ionice != io_priority and getattr(ionice, 'ioclass', None) != io_priority:
+                process.ionice(io_priority)
+                previous['I/O priority'] = ionice
+        except (AttributeError, psutil.Error):
+            pass
+    return previous
+
+
+def restore_process_priority(previous):
+    """
+    Restores the priorities lowered by lower_process_priority.
+
+    Args:
+        previous (dict): Previous priorities returned by lower_process_priority.
+
+    Returns:
+        list: Descriptions of the priorities that could not be restored (e.g. Linux doesn't
+        allow unprivileged users to raise the CPU priority back).
+    """
+    process = psutil.Process()
+    not_restored = []
+    for description, value in previous.items():
+        try:
+            if description == 'CPU priority':
+                process.nice(value)
+            elif isinstance(value, int):  # Windows I/O priority
+                process.ionice(value)
+            else:  # Linux I/O class and value
+                process.ionice(value.ioclass, value.value)
+        except (AttributeError, ValueError, psutil.Error):
+            not_restored.append(description)
+    return not_restored
+
+
+def limit_transfer_sizes(sizes, max_megas):
+    """
+    Returns the first sizes (e.g. ['1MB', '10MB']) whose transfers add up to at most max_megas.
+    """
+    limited, total = [], 0
+    for size in sizes:
+        total += get_megas(size)
+        if total > max_megas:
+            break
+        limited.append(size)
+    return limited
+
+
 def get_megas(size):
     """
     Convert a string with bytes info into the number of corresponding mega bytes
@@ -416,24 +1780,70 @@ def check_arguments_validity(arguments):
     Returns:
         None
     """
-    arg_types = {'logs_folder': [str], 'min_gb': [int, float], 'min_percent_disk': [int, float],
-                 'folders_to_print': [int], 'max_cpu_usage': [int, float],
-                 'website_to_check': [str], 'max_connection_attempts': [int],
+    arg_types = {'logs_folder': [str], 'reboot_scan_filename': [str],
+                 'reboot_scan_time_budget': [int, float], 'reboot_scan_max_workers': [int],
+                 'min_gb': [int, float], 'min_percent_disk': [int, float],
+                 'folders_to_print': [int], 'folders_time_budget': [int, float],
+                 'folders_max_workers': [int], 'folders_drill_down_depth': [int],
+                 'max_cpu_usage': [int, float], 'max_throttled_percent': [int, float],
+                 'max_memory_percent': [int, float], 'top_processes': [int],
+                 'min_frequency_percent': [int, float], 'min_fd_headroom_percent': [int, float],
+                 'min_pid_headroom_percent': [int, float],
+                 'min_port_headroom_percent': [int, float],
+                 'critical_temperature_margin': [int, float], 'throttle_window': [int, float],
+                 'website_to_check': [str], 'dns_names_to_check': [list],
+                 'dns_resolvers': [list], 'dns_queries_per_name': [int],
+                 'dns_max_resolution_ms': [int, float], 'dns_max_failure_percent': [int, float],
+                 'max_connection_attempts': [int],
                  'file_sizes_to_download': [list], 'block_size': [int], 'sleep_time': [int, float],
-                 'speed_log_filename': [str], 'minimum_previous_tests': [int],
+                 'speed_log_filename': [str], 'register_retention_days': [int],
+                 'minimum_previous_tests': [int],
                  'std_deviations_limit': [int, float], 'speed_min_mbps': [int, float],
-                 'minimum_download_time': [int, float], 'latency_url': [str],
-                 'latency_limit_ms': [int, float], 'min_percent_battery': [int, float],
-                 'min_remaining_time_mins': [int, float]}
-
-    min_values = {'min_gb': 0, 'min_percent_disk': 0, 'folders_to_print': 0, 'max_cpu_usage': 0,
-                  'max_connection_attempts': 1, 'block_size': 1, 'sleep_time': 0,
-                  'minimum_previous_tests': 1, 'std_deviations_limit': 0,
-                  'speed_min_mbps': 0, 'minimum_download_time': 0,
-                  'latency_limit_ms': 0, 'min_percent_battery': 0, 'min_remaining_time_mins': 0}
-
-    max_values = {'min_percent_disk': 100, 'max_cpu_usage': 100, 'max_connection_attempts': 10,
-                  'sleep_time': 20, 'min_percent_battery': 100}
+                 'minimum_download_time': [int, float], 'passive_window': [int, float],
+                 'passive_interval': [int, float], 'max_interface_error_percent': [int, float],
+                 'upload_url': [str],
+                 'upload_speed_log_filename': [str], 'latency_url': [str],
+                 'latency_limit_ms': [int, float], 'latency_log_filename': [str],
+                 'min_percent_battery': [int, float],
+                 'min_remaining_time_mins': [int, float], 'battery_history_filename': [str],
+                 'max_parallel_checks': [int],
+                 'cache_filename': [str], 'snapshot_filename': [str],
+                 'cache_ttls': [dict], 'network_timeout': [int, float],
+                 'check_timeouts': [dict], 'run_time_budget': [int, float],
+                 'preflight_mode': [bool], 'preflight_budget': [int, float],
+                 'low_impact_mode': [bool], 'low_impact_max_load': [int, float],
+                 'low_impact_max_transfer_mb': [int, float],
+                 'low_impact_scan_budget': [int, float]}
+
+    min_values = {'reboot_scan_time_budget': 0, 'reboot_scan_max_workers': 1, 'min_gb': 0,
+                  'min_percent_disk': 0, 'folders_to_print': 0,
+                  'folders_time_budget': 0.1, 'folders_max_workers': 1,
+                  'folders_drill_down_depth': 0, 'max_cpu_usage': 0, 'max_throttled_percent': 0,
+                  'max_memory_percent': 0, 'top_processes': 0, 'min_frequency_percent': 0,
+                  'critical_temperature_margin': 0, 'throttle_window': 0,
+                  'min_fd_headroom_percent': 0,
+                  'min_pid_headroom_percent': 0, 'min_port_headroom_percent': 0,
+                  'dns_queries_per_name': 1, 'dns_max_resolution_ms': 0,
+                  'dns_max_failure_percent': 0, 'max_connection_attempts': 1, 'block_size': 1,
+                  'sleep_time': 0,
+                  'register_retention_days': 0, 'minimum_previous_tests': 1,
+                  'std_deviations_limit': 0,
+                  'speed_min_mbps': 0, 'minimum_download_time': 0, 'passive_window': 0,
+                  'passive_interval': 0.01, 'max_interface_error_percent': 0,
+                  'latency_limit_ms': 0, 'min_percent_battery': 0, 'min_remaining_time_mins': 0,
+                  'max_parallel_checks': 1, 'network_timeout': 1, 'run_time_budget': 0,
+                  'preflight_budget': 0, 'low_impact_max_load': 0,
+                  'low_impact_max_transfer_mb': 0, 'low_impact_scan_budget': 0.1}
+
+    max_values = {'reboot_scan_max_workers': 32, 'min_percent_disk': 100,
+                  'folders_max_workers': 32, 'max_cpu_usage': 100, 'dns_queries_per_name': 10,
+                  'dns_max_failure_percent': 100,
+                  'max_throttled_percent': 100, 'max_memory_percent': 100,
+                  'min_frequency_percent': 100, 'throttle_window': 5,
+                  'min_fd_headroom_percent': 100,
+                  'min_pid_headroom_percent': 100, 'min_port_headroom_percent': 100,
+                  'max_connection_attempts': 10, 'sleep_time': 20, 'min_percent_battery': 100,
+                  'max_parallel_checks': 16}
 
     for argument in arguments:
         value = arguments[argument]
@@ -450,3 +1860,6 @@ def check_arguments_validity(arguments):
             if value > max_values[argument]:
                 raise ValueError(f'Value {value} of argument {argument} is larger than allowed'
                                  f' maximum of {max_values[argument]}')
+
+    for resolver in arguments.get('dns_resolvers', []):
+        dns_client.parse_resolver(resolver)  # Raises ValueError if the port is not valid
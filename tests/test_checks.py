@@ -5,13 +5,47 @@
 # Date: 2023-06-07
 # Filename: test_checks.py
 # License: MIT License
+import json
+import logging
 import os
+import platform
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
+import numpy as np
+import psutil
+
+import cpu_health_checks
+import cpu_health_checks.analytics as analytics
+import cpu_health_checks.backtest as backtest
+import cpu_health_checks.cache as cache
 import cpu_health_checks.cpu_health as cpu_health
+import cpu_health_checks.dns_client as dns_client
+import cpu_health_checks.registry as registry
+import cpu_health_checks.sink_server as sink_server
+import cpu_health_checks.snapshot as snapshot
+import cpu_health_checks.utilities as utilities
 
 
 class SystemTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The logs, registers and cache written by the tests go to a temporary folder instead
+        # of the logs folder of the repository
+        cls.logs_folder = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        # The log files have to be closed before removing the folder (required on Windows)
+        logger = logging.getLogger('my_logger')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        cls.logs_folder.cleanup()
+
     def setUp(self):
         # Get the directory path of the current file
         current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -20,11 +54,60 @@ class SystemTestCase(unittest.TestCase):
         project_root = os.path.dirname(os.path.dirname(current_dir))
         self.config_file_path = os.path.join(project_root, 'cpu_health_checks', 'config',
                                              'configuration.yml')
-        self.logs_folder_path = os.path.join(project_root, 'cpu_health_checks', 'logs')
+        self.logs_folder_path = self.logs_folder.name
 
         self.cpu_check = cpu_health.CPUCheck(config_file=self.config_file_path,
                                              logs_folder=self.logs_folder_path)
 
+    def test_pending_reboot_scan(self):
+        """
+        Test case to check that a newer installed kernel is found, and that processes mapping
+        deleted libraries or libraries replaced after a previous scan are reported.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            running_kernel = platform.release()
+            for kernel in [running_kernel, '999.0.0']:
+                os.makedirs(os.path.join(folder, 'modules', kernel))
+            self.assertEqual(utilities.get_kernel_versions(os.path.join(folder, 'modules')),
+                             (running_kernel, '999.0.0'))
+
+            library = os.path.join(folder, 'libtest.so.1')
+            open(library, 'w').close()
+            maps = {'100': f'7f00-7f10 r-xp 00000000 fe:00 1 {library}\n',
+                    '200': '7f00-7f10 r-xp 00000000 fe:00 2 /usr/lib/libold.so.2 (deleted)\n'}
+            for pid, content in maps.items():
+                os.makedirs(os.path.join(folder, 'proc', pid))
+                with open(os.path.join(folder, 'proc', pid, 'stat'), 'w') as f:
+                    f.write(f'{pid} (a name) S' + ' 0' * 18 + ' 5000 0\n')
+                with open(os.path.join(folder, 'proc', pid, 'maps'), 'w') as f:
+                    f.write(content)
+
+            proc_folder = os.path.join(folder, 'proc')
+            stale, scan, complete = utilities.scan_deleted_libraries({}, 10, 2, proc_folder)
+            self.assertTrue(complete)
+            self.assertEqual(stale, {'200': ['/usr/lib/libold.so.2']})
+
+            # The process keeps the same start time, so it is not read again but the upgraded
+            # library is detected because the file was replaced
+            with open(library + '.new', 'w') as f:
+                f.write('new version')
+            os.replace(library + '.new', library)
+            stale, _, _ = utilities.scan_deleted_libraries(scan, 10, 2, proc_folder)
+            self.assertEqual(stale['100'], [library])
+
+    def test_pending_reboot_corrupt_scan(self):
+        """
+        Test case to check that a truncated reboot scan file is ignored and replaced by a new
+        scan instead of making the check crash.
+        """
+        scan_filename = os.path.join(self.logs_folder_path, self.cpu_check.reboot_scan_filename)
+        with open(scan_filename, 'w') as f:
+            f.write('{"100": [12')
+        self.assertIsInstance(self.cpu_check.check_no_pending_reboot(), bool)
+        if os.path.isdir('/proc/self'):
+            with open(scan_filename, 'r') as f:
+                self.assertIsInstance(json.load(f), dict)
+
     def test_disk_space_min_percent_hundred(self):
         """
         Test case to check if check_enough_disk_space
@@ -34,6 +117,672 @@ class SystemTestCase(unittest.TestCase):
         result = self.cpu_check.check_enough_disk_space()
         self.assertFalse(result, 'check_enough_disk_space is not False')
 
+    def test_largest_subfolders_bounded(self):
+        """
+        Test case to check that the bounded subfolder analysis returns the largest subfolders
+        sorted by size, drills down into the largest one, and marks as partial the results
+        obtained with no time budget.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            for name, size in [('small', 1), ('medium', 20), ('large', 40)]:
+                os.makedirs(os.path.join(folder, name, 'inner'))
+                with open(os.path.join(folder, name, 'inner', 'data'), 'wb') as file:
+                    file.write(b'0' * size * 2**12)
+
+            largest, complete = utilities.get_largest_subfolders_bounded(folder, 2, 30, 2, 1)
+            self.assertTrue(complete, 'Analysis was not completed')
+            self.assertEqual([(os.path.basename(path), depth) for path, _, depth in largest],
+                             [('large', 0), ('medium', 0), ('inner', 1)])
+
+            largest, complete = utilities.get_largest_subfolders_bounded(folder, 2, 0, 2, 1)
+            self.assertFalse(complete, 'Analysis without time budget was not marked as partial')
+
+    def test_latency_register_outliers(self):
+        """
+        Test case to check that the latency register flags a latency much higher than the
+        previous ones, that the running statistics match the values in the register, and that
+        they are rebuilt from it when their file is truncated.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            for latency in [10, 12, 11, 11]:
+                self.assertTrue(utilities.handle_final_latency_test(folder, 'latency.txt',
+                                                                    latency, 3, 2))
+            self.assertFalse(utilities.handle_final_latency_test(folder, 'latency.txt',
+                                                                 100, 3, 2))
+            stats = utilities.load_running_stats(os.path.join(folder, 'latency_stats.json'),
+                                                 os.path.join(folder, 'latency.txt'), 4)
+            self.assertEqual(stats['count'], 5)
+            self.assertAlmostEqual(stats['mean'], 28.8)
+            self.assertAlmostEqual(stats['m2'], 6338.8)
+
+            # A truncated statistics file is rebuilt from the register
+            with open(os.path.join(folder, 'latency_stats.json'), 'w') as f:
+                f.write('{"count": 5, "me')
+            rebuilt = utilities.load_running_stats(os.path.join(folder, 'latency_stats.json'),
+                                                   os.path.join(folder, 'latency.txt'), 4)
+            self.assertEqual(rebuilt['count'], 5)
+            self.assertAlmostEqual(rebuilt['mean'], 28.8)
+
+    def test_passive_throughput(self):
+        """
+        Test case to check that the passive measurement of the interfaces returns throughputs
+        and error rates, and that it is only conclusive when the observed traffic reached the
+        minimum speed or there are too many errors among enough packets.
+        """
+        interfaces_info = utilities.sample_interface_counters(0.2, 0.05)
+        for info in interfaces_info.values():
+            self.assertGreaterEqual(info['recv_peak_mbps'], info['recv_mbps'] - 1e-9)
+            self.assertGreaterEqual(info['error_percent'], 0)
+
+        info = {'recv_mbps': 2.0, 'recv_peak_mbps': 5.0, 'sent_mbps': 0.1, 'sent_peak_mbps': 0.2,
+                'utilization_percent': None, 'packets': 5000, 'error_percent': 0.0,
+                'drop_percent': 0.0}
+        self.assertTrue(utilities.evaluate_passive_throughput({'eth0': info}, 4, 1)[0])
+        self.assertIsNone(utilities.evaluate_passive_throughput({'eth0': info}, 10, 1)[0])
+        info['drop_percent'] = 5.0
+        self.assertFalse(utilities.evaluate_passive_throughput({'eth0': info}, 4, 1)[0])
+        # 1 dropped packet out of 20 on a quiet interface is not conclusive
+        info['packets'] = 20
+        self.assertIsNone(utilities.evaluate_passive_throughput({'eth0': info}, 10, 1)[0])
+
+    def test_network_available_stub_dns(self):
+        """
+        Test case to check that check_network_available queries the resolvers directly, passing
+        while one stub DNS server is fast and failing when all are too slow or the names don't
+        exist.
+        """
+        fast_server = dns_client.start_stub_dns_server({'www.example.com': '192.0.2.1',
+                                                        'ipv6.example.com': '2001:db8::1'})
+        slow_server = dns_client.start_stub_dns_server({'www.example.com': '192.0.2.1'},
+                                                       delay=0.2)
+        try:
+            self.assertEqual(dns_client.resolve('www.example.com', '127.0.0.1',
+                                                fast_server.getsockname()[1])[0], ['192.0.2.1'])
+            self.cpu_check.dns_names_to_check = ['www.example.com']
+            self.cpu_check.dns_max_resolution_ms = 100
+            self.cpu_check.dns_resolvers = [f'127.0.0.1:{fast_server.getsockname()[1]}']
+            self.assertTrue(self.cpu_check.check_network_available())
+            self.cpu_check.dns_resolvers.append(f'127.0.0.1:{slow_server.getsockname()[1]}')
+            self.assertTrue(self.cpu_check.check_network_available())
+            self.cpu_check.dns_resolvers = [f'127.0.0.1:{slow_server.getsockname()[1]}']
+            self.assertFalse(self.cpu_check.check_network_available())
+            self.cpu_check.dns_resolvers = [f'127.0.0.1:{fast_server.getsockname()[1]}']
+            self.cpu_check.dns_names_to_check = ['missing.example.com']
+            self.assertFalse(self.cpu_check.check_network_available())
+            # The sender is compared with the resolver in canonical form
+            self.assertEqual(dns_client.resolve('www.example.com', '127.000.000.001',
+                                                fast_server.getsockname()[1])[0], ['192.0.2.1'])
+            # Names without IPv4 addresses are resolved to their IPv6 ones
+            self.assertEqual(dns_client.resolve('ipv6.example.com', '127.0.0.1',
+                                                fast_server.getsockname()[1])[0], ['2001:db8::1'])
+        finally:
+            fast_server.close()
+            slow_server.close()
+
+    def test_system_resolvers(self):
+        """
+        Test case to check that the upstream resolvers of systemd-resolved replace its local
+        stub, and that resolvers with an invalid port are rejected with the configuration.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            resolv_conf = os.path.join(folder, 'resolv.conf')
+            upstream_resolv_conf = os.path.join(folder, 'upstream.conf')
+            with open(resolv_conf, 'w') as f:
+                f.write('# stub\nnameserver 127.0.0.53\noptions edns0\n')
+            self.assertEqual(dns_client.get_system_resolvers(resolv_conf, upstream_resolv_conf),
+                             ['127.0.0.53'])
+            with open(upstream_resolv_conf, 'w') as f:
+                f.write('nameserver 192.0.2.53\nnameserver 2001:db8::53\n')
+            self.assertEqual(dns_client.get_system_resolvers(resolv_conf, upstream_resolv_conf),
+                             ['192.0.2.53', '2001:db8::53'])
+
+        self.assertEqual(dns_client.parse_resolver('[2001:db8::53]:5353'), ('2001:db8::53', 5353))
+        self.assertEqual(dns_client.parse_resolver('2001:db8::53'), ('2001:db8::53', 53))
+        for resolver in ['192.0.2.53:dns', '192.0.2.53:70000', '[2001:db8::53]:x']:
+            with self.assertRaises(ValueError):
+                utilities.check_arguments_validity({'dns_resolvers': [resolver]})
+
+    def test_upload_speed_local_sink(self):
+        """
+        Test case to check that check_good_upload_speed streams the data to a local sink server,
+        passes, and stores the speed in the upload speed register.
+        """
+        server = sink_server.start_sink_server()
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                cpu_check = cpu_health.CPUCheck(config_file=self.config_file_path,
+                                                logs_folder=folder, sleep_time=0,
+                                                file_sizes_to_download=['1MB', '10MB'],
+                                                upload_url=(f'http://127.0.0.1:'
+                                                            f'{server.server_address[1]}/'))
+                self.assertTrue(cpu_check.check_good_upload_speed(),
+                                'check_good_upload_speed is not True')
+                register = os.path.join(folder, cpu_check.upload_speed_log_filename)
+                with open(register) as file:
+                    self.assertIn('Upload_Speed[Mb/s]', file.readline())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_speed_register_compaction(self):
+        """
+        Test case to check that old rows are rolled into daily aggregates, duplicated rows are
+        dropped, and the statistics of the compacted register are the same as the raw ones.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            register_filename = os.path.join(folder, 'register.txt')
+            rows = ['2023     05   29  13:51             10.18                  9.83',
+                    '2023     05   29  13:54            115.16                  8.89',
+                    '2023     05   29  13:54            115.16                  8.89',
+                    '2023     05   30  09:10             87.10                 11.76',
+                    '2023     06   05  09:10             87.10                  2.50']
+            with open(register_filename, 'w') as f:
+                f.write('Year  Month  Day  HH:MM  Download_Time[s]  Download_Speed[Mb/s]\n'
+                        + '\n'.join(rows))
+
+            register = utilities.load_speed_register(register_filename, 3,
+                                                     np.datetime64('2023-06-06'))
+            self.assertEqual(list(register['counts']), [2, 1])
+            self.assertEqual(list(register['speeds']), [2.5])
+            with open(register_filename, 'r') as f:
+                self.assertEqual(len(f.read().splitlines()), 2)
+            self.assertTrue(os.path.isfile(os.path.join(folder, 'register_daily.txt')))
+
+            counts = np.append(register['counts'], [1])
+            means = np.append(register['means'], register['speeds'])
+            variances = np.append(register['variances'], [0])
+            mean, std = utilities.combine_group_statistics(counts, means, variances)
+            speeds = [9.83, 8.89, 11.76, 2.5]
+            self.assertAlmostEqual(mean, np.average(speeds))
+            self.assertAlmostEqual(std, np.std(speeds))
+
+            # Reading it again doesn't change it
+            register = utilities.load_speed_register(register_filename, 3,
+                                                     np.datetime64('2023-06-06'))
+            self.assertEqual(list(register['counts']), [2, 1])
+
+            # The analytics and the backtest still see the compacted speeds
+            register = analytics.read_register(register_filename)
+            self.assertEqual(list(register['daily_counts']), [2, 1])
+            profiles = analytics.throughput_profiles(register)
+            # 2023-05-29 was a Monday and 2023-06-05 too
+            self.assertEqual(profiles['day_of_week']['count'][0], 3)
+            self.assertAlmostEqual(profiles['day_of_week']['mean'][0], (9.83 + 8.89 + 2.5) / 3)
+            values, _, prior = backtest.load_history(register_filename)
+            self.assertEqual(list(values), [2.5])
+            self.assertEqual(prior[0], 3)
+            self.assertAlmostEqual(prior[1], np.average(speeds[:3]))
+            self.assertAlmostEqual(prior[2], np.var(speeds[:3]))
+
+    def test_analytics(self):
+        """
+        Test case to check that the registers and logs are parsed, that the grouped percentiles
+        match np.percentile, and that the pass rate of every check is computed per day.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            register_filename = os.path.join(folder, 'register.txt')
+            with open(register_filename, 'w') as f:
+                f.write('Year  Month  Day  HH:MM  Download_Time[s]  Download_Speed[Mb/s]\n'
+                        '2023     05   29  13:51             10.18                  9.83\n'
+                        '2023     05   29  13:54            115.16                  8.89\n'
+                        '2023     06   02  09:10             87.10                 11.76\n')
+            register = analytics.read_register(register_filename)
+            self.assertEqual(str(register['timestamps'][2]), '2023-06-02T09:10')
+            profiles = analytics.throughput_profiles(register)
+            self.assertEqual(profiles['hour_of_day']['count'][13], 2)
+            # 2023-05-29 was a Monday and 2023-06-02 a Friday
+            self.assertEqual(list(profiles['day_of_week']['count']), [2, 0, 0, 0, 1, 0, 0])
+            np.testing.assert_allclose(profiles['hour_of_day']['percentiles'][13],
+                                       np.percentile([9.83, 8.89], analytics.PERCENTILES))
+            weighted = analytics.grouped_percentiles(np.array([0, 0, 1]), np.array([3., 1., 2.]),
+                                                     2, weights=np.array([2, 1, 3]))
+            np.testing.assert_allclose(weighted['percentiles'][0],
+                                       np.percentile([3, 3, 1], analytics.PERCENTILES))
+            self.assertEqual(list(weighted['count']), [3, 3])
+
+            log_filename = os.path.join(folder, 'host.log')
+            with open(log_filename, 'w') as f:
+                f.write('2023-06-06 13:04:46,698 - INFO - Running check_network_available\n'
+                        '2023-06-06 13:04:47,698 - INFO - Running check_good_download_speed\n'
+                        '2023-06-06 13:07:34,274 - INFO - Downloaded at an average speed of '
+                        '7.153Mb/s: 143.16 secs for a 1024.0 Mb file\n'
+                        '2023-06-07 13:04:46,698 - INFO - Running check_network_available\n'
+                        "2023-06-07 13:04:49,698 - ERROR - check_network_available didn't "
+                        'passed\n'
+                        '2023-06-07 13:04:49,699 - ERROR - check_good_download_speed was set '
+                        "to failed because check_network_available didn't pass\n")
+            log = analytics.read_log(log_filename)
+            trends = analytics.pass_rate_trends(log)
+            days, runs, pass_rates = trends['check_network_available']
+            self.assertEqual(list(runs), [1, 1])
+            self.assertEqual(list(pass_rates), [1, 0])
+            self.assertEqual(list(trends['check_good_download_speed'][2]), [1, 0])
+            summary = analytics.compare_hosts({'host': log})['host']
+            self.assertEqual(summary['runs'], 4)
+            self.assertAlmostEqual(summary['download_percentiles'][2], 7.153)
+
+    def test_backtest_matches_replay(self):
+        """
+        Test case to check that the vectorized backtest flags the same speeds as replaying the
+        history one test at a time with the rule of handle_final_speed_test.
+        """
+        speeds = np.random.default_rng(0).normal(10, 2, 200)
+        limits, minimums = [0.5, 1, 2], [1, 3, 50, 300]
+        flagged, evaluated = backtest.backtest_outlier_rule(speeds, limits, minimums)
+        for limit_index, limit in enumerate(limits):
+            for minimum_index, minimum in enumerate(minimums):
+                expected = sum(speeds[i] < np.average(speeds[:i]) - limit * np.std(speeds[:i])
+                               for i in range(minimum, speeds.size))
+                self.assertEqual(flagged[limit_index, minimum_index], expected)
+                self.assertEqual(evaluated[limit_index, minimum_index],
+                                 max(speeds.size - minimum, 0))
+
+        # Replaying the history after the first speeds were rolled into aggregates flags the same
+        prior = (50, np.average(speeds[:50]), np.var(speeds[:50]))
+        flagged_after, evaluated_after = backtest.backtest_outlier_rule(speeds[50:], limits,
+                                                                        minimums, prior=prior)
+        for minimum_index, minimum in enumerate(minimums):
+            start = max(minimum, 50)
+            self.assertEqual(evaluated_after[0, minimum_index], max(speeds.size - start, 0))
+            for limit_index, limit in enumerate(limits):
+                expected = sum(speeds[i] < np.average(speeds[:i]) - limit * np.std(speeds[:i])
+                               for i in range(start, speeds.size))
+                self.assertEqual(flagged_after[limit_index, minimum_index], expected)
+
+    def test_registry_scheduling(self):
+        """
+        Test case to check that the scheduler runs the cheapest checks first, skips the checks
+        that don't apply, and sets to failed without running them the checks depending on a
+        failed check, both sequentially and in parallel.
+        """
+        check_registry = registry.CheckRegistry()
+        check_registry.register(registry.CheckSpec('heavy', lambda checkobj: True,
+                                                   cost='heavy'))
+        check_registry.register(registry.CheckSpec('network', lambda checkobj: False,
+                                                   cost='network'))
+        check_registry.register(registry.CheckSpec('dependent', lambda checkobj: True,
+                                                   depends_on=['network']))
+        check_registry.register(registry.CheckSpec('cheap', lambda checkobj: True,
+                                                   skip_if=lambda checkobj: 'not needed'))
+        self.assertEqual(check_registry.execution_order(),
+                         ['cheap', 'network', 'dependent', 'heavy'])
+
+        for max_parallel in [1, 4]:
+            outcomes = registry.run_checks(self.cpu_check, check_registry, max_parallel)
+            self.assertEqual({name: outcome.status for name, outcome in outcomes.items()},
+                             {'cheap': 'skipped', 'network': 'failed',
+                              'dependent': 'dependency_failed', 'heavy': 'passed'})
+
+        check_registry.register(registry.CheckSpec('cheap', lambda checkobj: True,
+                                                   depends_on=['dependent']))
+        check_registry.register(registry.CheckSpec('network', lambda checkobj: True,
+                                                   depends_on=['cheap']))
+        with self.assertRaises(ValueError):
+            check_registry.execution_order()
+
+    def test_registry_timeouts(self):
+        """
+        Test case to check that a hung check is reported as timed out without stalling the run,
+        that its dependents are set to failed, that the checks not started when the run
+        time budget is exhausted are reported as timed out, and that the abandoned worker keeps
+        its slot and is told it was cancelled.
+        """
+        check_registry = registry.CheckRegistry()
+        check_registry.register(registry.CheckSpec('hung', lambda checkobj: time.sleep(30),
+                                                   timeout=0.2))
+        check_registry.register(registry.CheckSpec('dependent', lambda checkobj: True,
+                                                   depends_on=['hung']))
+        check_registry.register(registry.CheckSpec('slow', lambda checkobj: time.sleep(0.5),
+                                                   cost='heavy'))
+        check_registry.register(registry.CheckSpec('last', lambda checkobj: True,
+                                                   cost='heavy'))
+
+        start_time = time.time()
+        outcomes = registry.run_checks(self.cpu_check, check_registry,
+                                       check_timeouts={'slow': 10}, run_time_budget=0.5)
+        self.assertLess(time.time() - start_time, 5, 'The hung check stalled the run')
+        self.assertEqual({name: outcome.status for name, outcome in outcomes.items()},
+                         {'hung': 'timed_out', 'dependent': 'dependency_failed',
+                          'slow': 'timed_out', 'last': 'timed_out'})
+        # The worker of the hung check keeps its slot, so the slow check never started
+        self.assertIn('no worker was free', outcomes['slow'].message)
+
+        cancelled = []
+
+        def late_check(checkobj):
+            time.sleep(0.3)
+            cancelled.append(registry.is_cancelled())
+            return True
+
+        check_registry = registry.CheckRegistry()
+        check_registry.register(registry.CheckSpec('late', late_check, timeout=0.1))
+        check_registry.register(registry.CheckSpec('next', lambda checkobj: True,
+                                                   cost='heavy'))
+        outcomes = registry.run_checks(self.cpu_check, check_registry)
+        self.assertEqual([outcomes['late'].status, outcomes['next'].status],
+                         ['timed_out', 'passed'])
+        self.assertEqual(cancelled, [True])
+
+        # A check that crashes fails alone and its dependents are set to failed
+        def crash(checkobj):
+            raise RuntimeError('broken sensor')
+
+        check_registry = registry.CheckRegistry()
+        check_registry.register(registry.CheckSpec('crash', crash))
+        check_registry.register(registry.CheckSpec('after_crash', lambda checkobj: True,
+                                                   depends_on=['crash']))
+        check_registry.register(registry.CheckSpec('other', lambda checkobj: True))
+        outcomes = registry.run_checks(self.cpu_check, check_registry)
+        self.assertEqual({name: outcome.status for name, outcome in outcomes.items()},
+                         {'crash': 'failed', 'after_crash': 'dependency_failed',
+                          'other': 'passed'})
+        self.assertIn('RuntimeError: broken sensor', outcomes['crash'].message)
+
+        # A worker cancelled while it waited for the lease of another process doesn't measure
+        started = []
+        spec = registry.CheckSpec('leased', lambda checkobj: started.append(True) or True,
+                                  cacheable=True)
+        with tempfile.TemporaryDirectory() as folder:
+            result_cache = cache.ResultCache(os.path.join(folder, 'cache.sqlite'))
+            registry.worker_state.cancelled = threading.Event()
+            registry.worker_state.cancelled.set()
+            try:
+                with self.assertRaises(registry.CheckCancelled):
+                    registry.run_check(self.cpu_check, spec, {}, result_cache, {'leased': 60})
+            finally:
+                registry.worker_state.cancelled = None
+        self.assertEqual(started, [])
+
+    def test_low_impact_mode(self):
+        """
+        Test case to check that the resources used by every check run are measured, that heavy
+        checks are not started above the load limit, and that the transfers and scans are
+        bounded in low impact mode.
+        """
+        check_registry = registry.CheckRegistry()
+        check_registry.register(registry.CheckSpec('cheap', lambda checkobj: sum(range(10**5))))
+        check_registry.register(registry.CheckSpec('heavy', lambda checkobj: True,
+                                                   cost='heavy'))
+        with unittest.mock.patch.object(utilities, 'get_load_per_cpu', return_value=8):
+            outcomes = registry.run_checks(self.cpu_check, check_registry, max_heavy_load=2)
+        self.assertEqual(outcomes['heavy'].status, 'skipped')
+        self.assertIsNone(outcomes['heavy'].usage)
+        self.assertEqual(outcomes['cheap'].status, 'passed')
+        self.assertGreaterEqual(outcomes['cheap'].usage['cpu_seconds'], 0)
+        self.assertGreater(outcomes['cheap'].usage['rss_mb'], 0)
+
+        self.assertEqual(utilities.limit_transfer_sizes(['1MB', '10MB', '100MB'], 20),
+                         ['1MB', '10MB'])
+        self.assertEqual(utilities.limit_transfer_sizes(['1MB', '1GB'], 0.5), [])
+        # The CPU priority is lowered relative to the current one and restored afterwards
+        nice = psutil.Process().nice()
+        lowered = utilities.lower_process_priority(nice_increment=1)
+        try:
+            if 'CPU priority' in lowered and os.name == 'posix':
+                self.assertEqual(psutil.Process().nice(), min(nice + 1, 19))
+        finally:
+            not_restored = utilities.restore_process_priority(lowered)
+        if 'CPU priority' not in not_restored:
+            self.assertEqual(psutil.Process().nice(), nice)
+        cpu_check = cpu_health.CPUCheck(config_file=self.config_file_path,
+                                        logs_folder=self.logs_folder_path, low_impact_mode=True,
+                                        low_impact_scan_budget=1, low_impact_max_transfer_mb=0)
+        self.assertEqual((cpu_check.folders_time_budget, cpu_check.folders_max_workers), (1, 1))
+        self.assertEqual(cpu_check.reboot_scan_max_workers, 1)
+        spec = cpu_health.build_default_registry().specs['check_good_download_speed']
+        self.assertIn('low impact mode', spec.skip_if(cpu_check))
+
+        # The budget is shared by the speed tests of the run and counts every attempt
+        cpu_check = cpu_health.CPUCheck(config_file=self.config_file_path,
+                                        logs_folder=self.logs_folder_path, low_impact_mode=True,
+                                        low_impact_max_transfer_mb=25, max_connection_attempts=2,
+                                        file_sizes_to_download=['1MB', '10MB', '100MB'],
+                                        sleep_time=0, minimum_download_time=0.005)
+        self.assertEqual(cpu_check.get_low_impact_transfer_sizes(), ['1MB', '10MB'])
+        progress = []
+        self.assertTrue(cpu_check.run_speed_test(
+            lambda size, track_progress: progress.append(track_progress) or time.sleep(0.01)
+            or True, 'Download', cpu_check.speed_log_filename))
+        self.assertEqual(progress, [False, False])
+        self.assertEqual(cpu_check.low_impact_transferred_mb, 22)
+        self.assertEqual(cpu_check.get_low_impact_transfer_sizes(), ['1MB'])
+        low_impact_register = os.path.join(
+            self.logs_folder_path,
+            utilities.get_low_impact_register_filename(cpu_check.speed_log_filename))
+        self.assertTrue(os.path.isfile(low_impact_register))
+
+    def test_preflight_mode(self):
+        """
+        Test case to check that the pre-flight mode runs the checks from the fastest to the
+        slowest according to their measured durations, stops at the first failure, and skips
+        the checks expected to exceed the budget along with the checks depending on them.
+        """
+        # Checks never measured are expected to take longer the more expensive their class is
+        self.assertEqual(sorted(registry.COST_CLASSES, key=registry.DEFAULT_DURATIONS.get),
+                         registry.COST_CLASSES)
+        order = []
+
+        def make_check(name, result):
+            return registry.CheckSpec(name, lambda checkobj: order.append(name) or result)
+
+        with tempfile.TemporaryDirectory() as folder:
+            result_cache = cache.ResultCache(os.path.join(folder, 'cache.sqlite'))
+            for name, seconds in [('medium', 0.05), ('fast', 0.01), ('slow', 10)]:
+                result_cache.record_duration(name, seconds)
+
+            for medium_result, statuses in [
+                    (False, ['passed', 'failed', 'skipped', 'skipped']),
+                    (True, ['passed', 'passed', 'budget_skipped', 'budget_skipped'])]:
+                order.clear()
+                check_registry = registry.CheckRegistry()
+                for name, result in [('slow', True), ('medium', medium_result),
+                                     ('fast', True)]:
+                    check_registry.register(make_check(name, result))
+                check_registry.register(registry.CheckSpec('after_slow', lambda checkobj: True,
+                                                           depends_on=['slow']))
+                outcomes = registry.run_checks(self.cpu_check, check_registry,
+                                               result_cache=result_cache, run_time_budget=2,
+                                               preflight=True)
+                self.assertEqual(order, ['fast', 'medium'])
+                self.assertEqual([outcomes[name].status
+                                  for name in ['fast', 'medium', 'slow', 'after_slow']],
+                                 statuses)
+
+    def test_result_cache(self):
+        """
+        Test case to check that a fresh cached result is reused instead of measuring again,
+        that an expired one is measured again, and that the lease to measure a result can only
+        be held (and released) by one cache at a time.
+        """
+        measurements = []
+
+        def measure():
+            measurements.append(1)
+            return 'passed'
+
+        with tempfile.TemporaryDirectory() as folder:
+            result_cache = cache.ResultCache(os.path.join(folder, 'cache.sqlite'))
+            other_cache = cache.ResultCache(os.path.join(folder, 'cache.sqlite'))
+            key = result_cache.make_key('check_a', {'min_gb': 2})
+
+            self.assertEqual(result_cache.get_or_measure(key, 60, measure, 10), ('passed', None))
+            status, cached_result = other_cache.get_or_measure(key, 60, measure, 10)
+            self.assertEqual(status, 'passed')
+            self.assertIsNotNone(cached_result)
+            self.assertEqual(len(measurements), 1)
+            other_cache.get_or_measure(key, 0, measure, 10)
+            self.assertEqual(len(measurements), 2)
+
+            self.assertTrue(result_cache.acquire(key, 10))
+            self.assertFalse(other_cache.acquire(key, 10))
+            result_cache.release(key)
+            self.assertTrue(other_cache.acquire(key, 10))
+            # A cache whose lease was taken over doesn't release the lease of the other one
+            result_cache.release(key)
+            self.assertFalse(result_cache.acquire(key, 10))
+
+    def test_snapshot(self):
+        """
+        Test case to check that the outcomes of a run are read back from the snapshot, that a
+        single check is found without reading the others, and that other files are rejected.
+        """
+        outcomes = {'check_good_download_speed': registry.CheckOutcome(
+                        'check_good_download_speed', 'passed', 12.5, timestamp=1000.0),
+                    'check_fast_latency': registry.CheckOutcome('check_fast_latency',
+                                                                'timed_out', 60, cached=True)}
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'snapshot.bin')
+            snapshot.write_snapshot(filename, outcomes, {'check_good_download_speed': 95.5})
+            written, records = cpu_health_checks.read_snapshot(filename)
+            self.assertLess(time.time() - written, 60)
+            self.assertEqual(list(records), list(outcomes))
+            download = records['check_good_download_speed']
+            self.assertEqual((download.status, download.value, download.duration,
+                              download.timestamp, download.cached),
+                             ('passed', 95.5, 12.5, 1000.0, False))
+            latency = cpu_health_checks.read_check_result(filename, 'check_fast_latency')
+            self.assertEqual((latency.status, latency.cached), ('timed_out', True))
+            self.assertTrue(np.isnan(latency.value))
+            self.assertIsNone(cpu_health_checks.read_check_result(filename, 'check_other'))
+            self.assertEqual(os.path.getsize(filename),
+                             snapshot.HEADER.size + 2 * snapshot.RECORD.size)
+
+            # A snapshot that can't be replaced (e.g. mapped by a reader on Windows) is retried
+            # and then the temporary file is removed
+            with unittest.mock.patch.object(snapshot.os, 'replace',
+                                            side_effect=PermissionError('in use')) as replace, \
+                    unittest.mock.patch.object(snapshot.time, 'sleep'):
+                with self.assertRaises(PermissionError):
+                    snapshot.write_snapshot(filename, outcomes)
+            self.assertEqual(replace.call_count, snapshot.REPLACE_ATTEMPTS)
+            self.assertEqual(os.listdir(folder), ['snapshot.bin'])
+
+            with open(filename, 'wb') as f:
+                f.write(b'not a snapshot file')
+            with self.assertRaises(ValueError):
+                cpu_health_checks.read_snapshot(filename)
+
+    def test_cgroup_limits(self):
+        """
+        Test case to check that the cgroup v2 files are found and read, and that the usage is
+        evaluated relative to the CPU quota and memory limit, failing when throttled.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            cgroup_folder = os.path.join(folder, 'unified', 'app')
+            os.makedirs(cgroup_folder)
+            files = {'cgroup': '0::/app\n',
+                     'mounts': f'cgroup2 {folder}/unified cgroup2 rw,nosuid 0 0\n',
+                     'unified/app/cpu.max': '50000 100000\n',
+                     'unified/app/cpu.stat': ('usage_usec 1000000\nnr_periods 100\n'
+                                              'nr_throttled 0\nthrottled_usec 0\n'),
+                     'unified/app/memory.current': f'{2**29}\n',
+                     'unified/app/memory.max': f'{2**30}\n'}
+            for filename, content in files.items():
+                with open(os.path.join(folder, filename), 'w') as f:
+                    f.write(content)
+
+            cgroup = utilities.find_cgroup(os.path.join(folder, 'cgroup'),
+                                           os.path.join(folder, 'mounts'))
+            self.assertEqual(cgroup['version'], 2)
+            self.assertEqual(cgroup['cpu'], cgroup_folder)
+            before = utilities.read_cgroup_stats(cgroup)
+            self.assertEqual(before['cpu_quota'], 0.5)
+            self.assertEqual(before['memory_max'], 2**30)
+
+            # 0.25 CPUs used during 1 second is 50% of the quota
+            after = dict(before, usage_usec=1250000, nr_periods=110)
+            result, messages = utilities.evaluate_cgroup_usage(before, after, 1, 75, 10, 90)
+            self.assertTrue(result)
+            self.assertIn('50.00% of its quota', messages[0])
+            after['nr_throttled'] = 5
+            self.assertFalse(utilities.evaluate_cgroup_usage(before, after, 1, 75, 10, 90)[0])
+
+        self.assertIsNone(utilities.find_cgroup('/nonexistent/cgroup', '/nonexistent/mounts'))
+
+    def test_cpu_thermal_state(self):
+        """
+        Test case to check that the frequencies and temperatures are read from sysfs, and that a
+        core with a lowered frequency limit or a sensor near its critical temperature fails.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            files = {'devices/system/cpu/cpu0/cpufreq/scaling_cur_freq': '800000',
+                     'devices/system/cpu/cpu0/cpufreq/scaling_max_freq': '3000000',
+                     'devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq': '3000000',
+                     'devices/system/cpu/cpu1/cpufreq/scaling_cur_freq': '1000000',
+                     'devices/system/cpu/cpu1/cpufreq/scaling_max_freq': '1200000',
+                     'devices/system/cpu/cpu1/cpufreq/cpuinfo_max_freq': '3000000',
+                     'class/thermal/thermal_zone0/type': 'x86_pkg_temp',
+                     'class/thermal/thermal_zone0/temp': '97000',
+                     'class/thermal/thermal_zone0/trip_point_0_type': 'critical',
+                     'class/thermal/thermal_zone0/trip_point_0_temp': '100000'}
+            for filename, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(folder, filename)), exist_ok=True)
+                with open(os.path.join(folder, filename), 'w') as f:
+                    f.write(content + '\n')
+
+            state = utilities.read_cpu_thermal_state(folder)
+            self.assertEqual([core['limit_mhz'] for core in state['cores']], [3000, 1200])
+            self.assertEqual(state['sensors'], [{'label': 'x86_pkg_temp', 'current': 97,
+                                                 'critical': 100}])
+            result, messages = utilities.evaluate_cpu_thermal_state(state, 70, 5)
+            self.assertFalse(result)
+            self.assertEqual(len(messages), 2)
+            self.assertTrue(utilities.evaluate_cpu_thermal_state(state, 30, 2)[0])
+
+            # With the hardware counters the frequency limit is a power profile cap, and the
+            # cores throttled are the ones whose counters increased
+            throttle_folder = os.path.join(folder, 'devices/system/cpu/cpu0/thermal_throttle')
+            os.makedirs(throttle_folder)
+            for filename, content in [('core_throttle_count', '3'),
+                                      ('package_throttle_count', '2')]:
+                with open(os.path.join(throttle_folder, filename), 'w') as f:
+                    f.write(content + '\n')
+            state = utilities.read_cpu_thermal_state(folder)
+            self.assertEqual(state['throttle_counts'], {'cpu0': 5})
+            self.assertTrue(utilities.evaluate_cpu_thermal_state(state, 70, 2)[0])
+            self.assertTrue(utilities.evaluate_cpu_thermal_state(state, 70, 2, {'cpu0': 5})[0])
+            result, messages = utilities.evaluate_cpu_thermal_state(state, 70, 2, {'cpu0': 9})
+            self.assertFalse(result)
+            self.assertIn('4 times', messages[0])
+
+    def test_kernel_resource_headroom(self):
+        """
+        Test case to check that the usage of file descriptors, pids and ephemeral ports is read
+        from /proc files, and that the check fails when the headroom required is 100%.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            files = {'sys/fs/file-nr': '1000\t0\t10000\n',
+                     'loadavg': '0.11 0.17 0.16 1/900 14169\n',
+                     'sys/kernel/pid_max': '32768\n',
+                     'sys/kernel/threads-max': '1000\n',
+                     'sys/net/ipv4/ip_local_port_range': '32768\t60999\n',
+                     'net/sockstat': ('sockets: used 18\n'
+                                      'TCP: inuse 4 orphan 0 tw 2 alloc 4 mem 244\n'
+                                      'UDP: inuse 1 mem 0\n'),
+                     'net/sockstat6': 'TCP6: inuse 3\nUDP6: inuse 0\n'}
+            for filename, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(folder, filename)), exist_ok=True)
+                with open(os.path.join(folder, filename), 'w') as f:
+                    f.write(content)
+            self.assertEqual(utilities.read_kernel_resources(folder),
+                             {'file_descriptors': (1000, 10000), 'pids': (900, 1000),
+                              'ephemeral_ports': (10, 28232)})
+
+        if utilities.read_kernel_resources():
+            self.assertTrue(self.cpu_check.check_kernel_resource_headroom())
+            self.cpu_check.min_fd_headroom_percent = 100
+            self.assertFalse(self.cpu_check.check_kernel_resource_headroom())
+
+        # Deciding whether to skip the check and running it read /proc once
+        spec = cpu_health.build_default_registry().specs['check_kernel_resource_headroom']
+        cpu_check = cpu_health.CPUCheck(config_file=self.config_file_path,
+                                        logs_folder=self.logs_folder_path)
+        with unittest.mock.patch.object(utilities, 'read_kernel_resources',
+                                        return_value={'pids': (10, 100)}) as read:
+            self.assertIsNone(spec.skip_if(cpu_check))
+            self.assertTrue(cpu_check.check_kernel_resource_headroom())
+            read.assert_called_once()
+
     def test_idle_usage_max_cpu_zero_hundred(self):
         """
         Test case to check if check_enough_idle_usage returns True when max_cpu_usage is 100.
@@ -42,6 +791,55 @@ class SystemTestCase(unittest.TestCase):
         result = self.cpu_check.check_enough_idle_usage()
         self.assertTrue(result, 'check_enough_idle_usage is not True')
 
+    def test_idle_usage_top_processes_report(self):
+        """
+        Test case to check that when check_enough_idle_usage fails it reports the processes
+        using most CPU and memory, sorted and limited to top_processes.
+        """
+        self.cpu_check.max_cpu_usage = 0
+        self.cpu_check.top_processes = 3
+        self.assertFalse(self.cpu_check.check_enough_idle_usage())
+        report = self.cpu_check.reports['check_enough_idle_usage']
+        self.assertTrue(0 < len(report['top_rss']) <= 3)
+        self.assertLessEqual(len(report['top_cpu']), 3)
+        rss_values = [entry['rss_mb'] for entry in report['top_rss']]
+        self.assertEqual(rss_values, sorted(rss_values, reverse=True))
+
+    def test_battery_drain_rate(self):
+        """
+        Test case to check that the battery charge rate is estimated per power state from the
+        samples of every run, that a drain much faster than usual is flagged as abnormal, and
+        that a charge slowing down near full is not.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            def sample(minutes, percent, plugged=False):
+                return utilities.handle_battery_sample(folder, 'battery.json', percent, plugged,
+                                                       3, 2, now=60 * minutes)
+
+            self.assertIsNone(sample(0, 100)['rate'])
+            for hour, percent in enumerate([90, 80, 70, 60], start=1):
+                info = sample(60 * hour, percent)
+                self.assertAlmostEqual(info['rate'], -10)
+            # The plugged state has its own estimate, so it doesn't have enough rates yet
+            self.assertIsNone(sample(270, 62, plugged=True)['mean_rate'])
+
+            self.assertIsNone(sample(300, 55)['rate'])  # Previous sample was plugged
+            info = sample(360, 25)
+            self.assertAlmostEqual(info['mean_rate'], -10)
+            self.assertTrue(info['abnormal'])
+
+            # A normal charge slows down near full, which is neither stored nor flagged
+            for hour, percent in enumerate([20, 50, 80, 92, 97], start=7):
+                info = sample(60 * hour, percent, plugged=True)
+                self.assertFalse(info['abnormal'])
+            with open(os.path.join(folder, 'battery.json')) as f:
+                self.assertEqual(json.load(f)['rates']['plugged']['count'], 2)
+
+            # A truncated history starts again instead of failing
+            with open(os.path.join(folder, 'battery.json'), 'w') as f:
+                f.write('{"samples": [[0, 10')
+            self.assertIsNone(sample(720, 96, plugged=True)['rate'])
+
     def test_code_execution_minimums(self):
         """
         Test case to check if the code execution completes successfully with minimum parameters.
@@ -69,6 +867,8 @@ class SystemTestCase(unittest.TestCase):
 
         self.assertTrue(result['check_enough_disk_space'], 'check_enough_disk_space is not True')
         self.assertFalse(result['check_enough_idle_usage'], 'check_enough_idle_usage is not False')
+        # The processes using most CPU and memory are returned along with the results
+        self.assertIn('top_cpu', result.reports['check_enough_idle_usage'])
         if 'check_fast_latency' in result:
             self.assertFalse(result['check_fast_latency'], 'check_fast_latency is not False')
         if 'check_enough_battery_charge' in result: